@@ -1,9 +1,27 @@
 from __future__ import absolute_import
 import os
+import zlib
 from celery import Celery
+from kombu.serialization import register
+from kombu.utils.json import dumps, loads
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'communal_task.settings')
 
+def dumps_compressed(data):
+    return zlib.compress(dumps(data).encode())
+
+def loads_compressed(data):
+    # Бэкенд результатов декодирует все строки текущим сериализатором: результаты, сохраненные
+    # до включения сжатия, — обычный JSON (строка или байты, не начинающиеся с заголовка zlib)
+    if isinstance(data, bytes) and data[:1] == b'x':
+        data = zlib.decompress(data)
+    return loads(data.decode() if isinstance(data, bytes) else data)
+
+# JSON со сжатием zlib для результатов задач (TASK_RESULT_COMPRESSION); регистрируется во всех процессах,
+# читающих результаты
+register('json-zlib', dumps_compressed, loads_compressed, content_type='application/x-json-zlib',
+         content_encoding='binary')
+
 app = Celery('communal_task')
 
 app.config_from_object('django.conf:settings', namespace='CELERY')
@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 from pathlib import Path
 import environ
 import os
+from celery.schedules import crontab
 
 env = environ.Env(
     # set casting, default value
@@ -59,6 +60,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'home.middleware.MetricsMiddleware',
+    'home.middleware.QueryCountMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -124,6 +127,95 @@ AUTH_PASSWORD_VALIDATORS = [
 
 CELERY_BROKER_URL = f'redis://{env("REDIS_SERVER")}:6379/0'
 CELERY_RESULT_BACKEND = 'django-db'
+# Срок хранения результатов задач, сек.: устаревшие результаты удаляет задача celery.backend_cleanup,
+# которую celery_beat запускает ежедневно
+CELERY_RESULT_EXPIRES = env.int('CELERY_RESULT_EXPIRES', default=24 * 3600)
+# Сжатие результатов задач (zlib, см. communal_task/celery.py). Результаты, сохраненные до включения, читаются;
+# после выключения сжатые результаты не читаются до истечения CELERY_RESULT_EXPIRES
+TASK_RESULT_COMPRESSION = env.bool('TASK_RESULT_COMPRESSION', default=False)
+if TASK_RESULT_COMPRESSION:
+    CELERY_RESULT_SERIALIZER = 'json-zlib'
+    CELERY_RESULT_ACCEPT_CONTENT = ['json', 'json-zlib']
+# Очереди расчета (см. home/services/task_routing.py): расчет дома по запросу отправляется в calc_interactive
+# или calc_large по стоимости, расчет по городу и пересчет устаревших квитанций — в calc_batch
+CELERY_TASK_ROUTES = {
+    'home.celery_tasks.calculate_utility_bills_for_house_task': {'queue': 'calc_interactive'},
+    'home.celery_tasks.calculate_city_bills_task': {'queue': 'calc_batch'},
+    'home.celery_tasks.calculate_houses_chunk_task': {'queue': 'calc_batch'},
+    'home.celery_tasks.finish_city_calculation_task': {'queue': 'calc_batch'},
+    'home.celery_tasks.recalculate_stale_bills_task': {'queue': 'calc_batch'},
+    'home.celery_tasks.close_month_task': {'queue': 'calc_batch'},
+}
+# Задачи расчета долгие: воркер берет следующую задачу только после завершения текущей,
+# чтобы она не ждала в его буфере, пока ее может выполнить свободный воркер
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+# Ограничение частоты пачек расчета по городу на каждом воркере calc_batch (формат Celery: '10/m'), пусто — без ограничения
+CALC_BATCH_RATE_LIMIT = env('CALC_BATCH_RATE_LIMIT', default='')
+if CALC_BATCH_RATE_LIMIT:
+    CELERY_TASK_ANNOTATIONS = {
+        'home.celery_tasks.calculate_houses_chunk_task': {'rate_limit': CALC_BATCH_RATE_LIMIT},
+        'home.celery_tasks.recalculate_stale_bills_task': {'rate_limit': CALC_BATCH_RATE_LIMIT},
+    }
+
+# Кол-во квартир, рассчитываемых и записываемых в одной транзакции
+CALC_CHUNK_APARTMENTS = env.int('CALC_CHUNK_APARTMENTS', default=500)
+# Кол-во повторов расчета дома при сбое соединения с БД
+CALC_MAX_RETRIES = env.int('CALC_MAX_RETRIES', default=3)
+
+# Предельный срок, сек., в течение которого повторные запросы расчета дома за месяц присоединяются к уже запущенному
+CALC_LOCK_TIMEOUT = env.int('CALC_LOCK_TIMEOUT', default=3600)
+# Пауза перед повторным расчетом домов с ошибкой при расчете по городу, сек. (умножается на номер прохода)
+CITY_RETRY_DELAY = env.int('CITY_RETRY_DELAY', default=300)
+# Предельная задержка отправки пачки расчета по городу, сек.: меньше visibility_timeout брокера Redis (1 ч),
+# иначе отложенная пачка будет доставлена повторно; пачка, запланированная позже, откладывается заново
+CITY_MAX_COUNTDOWN = env.int('CITY_MAX_COUNTDOWN', default=1800)
+# Закрытие месяца по расписанию (celery_beat): расчет всех домов за предыдущий месяц в MONTH_CLOSE_DAY день месяца
+# в MONTH_CLOSE_HOUR часов, не быстрее MONTH_CLOSE_APARTMENTS_PER_SECOND квартир в секунду (0 — без ограничения),
+# дома с ошибкой рассчитываются повторно, всего не больше MONTH_CLOSE_MAX_ATTEMPTS проходов
+MONTH_CLOSE_DAY = env.int('MONTH_CLOSE_DAY', default=1)
+MONTH_CLOSE_HOUR = env.int('MONTH_CLOSE_HOUR', default=2)
+MONTH_CLOSE_APARTMENTS_PER_SECOND = env.float('MONTH_CLOSE_APARTMENTS_PER_SECOND', default=200)
+MONTH_CLOSE_MAX_ATTEMPTS = env.int('MONTH_CLOSE_MAX_ATTEMPTS', default=3)
+CELERY_BEAT_SCHEDULE = {
+    'close-month': {
+        'task': 'home.celery_tasks.close_month_task',
+        'schedule': crontab(minute=0, hour=MONTH_CLOSE_HOUR, day_of_month=MONTH_CLOSE_DAY),
+    },
+}
+# Стоимость расчета дома (квартиры + счётчики), начиная с которой расчет по запросу идет в очередь calc_large
+CALC_LARGE_HOUSE_COST = env.int('CALC_LARGE_HOUSE_COST', default=3000)
+# Примерное кол-во квартир в одной пачке при расчете по всему городу
+CITY_CHUNK_APARTMENTS = env.int('CITY_CHUNK_APARTMENTS', default=2000)
+
+# Справочники (тарифы, типы счётчиков) в памяти процесса: шина инвалидации между процессами
+# ('redis' — pub/sub, 'local' — только текущий процесс) и предельный срок жизни копии в секундах
+REFERENCE_CACHE_BUS = env('REFERENCE_CACHE_BUS', default='redis')
+REFERENCE_CACHE_REDIS_URL = env('REFERENCE_CACHE_REDIS_URL', default=CELERY_BROKER_URL)
+REFERENCE_CACHE_TTL = env.int('REFERENCE_CACHE_TTL', default=300)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': env('CACHE_REDIS_URL', default=f'redis://{env("REDIS_SERVER")}:6379/1'),
+    }
+}
+# Срок хранения готовых ответов (данные дома) в кэше, сек.; версии домов хранятся бессрочно
+RESPONSE_CACHE_TIMEOUT = env.int('RESPONSE_CACHE_TIMEOUT', default=3600)
+
+# Порог кол-ва SQL-запросов за один HTTP-запрос, после которого запрос пишется в лог как предупреждение
+QUERY_COUNT_WARNING = env.int('QUERY_COUNT_WARNING', default=50)
+
+# События хода расчета для потоковой выдачи клиентам: шина ('redis' — pub/sub, 'local' — только текущий процесс),
+# срок хранения последнего события задачи, предельная длительность потока SSE и ожидания long-poll,
+# интервал пустых сообщений для поддержания соединения, сек.
+TASK_EVENTS_BUS = env('TASK_EVENTS_BUS', default='redis')
+TASK_EVENTS_REDIS_URL = env('TASK_EVENTS_REDIS_URL', default=CELERY_BROKER_URL)
+TASK_EVENTS_TTL = env.int('TASK_EVENTS_TTL', default=86400)
+TASK_EVENTS_STREAM_TIMEOUT = env.int('TASK_EVENTS_STREAM_TIMEOUT', default=900)
+TASK_EVENTS_POLL_TIMEOUT = env.int('TASK_EVENTS_POLL_TIMEOUT', default=30)
+TASK_EVENTS_KEEPALIVE = env.int('TASK_EVENTS_KEEPALIVE', default=15)
+# Адреса, с которых доступен /metrics (Prometheus)
+METRICS_ALLOWED_IPS = env.list('METRICS_ALLOWED_IPS', default=['127.0.0.1', '::1'])
 
 # Internationalization
 # https://docs.djangoproject.com/en/5.1/topics/i18n/
@@ -26,7 +26,20 @@ from home.views import (ApartmentDetailView,
                         HouseListViewSet,
                         HouseDetailView,
                         MetersByHouseView,
-                        TaskResultView)
+                        TaskResultView,
+                        CityBillCalculationView,
+                        CalculationRunView,
+                        MeterReadingsImportView,
+                        StaleBillsView,
+                        UtilityBillListView,
+                        UtilityBillExportView,
+                        MetricsView,
+                        CalculationProfileView,
+                        ConsumptionAnalyticsView,
+                        AsyncHouseListView,
+                        AsyncMeterListView,
+                        AsyncTaskResultView,
+                        AsyncTaskEventsView)
 from drf_yasg.views import get_schema_view
 from rest_framework import permissions
 from drf_yasg import openapi
@@ -58,7 +71,20 @@ urlpatterns = [
     path('api/apartment/<int:id>/', ApartmentDetailView.as_view(), name='apartment-detail'),
     path('api/meters/house/<int:house_id>/', MetersByHouseView.as_view(), name='meters-by-house'),
     path('api/meter/<int:id>/', MeterDetailView.as_view(), name='meter-detail'),
+    path('api/readings/import/', MeterReadingsImportView.as_view(), name='readings-import'),
     path('api/tasks/<str:task_id>/result/', TaskResultView.as_view(), name='task_status'),
+    path('api/tasks/<str:task_id>/profile/', CalculationProfileView.as_view(), name='task_profile'),
+    path('api/calculate_bills/', CityBillCalculationView.as_view(), name='calculate_city_bills'),
+    path('api/calculations/<int:id>/', CalculationRunView.as_view(), name='calculation-run'),
+    path('api/bills/', UtilityBillListView.as_view(), name='bills'),
+    path('api/bills/export/', UtilityBillExportView.as_view(), name='bills-export'),
+    path('api/bills/stale/', StaleBillsView.as_view(), name='stale-bills'),
+    path('api/analytics/consumption/', ConsumptionAnalyticsView.as_view(), name='consumption-analytics'),
+    path('api/async/houses/', AsyncHouseListView.as_view(), name='async-houses'),
+    path('api/async/meters/', AsyncMeterListView.as_view(), name='async-meters'),
+    path('api/async/tasks/<str:task_id>/result/', AsyncTaskResultView.as_view(), name='async-task-status'),
+    path('api/async/tasks/<str:task_id>/events/', AsyncTaskEventsView.as_view(), name='async-task-events'),
+    path('metrics', MetricsView.as_view(), name='metrics'),
     re_path(r'^swagger(?P<format>\.json|\.yaml)$', schema_view.without_ui(cache_timeout=0), name='schema-json'),
     path('swagger/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
     path('redoc/', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import House, Apartment, Meter, MeterType, Tariff
+from .models import House, Apartment, Meter, MeterReading, MeterType, Tariff
+from .services.reference_cache import get_meter_type
 from django import forms
 from django.utils.html import format_html
 from django.urls import reverse
@@ -9,6 +10,13 @@ class MeterInline(admin.TabularInline):
   extra = 0
 
 
+class MeterReadingInline(admin.TabularInline):
+  model = MeterReading
+  extra = 0
+  ordering = ['-period']
+  readonly_fields = ['consumption', 'consumption_months', 'average_consumption']
+
+
 class ApartmentInline(admin.TabularInline):
   model = Apartment
   extra = 0
@@ -35,6 +43,7 @@ class HouseAdmin(admin.ModelAdmin):
 @admin.register(Apartment)
 class ApartmentAdmin(admin.ModelAdmin):
   list_display = ['number', 'area', 'house']
+  list_select_related = ['house']
   list_filter = ['house']
   ordering = ['house', 'area']
   inlines = [MeterInline]
@@ -43,10 +52,33 @@ class ApartmentAdmin(admin.ModelAdmin):
     extra_context = {'title': 'Выберите квартиру чтобы изменить'}
     return super(ApartmentAdmin, self).changelist_view(request, extra_context=extra_context)
 
+class ApartmentListFilter(admin.RelatedFieldListFilter):
+  """
+  Фильтр по квартире: название квартиры включает адрес дома, загружаем дома тем же запросом
+  """
+  def field_choices(self, field, request, model_admin):
+    apartments = Apartment.objects.select_related('house').order_by('house__address', 'number')
+    return [(apartment.pk, str(apartment)) for apartment in apartments]
+
 @admin.register(Meter)
 class MeterAdmin(admin.ModelAdmin):
-  list_display = ('id', 'meter_number', 'meter_type', 'readings', 'get_apartment_number', 'get_house')
-  list_filter = ['apartment', 'apartment__house']
+  list_display = ('id', 'meter_number', 'get_meter_type', 'get_readings', 'get_apartment_number', 'get_house')
+  list_select_related = ['apartment__house']
+  list_filter = [('apartment', ApartmentListFilter), 'apartment__house']
+  inlines = [MeterReadingInline]
+
+  def get_queryset(self, request):
+    return super().get_queryset(request).prefetch_related('meter_readings')
+
+  def get_meter_type(self, obj):
+    return get_meter_type(obj.meter_type_id)
+
+  get_meter_type.short_description = 'Тип счётчика'
+
+  def get_readings(self, obj):
+    return ', '.join(f'{month}: {value}' for month, value in obj.readings.items())
+
+  get_readings.short_description = 'Показания'
 
   def get_apartment_number(self, obj):
     return obj.apartment.number
@@ -104,7 +136,8 @@ class TariffAdmin(admin.ModelAdmin):
   list_display = ('id', 'name', 'price_per_unit', 'unit')
 
   def name(self, obj):
-    return obj.custom_name or obj.meter_type.name if obj.meter_type else 'No Name'
+    meter_type = get_meter_type(obj.meter_type_id)
+    return obj.custom_name or meter_type.name if meter_type else 'No Name'
 
   name.short_description = 'Название'
 
@@ -6,3 +6,6 @@ class HomeConfig(AppConfig):
     name = 'home'
     verbose_name = 'Управление МКД'
 
+    def ready(self):
+        from . import metrics, signals  # noqa: F401
+
@@ -1,23 +1,270 @@
-from celery import shared_task
-from .models import CalculationProgress
-from .services.calc_tarif import calculate_utility_bills_for_house
+from datetime import date
+from celery import shared_task, chord
+from celery.signals import task_failure
+from dateutil.relativedelta import relativedelta
+from django.conf import settings
+from django.db import OperationalError
+from django.db.models import F, Sum
+from django.urls import reverse
+from django.utils import timezone
+from urllib.parse import urlencode
+from .models import CalculationProgress, CalculationRun, ConsumptionRollup, UtilityBill
+from .services.calc_tarif import calculate_utility_bills_for_house, ENGINE_DECIMAL
+from .services.analytics import refresh_house_rollups
+from .services.profiling import create_profiler
+from .services.city_calc import select_houses, build_house_chunks, get_failed_house_ids, get_chunk_delays
+from .services.stale_bills import recalculate_stale_bills, STALE_BATCH_SIZE
+from .services.calculation_lock import release_house_calculation
+from .services.task_events import publish_task_event, get_progress_data, EVENT_DONE, EVENT_ERROR
+import inspect
 import time
 
-@shared_task(bind=True)
-def calculate_utility_bills_for_house_task(self, house_id, year, month, delay=0):
-  try:
-    time.sleep(delay)
+def get_progress(task_id, house_id, year, month, run=None):
+  """
+  Незавершенный прогресс дома за месяц, с контрольной точки которого продолжается расчет: того же расчета
+  по городу (повторная доставка пачки или повторный проход домов с ошибкой) либо, вне расчета по городу,
+  той же задачи (повтор или повторная доставка после падения воркера). Иначе — новая запись прогресса.
+  """
+  progress = None
+  if run is not None or task_id:
+    unfinished = (CalculationProgress.objects
+                  .filter(house_id=house_id, year=year, month=month)
+                  .exclude(status="готово"))
+    unfinished = unfinished.filter(run=run) if run is not None else unfinished.filter(task_id=task_id)
+    progress = unfinished.order_by('-id').first()
 
-    progress = CalculationProgress.objects.create(house_id=house_id, year=year, month=month, status="в работе")
+  if progress is None:
+    return CalculationProgress.objects.create(run=run, task_id=task_id, house_id=house_id, year=year, month=month,
+                                              status="в работе")
 
-    result = calculate_utility_bills_for_house(house_id, year, month)
+  # Прогресс переходит к текущей задаче: по ней опрашивается статус и доставляются события
+  progress.task_id = task_id
+  progress.status = "в работе"
+  progress.error_message = None
+  progress.save(update_fields=['task_id', 'status', 'error_message', 'updated_at'])
+  return progress
 
-    progress.status = "готово"
-    progress.save()
+def run_house_calculation(house_id, year, month, engine=ENGINE_DECIMAL, run=None, task_id=None, profile=None):
+  """
+  profile — None (без профилирования) или список инструментов профилирования (см. services.profiling);
+  профиль сохраняется в CalculationProgress и при ошибке расчета
+  """
+  progress = get_progress(task_id, house_id, year, month, run)
+  profiler = create_profiler(profile)
 
-    return result
+  try:
+    result = calculate_utility_bills_for_house(house_id, year, month, engine, progress=progress, profiler=profiler)
   except Exception as e:
     progress.status = "ошибка"
     progress.error_message = str(e)
+    progress.profile = profiler.to_dict()
     progress.save()
     raise e
+
+  progress.status = "готово"
+  progress.profile = profiler.to_dict()
+  progress.save()
+  refresh_house_rollups(house_id, date(year, month, 1))
+
+  return progress, result
+
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True, autoretry_for=(OperationalError,),
+             retry_backoff=True, max_retries=settings.CALC_MAX_RETRIES)
+def calculate_utility_bills_for_house_task(self, house_id, year, month, delay=0, engine=ENGINE_DECIMAL, profile=None):
+  if not self.request.retries:
+    time.sleep(delay)
+
+  progress, _ = run_house_calculation(house_id, year, month, engine, task_id=self.request.id, profile=profile)
+  release_house_calculation(house_id, year, month, self.request.id)
+
+  summary = get_house_summary(progress)
+  publish_task_event(self.request.id, EVENT_DONE, {'status': 'Расчет квартплаты выполнен', 'data': summary})
+  return summary
+
+def get_house_summary(progress):
+  """
+  Результат задачи расчета дома: итоги и ссылка на сохраненные квитанции (UtilityBill) вместо строк квитанций,
+  чтобы результат в бэкенде результатов и ответ опроса статуса не росли с размером дома.
+  Итоги считаются по сохраненным квитанциям дома за месяц (сумма — по итогам начислений, пересчитанным
+  после расчета), а не по строкам текущей попытки: после продолжения с контрольной точки в них
+  есть только пачки этой попытки.
+  """
+  month_start = date(progress.year, progress.month, 1)
+  month = f'{progress.year}-{progress.month:02d}'
+  cost = (ConsumptionRollup.objects
+          .filter(house_id=progress.house_id, month=month_start)
+          .aggregate(cost=Sum('cost'))['cost'])
+  return {
+    **get_progress_data(progress)['progress'],
+    'year': progress.year,
+    'month': progress.month,
+    'bills': UtilityBill.objects.filter(apartment__house_id=progress.house_id, month=month_start).count(),
+    'cost': float(cost or 0),
+    'bills_url': f"{reverse('bills')}?{urlencode({'house_id': progress.house_id, 'month_from': month, 'month_to': month})}"
+  }
+
+@task_failure.connect
+def house_calculation_failed(sender=None, task_id=None, exception=None, args=None, kwargs=None, **extra):
+  # Сигнал отправляется только после последней попытки: при повторе расчет еще продолжится
+  if sender is not None and sender.name == calculate_utility_bills_for_house_task.name:
+    call = inspect.signature(sender.run).bind_partial(*(args or ()), **(kwargs or {})).arguments
+    release_house_calculation(call['house_id'], call['year'], call['month'], task_id)
+    publish_task_event(task_id, EVENT_ERROR, {'status': 'Ошибка выполнения расчета квартплаты', 'error': str(exception)})
+
+@shared_task(bind=True)
+def calculate_city_bills_task(self, run_id):
+  """
+  Раскладывает дома по пачкам и запускает их расчет группой с общим завершающим шагом
+  """
+  run = CalculationRun.objects.get(id=run_id)
+
+  houses = select_houses(run.house_ids)
+  chunks = build_house_chunks(houses, settings.CITY_CHUNK_APARTMENTS)
+
+  CalculationRun.objects.filter(id=run_id).update(
+    houses_total=len(houses),
+    apartments_total=sum(apartments_count for _, apartments_count in houses)
+  )
+
+  if not chunks:
+    return finish_city_calculation_task([], run_id)
+
+  dispatch_city_chunks(run, chunks, dict(houses))
+
+  return {'run_id': run_id, 'chunks': len(chunks)}
+
+def dispatch_city_chunks(run, chunks, apartments_counts, delay=0, chunks_dispatched=0):
+  """
+  Запуск пачек домов группой с общим завершающим шагом через delay сек. Ограничение скорости расчета
+  соблюдается при запуске: каждая пачка откладывается по бюджету квартир предыдущих пачек, воркер не ждет.
+  Завершающий шаг получает кол-во пачек всех проходов; при ошибке пачки или завершающего шага
+  расчет помечается ошибкой.
+  """
+  delays = get_chunk_delays(chunks, apartments_counts, run.apartments_per_second_limit)
+  started_at = time.time()
+  callback = (finish_city_calculation_task.s(run.id, chunks_dispatched + len(chunks))
+              .on_error(fail_city_calculation_task.s(run.id)))
+
+  chord(
+    get_chunk_signature(run.id, chunk, delay + chunk_delay, started_at)
+    for chunk, chunk_delay in zip(chunks, delays)
+  )(callback)
+
+def get_chunk_signature(run_id, house_ids, delay, started_at):
+  # Задержка больше CITY_MAX_COUNTDOWN набирается повторными откладываниями (см. calculate_houses_chunk_task)
+  not_before = started_at + delay if delay > settings.CITY_MAX_COUNTDOWN else None
+  return (calculate_houses_chunk_task.s(run_id, house_ids, not_before=not_before)
+          .set(countdown=min(delay, settings.CITY_MAX_COUNTDOWN) or None))
+
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True, max_retries=None)
+def calculate_houses_chunk_task(self, run_id, house_ids, not_before=None):
+  # Пачка запланирована позже предельной задержки отправки: откладывается снова, не занимая процесс воркера
+  if not_before is not None and not_before > time.time():
+    raise self.retry(countdown=min(not_before - time.time(), settings.CITY_MAX_COUNTDOWN))
+
+  run = CalculationRun.objects.get(id=run_id)
+  runs = CalculationRun.objects.filter(id=run_id)
+  houses_done = apartments_done = houses_failed = 0
+
+  # При повторной доставке пачки уже рассчитанные дома не пересчитываются и не учитываются повторно
+  finished = set(CalculationProgress.objects
+                 .filter(task_id=self.request.id, status="готово")
+                 .values_list('house_id', flat=True))
+
+  for house_id in house_ids:
+    if house_id in finished:
+      continue
+
+    try:
+      progress, _ = run_house_calculation(house_id, run.year, run.month, run.engine, run=run, task_id=self.request.id)
+    except Exception:
+      # Ошибка сохранена в CalculationProgress дома, переходим к следующему
+      houses_failed += 1
+      runs.update(houses_failed=F('houses_failed') + 1)
+      continue
+
+    houses_done += 1
+    apartments_done += progress.processed_apartments
+    runs.update(houses_done=F('houses_done') + 1,
+                apartments_done=F('apartments_done') + progress.processed_apartments)
+
+  return {'houses_done': houses_done, 'houses_failed': houses_failed, 'apartments_done': apartments_done}
+
+@shared_task
+def finish_city_calculation_task(chunk_results, run_id, chunks_dispatched=0):
+  """
+  Завершающий шаг прохода: повтор домов с ошибкой или итоговая сводка расчета.
+  chunks_dispatched — кол-во пачек, запущенных всеми проходами.
+  """
+  run = CalculationRun.objects.get(id=run_id)
+
+  # Дома с ошибкой рассчитываются повторно, пока не исчерпаны проходы расчета
+  failed_house_ids = get_failed_house_ids(run_id) if run.attempts < run.max_attempts else []
+  houses = select_houses(failed_house_ids) if failed_house_ids else []
+  chunks = build_house_chunks(houses, settings.CITY_CHUNK_APARTMENTS)
+  if chunks:
+    CalculationRun.objects.filter(id=run_id).update(attempts=F('attempts') + 1,
+                                                    houses_failed=F('houses_failed') - len(failed_house_ids))
+    dispatch_city_chunks(run, chunks, dict(houses), delay=settings.CITY_RETRY_DELAY * run.attempts,
+                         chunks_dispatched=chunks_dispatched)
+    return {'run_id': run_id, 'retry_houses': len(failed_house_ids), 'chunks': len(chunks)}
+
+  run.finished_at = timezone.now()
+  duration = (run.finished_at - run.created_at).total_seconds()
+
+  run.status = "готово"
+  run.summary = {
+    'houses_total': run.houses_total,
+    'houses_done': run.houses_done,
+    'houses_failed': run.houses_failed,
+    'apartments_done': run.apartments_done,
+    'chunks': chunks_dispatched,
+    'attempts': run.attempts,
+    'duration_seconds': round(duration, 3),
+    'apartments_per_second': round(run.apartments_done / duration, 1) if duration else 0,
+    'apartments_per_second_limit': run.apartments_per_second_limit
+  }
+  run.save(update_fields=['status', 'summary', 'finished_at'])
+
+  return run.summary
+
+@shared_task
+def fail_city_calculation_task(request, exc, traceback, run_id):
+  """
+  Обработчик ошибки пачки или завершающего шага расчета по городу (link_error): без него
+  завершающий шаг не выполнится и расчет останется в работе
+  """
+  CalculationRun.objects.filter(id=run_id, status="в работе").update(
+    status="ошибка",
+    finished_at=timezone.now(),
+    summary={'error': str(exc), 'task_id': request.id}
+  )
+
+@shared_task
+def close_month_task(year=None, month=None):
+  """
+  Закрытие месяца по расписанию (CELERY_BEAT_SCHEDULE): расчет всех домов за предыдущий месяц
+  с ограничением MONTH_CLOSE_APARTMENTS_PER_SECOND и повтором домов с ошибкой.
+  На месяц создается один CalculationRun: повторный запуск за тот же месяц ничего не делает.
+  """
+  if year is None or month is None:
+    previous_month = timezone.localdate().replace(day=1) - relativedelta(months=1)
+    year, month = previous_month.year, previous_month.month
+
+  # Уникальное ограничение на закрытие месяца: при параллельном запуске get_or_create вернет созданный расчет
+  run, created = CalculationRun.objects.get_or_create(
+    trigger='schedule', year=year, month=month,
+    defaults={
+      'apartments_per_second_limit': settings.MONTH_CLOSE_APARTMENTS_PER_SECOND or None,
+      'max_attempts': settings.MONTH_CLOSE_MAX_ATTEMPTS
+    }
+  )
+  if not created:
+    return {'run_id': run.id, 'status': 'закрытие месяца уже запущено'}
+
+  calculate_city_bills_task.delay(run.id)
+  return {'run_id': run.id, 'year': year, 'month': month}
+
+@shared_task(bind=True)
+def recalculate_stale_bills_task(self, batch_size=STALE_BATCH_SIZE):
+  return recalculate_stale_bills(batch_size)
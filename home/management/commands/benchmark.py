@@ -0,0 +1,44 @@
+import json
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from home.celery_tasks import calculate_utility_bills_for_house_task
+from home.services.benchmark import run_benchmark
+from home.services.calc_tarif import ENGINES
+
+class Command(BaseCommand):
+  help = ('Замеры расчета квитанций, задачи Celery и эндпоинтов чтения на синтетических домах разного размера. '
+          'Данные создаются в транзакции текущей БД и откатываются после замеров.')
+
+  def add_arguments(self, parser):
+    parser.add_argument('--scales', type=int, nargs='+', default=[10, 100, 1000], help='Кол-во квартир в доме')
+    parser.add_argument('--meters', type=int, default=3, help='Кол-во счётчиков в квартире')
+    parser.add_argument('--years', type=int, default=3, help='За сколько лет генерировать показания')
+    parser.add_argument('--repeats', type=int, default=5, help='Кол-во повторов каждого замера')
+    parser.add_argument('--engines', nargs='+', choices=ENGINES, default=list(ENGINES), help='Движки расчета')
+    parser.add_argument('--skip-celery', action='store_true', help='Не замерять путь через задачу Celery')
+    parser.add_argument('--keep-data', action='store_true', help='Зафиксировать созданные данные в БД')
+    parser.add_argument('--output', help='Файл с результатами (JSON), по умолчанию benchmark-<время>.json')
+
+  def handle(self, *args, **options):
+    if options['repeats'] < 1:
+      raise CommandError('--repeats должен быть не меньше 1.')
+
+    report = run_benchmark(
+      options['scales'], meters_per_apartment=options['meters'], years=options['years'],
+      repeats=options['repeats'], engines=options['engines'],
+      task=None if options['skip_celery'] else calculate_utility_bills_for_house_task,
+      cleanup=not options['keep_data']
+    )
+
+    output = options['output'] or f"benchmark-{datetime.now():%Y%m%d-%H%M%S}.json"
+    with open(output, 'w', encoding='utf-8') as file:
+      json.dump(report, file, ensure_ascii=False, indent=2)
+
+    for scale in report['results']:
+      for engine, result in scale['calculation'].items():
+        self.stdout.write(
+          f"{scale['apartments']} кв., {engine}: p50 {result['p50_ms']} мс, p99 {result['p99_ms']} мс, "
+          f"{result['apartments_per_second']} кв/с, пик памяти {result['peak_memory_kb']} КБ"
+        )
+
+    self.stdout.write(self.style.SUCCESS(f'Результаты записаны в {output}'))
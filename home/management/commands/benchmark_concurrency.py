@@ -0,0 +1,47 @@
+import json
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from home.services.benchmark import run_concurrency_benchmark
+
+class Command(BaseCommand):
+  help = ('Сравнение синхронного (WSGI, gunicorn) и асинхронного (ASGI, uvicorn) серверов под одновременной '
+          'нагрузкой на эндпоинтах чтения: запросов в секунду, p50/p99, ошибки. Серверы должны быть запущены '
+          'с одинаковым кол-вом воркеров и общей БД (данные — командой generate_data).')
+
+  def add_arguments(self, parser):
+    parser.add_argument('--sync-url', default='http://localhost:8002', help='Базовый URL синхронного сервера')
+    parser.add_argument('--async-url', default='http://localhost:8001', help='Базовый URL асинхронного сервера')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50, 100],
+                        help='Кол-во одновременных запросов')
+    parser.add_argument('--requests', type=int, default=1000, help='Кол-во запросов на каждый замер')
+    parser.add_argument('--task-id', default='benchmark-unknown-task',
+                        help='id задачи для опроса статуса (по умолчанию задача в очереди)')
+    parser.add_argument('--output', help='Файл с результатами (JSON), по умолчанию benchmark-concurrency-<время>.json')
+
+  def handle(self, *args, **options):
+    if options['requests'] < 1 or min(options['concurrency']) < 1:
+      raise CommandError('--requests и --concurrency должны быть не меньше 1.')
+
+    task_id = options['task_id']
+    endpoints = {
+      'houses': {'sync': ['/api/houses/'], 'async': ['/api/async/houses/']},
+      'meters': {'sync': ['/api/meters/?readings_last=3'], 'async': ['/api/async/meters/?readings_last=3']},
+      'task_result': {'sync': [f'/api/tasks/{task_id}/result/'], 'async': [f'/api/async/tasks/{task_id}/result/']},
+    }
+    report = run_concurrency_benchmark(
+      {'sync': options['sync_url'], 'async': options['async_url']}, endpoints,
+      options['concurrency'], options['requests']
+    )
+
+    output = options['output'] or f"benchmark-concurrency-{datetime.now():%Y%m%d-%H%M%S}.json"
+    with open(output, 'w', encoding='utf-8') as file:
+      json.dump(report, file, ensure_ascii=False, indent=2)
+
+    for result in report['results']:
+      self.stdout.write(
+        f"{result['endpoint']}, {result['server']}, {result['concurrency']} одновременно: "
+        f"{result['requests_per_second']} запр/с, p50 {result['p50_ms']} мс, p99 {result['p99_ms']} мс, "
+        f"ошибок {result['errors']}"
+      )
+
+    self.stdout.write(self.style.SUCCESS(f'Результаты записаны в {output}'))
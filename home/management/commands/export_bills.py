@@ -0,0 +1,34 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from home.services.bills import filter_bills, BillFilterError
+from home.services.bills_export import export_bills, EXPORT_CHUNK_SIZE
+from home.services.readings_import import FORMATS, FORMAT_NDJSON
+
+class Command(BaseCommand):
+  help = 'Потоковая выгрузка квитанций в NDJSON или CSV (по дому, квартире, месяцам или по всему городу)'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--house-id', help='ID дома')
+    parser.add_argument('--apartment-id', help='ID квартиры')
+    parser.add_argument('--month-from', help='Начальный месяц (YYYY-MM), включительно')
+    parser.add_argument('--month-to', help='Конечный месяц (YYYY-MM), включительно')
+    parser.add_argument('--format', choices=FORMATS, default=FORMAT_NDJSON, help='Формат выгрузки')
+    parser.add_argument('--output', help='Путь к файлу (по умолчанию stdout)')
+    parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE, help='Кол-во строк в пачке')
+
+  def handle(self, *args, **options):
+    try:
+      bills = filter_bills(options['house_id'], options['apartment_id'], options['month_from'], options['month_to'])
+    except BillFilterError as e:
+      raise CommandError(str(e))
+
+    chunks = export_bills(bills, options['format'], options['chunk_size'])
+
+    if not options['output']:
+      for chunk in chunks:
+        sys.stdout.write(chunk)
+      return
+
+    with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+      for chunk in chunks:
+        output.write(chunk)
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+from home.services.dataset import generate_dataset, DATASET_BATCH_SIZE
+from home.services.readings import parse_period
+
+class Command(BaseCommand):
+  help = 'Генерация синтетических домов, квартир, счётчиков и помесячных показаний с пропусками'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--houses', type=int, default=10, help='Кол-во домов')
+    parser.add_argument('--apartments', type=int, default=100, help='Кол-во квартир в доме')
+    parser.add_argument('--meters', type=int, default=3, help='Кол-во счётчиков в квартире')
+    parser.add_argument('--years', type=int, default=3, help='За сколько лет генерировать показания')
+    parser.add_argument('--gap-rate', type=float, default=0.05, help='Доля пропущенных месяцев (0..1)')
+    parser.add_argument('--last-month', help='Последний месяц показаний (YYYY-MM), по умолчанию текущий')
+    parser.add_argument('--seed', type=int, help='Начальное значение генератора для воспроизводимых данных')
+    parser.add_argument('--prefix', default='Синтетическая ул.', help='Начало адреса домов')
+    parser.add_argument('--batch-size', type=int, default=DATASET_BATCH_SIZE, help='Кол-во строк в пачке')
+
+  def handle(self, *args, **options):
+    if not 0 <= options['gap_rate'] < 1:
+      raise CommandError('--gap-rate должен быть в диапазоне [0, 1).')
+
+    last_month = None
+    if options['last_month']:
+      try:
+        last_month = parse_period(options['last_month'])
+      except ValueError:
+        raise CommandError('--last-month должен быть в формате YYYY-MM.')
+
+    house_ids, counts = generate_dataset(
+      options['houses'], options['apartments'], options['meters'], options['years'],
+      gap_rate=options['gap_rate'], last_month=last_month, seed=options['seed'],
+      address_prefix=options['prefix'], batch_size=options['batch_size']
+    )
+
+    self.stdout.write(self.style.SUCCESS(
+      f"Создано домов: {counts['houses']}, квартир: {counts['apartments']}, счётчиков: {counts['meters']}, "
+      f"показаний: {counts['readings']} (id домов {house_ids[0]}..{house_ids[-1]})" if house_ids else 'Дома не созданы'
+    ))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from home.services.readings_import import import_readings, detect_format, FORMATS, IMPORT_BATCH_SIZE
+
+class Command(BaseCommand):
+  help = 'Импорт показаний счётчиков из CSV (meter_id,period,value) или NDJSON файла'
+
+  def add_arguments(self, parser):
+    parser.add_argument('path', help='Путь к файлу с показаниями')
+    parser.add_argument('--format', choices=FORMATS, help='Формат файла (по умолчанию по расширению)')
+    parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE, help='Кол-во строк в пачке')
+
+  def handle(self, *args, **options):
+    file_format = options['format'] or detect_format(options['path'])
+
+    with open(options['path'], encoding='utf-8-sig', newline='') as lines:
+      report = import_readings(lines, file_format, options['batch_size'])
+
+    for error in report['errors']:
+      self.stderr.write(f"Строка {error['row']}: {error['error']}")
+    if report['failed'] > len(report['errors']):
+      self.stderr.write(f"... и еще строк с ошибками: {report['failed'] - len(report['errors'])}")
+
+    self.stdout.write(self.style.SUCCESS(
+      f"Обработано строк: {report['total']}, записано: {report['created']}, с ошибками: {report['failed']}"
+    ))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from home.services.analytics import refresh_house_rollups
+from home.services.bills import filter_bills, BillFilterError
+
+class Command(BaseCommand):
+  help = 'Пересчет итогов начислений домов по месяцам из уже рассчитанных квитанций'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--house-id', help='ID дома')
+    parser.add_argument('--month-from', help='Начальный месяц (YYYY-MM), включительно')
+    parser.add_argument('--month-to', help='Конечный месяц (YYYY-MM), включительно')
+
+  def handle(self, *args, **options):
+    try:
+      bills = filter_bills(options['house_id'], None, options['month_from'], options['month_to'])
+    except BillFilterError as e:
+      raise CommandError(str(e))
+
+    house_months = (bills
+                    .order_by('apartment__house_id', 'month')
+                    .values_list('apartment__house_id', 'month')
+                    .distinct())
+    refreshed = 0
+    for house_id, month in list(house_months):
+      refresh_house_rollups(house_id, month)
+      refreshed += 1
+
+    self.stdout.write(self.style.SUCCESS(f'Пересчитаны итоги: {refreshed} (дом, месяц)'))
@@ -0,0 +1,143 @@
+"""
+Метрики Prometheus: расчет квитанций, задачи Celery, HTTP-запросы и запросы к БД.
+
+В нескольких процессах (gunicorn, prefork-воркеры Celery) метрики пишутся в файлы каталога
+из переменной окружения PROMETHEUS_MULTIPROC_DIR (задается до запуска процессов, каталог очищается
+при перезапуске) и собираются вместе при запросе /metrics. Каталог может быть общим для нескольких
+контейнеров (web и воркеры Celery): файлы процессов различаются по имени хоста и PID.
+Без этой переменной метрики хранятся в памяти процесса.
+"""
+import os
+import socket
+import time
+from celery import signals as celery_signals
+from django.db.backends.signals import connection_created
+from prometheus_client import (CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest,
+                               multiprocess, values)
+
+# PID в разных контейнерах повторяются, поэтому в имени файла метрик процесса есть имя хоста
+# ('_' — разделитель частей имени файла)
+PROCESS_HOST = socket.gethostname().replace('_', '-')
+
+def get_process_identifier(pid=None):
+  return f'{PROCESS_HOST}-{pid or os.getpid()}'
+
+if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+  values.ValueClass = values.MultiProcessValue(get_process_identifier)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CALCULATION_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+DB_QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+house_calculation_seconds = Histogram(
+  'billing_house_calculation_seconds', 'Длительность расчета квитанций дома',
+  ['engine', 'status'], buckets=CALCULATION_BUCKETS
+)
+apartments_calculated = Counter(
+  'billing_apartments_calculated', 'Кол-во рассчитанных квартир', ['engine']
+)
+house_apartments_per_second = Gauge(
+  'billing_house_apartments_per_second', 'Скорость последнего расчета дома, квартир в секунду',
+  ['engine'], multiprocess_mode='mostrecent'
+)
+
+celery_queue_wait_seconds = Histogram(
+  'celery_task_queue_wait_seconds', 'Время задачи в очереди: от отправки до начала выполнения',
+  ['task', 'queue'], buckets=LATENCY_BUCKETS + (60, 300, 900)
+)
+celery_task_seconds = Histogram(
+  'celery_task_seconds', 'Длительность выполнения задачи', ['task'], buckets=CALCULATION_BUCKETS
+)
+celery_tasks = Counter(
+  'celery_tasks', 'Завершенные задачи по итогу выполнения', ['task', 'state']
+)
+
+http_request_seconds = Histogram(
+  'http_request_seconds', 'Длительность HTTP-запроса', ['method', 'route', 'status'], buckets=LATENCY_BUCKETS
+)
+http_request_db_queries = Histogram(
+  'http_request_db_queries', 'Кол-во SQL-запросов за HTTP-запрос', ['method', 'route'],
+  buckets=QUERY_COUNT_BUCKETS
+)
+db_query_seconds = Histogram(
+  'db_query_seconds', 'Длительность SQL-запроса', ['alias'], buckets=DB_QUERY_BUCKETS
+)
+
+# Заголовок сообщения Celery со временем отправки задачи
+PUBLISHED_AT_HEADER = 'published_at'
+
+def observe_house_calculation(engine, status, apartments, duration):
+  house_calculation_seconds.labels(engine, status).observe(duration)
+  if apartments:
+    apartments_calculated.labels(engine).inc(apartments)
+    if duration:
+      house_apartments_per_second.labels(engine).set(apartments / duration)
+
+def observe_http_request(method, route, status, duration, db_queries):
+  http_request_seconds.labels(method, route, status).observe(duration)
+  if db_queries is not None:
+    http_request_db_queries.labels(method, route).observe(db_queries)
+
+def render_metrics():
+  """
+  Метрики в текстовом формате Prometheus: всех процессов в режиме multiprocess, иначе текущего
+  """
+  if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+  else:
+    registry = REGISTRY
+  return generate_latest(registry)
+
+class DBQueryTimer:
+  """
+  Обертка выполнения SQL для всех соединений процесса (web и воркеры Celery)
+  """
+  def __init__(self, alias):
+    self.histogram = db_query_seconds.labels(alias)
+
+  def __call__(self, execute, sql, params, many, context):
+    started_at = time.perf_counter()
+    try:
+      return execute(sql, params, many, context)
+    finally:
+      self.histogram.observe(time.perf_counter() - started_at)
+
+def instrument_connection(sender, connection, **kwargs):
+  if not any(isinstance(wrapper, DBQueryTimer) for wrapper in connection.execute_wrappers):
+    connection.execute_wrappers.append(DBQueryTimer(connection.alias))
+
+def add_published_at(headers=None, **kwargs):
+  if headers is not None:
+    headers.setdefault(PUBLISHED_AT_HEADER, time.time())
+
+def get_published_at(request):
+  published_at = getattr(request, PUBLISHED_AT_HEADER, None)
+  if published_at is None:
+    published_at = (getattr(request, 'headers', None) or {}).get(PUBLISHED_AT_HEADER)
+  return published_at
+
+def task_started(task=None, **kwargs):
+  task.request.metrics_started_at = time.perf_counter()
+  published_at = get_published_at(task.request)
+  # Повтор задачи (retry) отправляется заново, ожидание считается от новой отправки
+  if published_at is not None:
+    queue = (task.request.delivery_info or {}).get('routing_key') or 'local'
+    celery_queue_wait_seconds.labels(task.name, queue).observe(max(time.time() - float(published_at), 0))
+
+def task_finished(task=None, state=None, **kwargs):
+  started_at = getattr(task.request, 'metrics_started_at', None)
+  if started_at is not None:
+    celery_task_seconds.labels(task.name).observe(time.perf_counter() - started_at)
+  celery_tasks.labels(task.name, state or 'UNKNOWN').inc()
+
+def worker_process_shutdown(pid=None, **kwargs):
+  if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+    multiprocess.mark_process_dead(get_process_identifier(pid))
+
+connection_created.connect(instrument_connection, dispatch_uid='metrics_instrument_connection')
+celery_signals.before_task_publish.connect(add_published_at, weak=False)
+celery_signals.task_prerun.connect(task_started, weak=False)
+celery_signals.task_postrun.connect(task_finished, weak=False)
+celery_signals.worker_process_shutdown.connect(worker_process_shutdown, weak=False)
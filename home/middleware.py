@@ -0,0 +1,112 @@
+import logging
+import time
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from .metrics import observe_http_request
+
+logger = logging.getLogger(__name__)
+
+# Счетчик запросов текущего HTTP-запроса; контекст передается и в потоки async ORM (sync_to_async)
+current_query_counter = ContextVar('current_query_counter', default=None)
+
+class QueryCounter:
+  """
+  Считает запросы и время в БД
+  """
+  def __init__(self):
+    self.count = 0
+    self.duration = 0.0
+
+  def __call__(self, execute, sql, params, many, context):
+    started_at = time.perf_counter()
+    try:
+      return execute(sql, params, many, context)
+    finally:
+      self.duration += time.perf_counter() - started_at
+      self.count += 1
+
+def count_queries(execute, sql, params, many, context):
+  """
+  Обертка выполнения SQL для всех соединений: передает запрос счетчику текущего HTTP-запроса, если он есть
+  """
+  counter = current_query_counter.get()
+  if counter is None:
+    return execute(sql, params, many, context)
+  return counter(execute, sql, params, many, context)
+
+def instrument_connection(sender, connection, **kwargs):
+  if count_queries not in connection.execute_wrappers:
+    connection.execute_wrappers.append(count_queries)
+
+connection_created.connect(instrument_connection, dispatch_uid='query_count_instrument_connection')
+
+class SyncAndAsyncMiddleware:
+  """
+  Middleware для WSGI и ASGI: при асинхронной цепочке вызывается без перехода в поток
+  """
+  sync_capable = True
+  async_capable = True
+
+  def __init__(self, get_response):
+    self.get_response = get_response
+    self.is_async = iscoroutinefunction(get_response)
+    if self.is_async:
+      markcoroutinefunction(self)
+
+  def __call__(self, request):
+    if self.is_async:
+      return self.__acall__(request)
+    state = self.process_request(request)
+    return self.process_response(request, self.get_response(request), state)
+
+  async def __acall__(self, request):
+    state = self.process_request(request)
+    return self.process_response(request, await self.get_response(request), state)
+
+class QueryCountMiddleware(SyncAndAsyncMiddleware):
+  """
+  Кол-во SQL-запросов и время в БД за запрос: заголовки X-DB-Query-Count и X-DB-Time-Ms,
+  при превышении QUERY_COUNT_WARNING запрос пишется в лог с уровнем WARNING.
+  Запросы потоковых ответов, выполняемые после возврата ответа, не учитываются.
+  """
+  def __init__(self, get_response):
+    super().__init__(get_response)
+    # Соединения, открытые до загрузки middleware
+    for connection in connections.all(initialized_only=True):
+      instrument_connection(None, connection)
+
+  def process_request(self, request):
+    counter = QueryCounter()
+    return counter, current_query_counter.set(counter)
+
+  def process_response(self, request, response, state):
+    counter, token = state
+    current_query_counter.reset(token)
+
+    request.db_query_count = counter.count
+    duration_ms = counter.duration * 1000
+    response['X-DB-Query-Count'] = str(counter.count)
+    response['X-DB-Time-Ms'] = f'{duration_ms:.1f}'
+
+    level = logging.WARNING if counter.count > settings.QUERY_COUNT_WARNING else logging.DEBUG
+    logger.log(level, "%s %s: %s SQL-запросов, %.1f мс в БД",
+               request.method, request.path, counter.count, duration_ms)
+    return response
+
+class MetricsMiddleware(SyncAndAsyncMiddleware):
+  """
+  Длительность HTTP-запросов и кол-во SQL-запросов по маршрутам (шаблон URL, без id) для /metrics.
+  Располагается перед QueryCountMiddleware, чтобы учитывать его счетчик.
+  """
+  def process_request(self, request):
+    return time.perf_counter()
+
+  def process_response(self, request, response, started_at):
+    resolver_match = getattr(request, 'resolver_match', None)
+    route = resolver_match.route if resolver_match else 'unmatched'
+    observe_http_request(request.method, route, response.status_code, time.perf_counter() - started_at,
+                         getattr(request, 'db_query_count', None))
+    return response
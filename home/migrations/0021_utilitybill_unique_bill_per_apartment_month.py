@@ -0,0 +1,28 @@
+# Generated by Django 5.1 on 2026-10-18 08:34
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def remove_duplicate_bills(apps, schema_editor):
+    UtilityBill = apps.get_model('home', 'UtilityBill')
+    # Оставляем последнюю квитанцию для каждой пары (квартира, месяц)
+    latest = (UtilityBill.objects.values('apartment_id', 'month')
+              .annotate(last_id=Max('id'))
+              .values_list('last_id', flat=True))
+    UtilityBill.objects.exclude(id__in=list(latest)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0020_alter_tariff_meter_type_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_bills, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='utilitybill',
+            constraint=models.UniqueConstraint(fields=('apartment', 'month'), name='unique_bill_per_apartment_month'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.1 on 2026-10-18 08:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0021_utilitybill_unique_bill_per_apartment_month'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CalculationRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.IntegerField()),
+                ('month', models.IntegerField()),
+                ('house_ids', models.JSONField(blank=True, null=True, verbose_name='Фильтр домов')),
+                ('engine', models.CharField(default='decimal', max_length=20, verbose_name='Движок расчета')),
+                ('status', models.CharField(choices=[('в работе', 'In Progress'), ('готово', 'Completed'), ('ошибка', 'Error')], default='в работе', max_length=50)),
+                ('houses_total', models.IntegerField(default=0)),
+                ('houses_done', models.IntegerField(default=0)),
+                ('houses_failed', models.IntegerField(default=0)),
+                ('apartments_total', models.IntegerField(default=0)),
+                ('apartments_done', models.IntegerField(default=0)),
+                ('summary', models.JSONField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Расчет по городу',
+                'verbose_name_plural': 'Расчеты по городу',
+            },
+        ),
+        migrations.AddField(
+            model_name='calculationprogress',
+            name='run',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='houses', to='home.calculationrun'),
+        ),
+    ]
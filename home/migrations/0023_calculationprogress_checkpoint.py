@@ -0,0 +1,38 @@
+# Generated by Django 5.1 on 2026-10-18 08:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0022_calculationrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='calculationprogress',
+            name='last_apartment_id',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='Последняя рассчитанная квартира'),
+        ),
+        migrations.AddField(
+            model_name='calculationprogress',
+            name='processed_apartments',
+            field=models.IntegerField(default=0, verbose_name='Рассчитано квартир'),
+        ),
+        migrations.AddField(
+            model_name='calculationprogress',
+            name='task_id',
+            field=models.CharField(blank=True, db_index=True, max_length=255, null=True, verbose_name='ID задачи Celery'),
+        ),
+        migrations.AddField(
+            model_name='calculationprogress',
+            name='total_apartments',
+            field=models.IntegerField(default=0, verbose_name='Всего квартир'),
+        ),
+        migrations.AddField(
+            model_name='calculationprogress',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -0,0 +1,83 @@
+# Generated by Django 5.1 on 2026-10-18 08:40
+
+import logging
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+
+def copy_readings_to_table(apps, schema_editor):
+    Meter = apps.get_model('home', 'Meter')
+    MeterReading = apps.get_model('home', 'MeterReading')
+
+    batch = []
+    for meter_id, readings in Meter.objects.filter(readings__isnull=False).values_list('id', 'readings').iterator():
+        for period, value in (readings or {}).items():
+            # Некорректные записи старого JSON (месяц не YYYY-MM, нечисловое показание) пропускаются,
+            # чтобы не прерывать миграцию
+            try:
+                reading = MeterReading(
+                    meter_id=meter_id,
+                    period=datetime.strptime(period, '%Y-%m').date(),
+                    value=Decimal(str(value))
+                )
+                if not reading.value.is_finite() or abs(reading.value) >= 10 ** 9:
+                    raise InvalidOperation
+            except (TypeError, ValueError, InvalidOperation):
+                logger.warning('Счётчик %s: пропущено некорректное показание %r: %r', meter_id, period, value)
+                continue
+            batch.append(reading)
+
+        if len(batch) >= BATCH_SIZE:
+            MeterReading.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+
+    MeterReading.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+def copy_readings_to_json(apps, schema_editor):
+    Meter = apps.get_model('home', 'Meter')
+    MeterReading = apps.get_model('home', 'MeterReading')
+
+    readings = {}
+    for meter_id, period, value in MeterReading.objects.values_list('meter_id', 'period', 'value').iterator():
+        readings.setdefault(meter_id, {})[period.strftime('%Y-%m')] = float(value)
+
+    for meter_id, meter_readings in readings.items():
+        Meter.objects.filter(id=meter_id).update(readings=meter_readings)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0023_calculationprogress_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MeterReading',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.DateField(verbose_name='Месяц')),
+                ('value', models.DecimalField(decimal_places=3, max_digits=12, verbose_name='Показание')),
+                ('meter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='meter_readings', to='home.meter', verbose_name='Счётчик')),
+            ],
+            options={
+                'verbose_name': 'Показание счётчика',
+                'verbose_name_plural': 'Показания счётчиков',
+                'indexes': [models.Index(fields=['period', 'meter'], name='reading_period_meter_idx')],
+                'constraints': [models.UniqueConstraint(fields=('meter', 'period'), name='unique_reading_per_meter_period')],
+            },
+        ),
+        migrations.RunPython(copy_readings_to_table, copy_readings_to_json),
+        migrations.RemoveField(
+            model_name='meter',
+            name='readings',
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1 on 2026-10-18 08:43
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0024_meterreading'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StaleBill',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('reason', models.CharField(choices=[('reading', 'Reading'), ('area', 'Area'), ('tariff', 'Tariff')], max_length=20)),
+                ('marked_at', models.DateTimeField()),
+                ('apartment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stale_bills', to='home.apartment')),
+            ],
+            options={
+                'verbose_name': 'Устаревшая квитанция',
+                'verbose_name_plural': 'Устаревшие квитанции',
+                'constraints': [models.UniqueConstraint(fields=('apartment', 'month'), name='unique_stale_bill_per_apartment_month')],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1 on 2026-10-18 08:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0025_stalebill'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='utilitybill',
+            index=models.Index(fields=['month', 'id'], name='bill_month_id_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1 on 2026-10-18 08:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0026_utilitybill_month_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='calculationprogress',
+            name='profile',
+            field=models.JSONField(blank=True, null=True, verbose_name='Профиль расчета'),
+        ),
+    ]
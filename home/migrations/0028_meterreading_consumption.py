@@ -0,0 +1,84 @@
+# Generated by Django 5.1 on 2026-10-18 09:00
+
+from collections import deque
+from decimal import Decimal, ROUND_HALF_UP
+from itertools import groupby
+
+from dateutil.relativedelta import relativedelta
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+# Расчет расхода на момент миграции, без импорта home.services: дальнейшие изменения кода не меняют миграцию
+AVERAGE_MONTHS = 3
+CONSUMPTION_FIELDS = ['consumption', 'consumption_months', 'average_consumption']
+
+
+def compute_consumption(readings):
+    """
+    Показания одного счётчика по возрастанию месяца: расход с предыдущего показания, за сколько месяцев
+    он накоплен и средний помесячный расход за AVERAGE_MONTHS месяцев по месяц показания включительно
+    """
+    previous = None
+    # Интервалы между показаниями, попадающие в окно среднего: (месяц окончания, расход, месяцев)
+    intervals = deque()
+
+    for reading in readings:
+        if previous is not None:
+            reading.consumption = reading.value - previous.value
+            reading.consumption_months = ((reading.period.year - previous.period.year) * 12
+                                          + reading.period.month - previous.period.month)
+            intervals.append((reading.period, reading.consumption, reading.consumption_months))
+        previous = reading
+
+        window_start = reading.period - relativedelta(months=AVERAGE_MONTHS)
+        while intervals and intervals[0][0] <= window_start:
+            intervals.popleft()
+
+        total_months = sum(months for _, _, months in intervals)
+        if total_months:
+            reading.average_consumption = (sum(consumption for _, consumption, _ in intervals) / total_months
+                                           ).quantize(Decimal('0.001'), rounding=ROUND_HALF_UP)
+
+    return readings
+
+
+def fill_consumption(apps, schema_editor):
+    MeterReading = apps.get_model('home', 'MeterReading')
+
+    meter_ids = list(MeterReading.objects.order_by('meter_id').values_list('meter_id', flat=True).distinct())
+    for offset in range(0, len(meter_ids), BATCH_SIZE):
+        readings = (MeterReading.objects
+                    .filter(meter_id__in=meter_ids[offset:offset + BATCH_SIZE])
+                    .order_by('meter_id', 'period'))
+
+        changed = []
+        for _, meter_readings in groupby(readings, key=lambda reading: reading.meter_id):
+            changed.extend(compute_consumption(list(meter_readings)))
+        MeterReading.objects.bulk_update(changed, CONSUMPTION_FIELDS, batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0027_calculationprogress_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='meterreading',
+            name='average_consumption',
+            field=models.DecimalField(blank=True, decimal_places=3, max_digits=12, null=True, verbose_name='Средний расход в месяц'),
+        ),
+        migrations.AddField(
+            model_name='meterreading',
+            name='consumption',
+            field=models.DecimalField(blank=True, decimal_places=3, max_digits=12, null=True, verbose_name='Расход с предыдущего показания'),
+        ),
+        migrations.AddField(
+            model_name='meterreading',
+            name='consumption_months',
+            field=models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='Месяцев в расходе'),
+        ),
+        migrations.RunPython(fill_consumption, migrations.RunPython.noop),
+    ]
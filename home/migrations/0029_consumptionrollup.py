@@ -0,0 +1,37 @@
+# Generated by Django 5.1 on 2026-10-18 09:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0028_meterreading_consumption'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConsumptionRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('tariff_id', models.IntegerField(verbose_name='Тариф')),
+                ('meter_type_id', models.IntegerField(blank=True, null=True, verbose_name='Тип счётчика')),
+                ('name', models.CharField(max_length=100, verbose_name='Название')),
+                ('unit', models.CharField(blank=True, max_length=50, verbose_name='Единица измерения')),
+                ('apartments', models.IntegerField(default=0, verbose_name='Квартир с начислением')),
+                ('consumption', models.DecimalField(decimal_places=3, default=0, max_digits=16, verbose_name='Расход')),
+                ('cost', models.DecimalField(decimal_places=2, default=0, max_digits=16, verbose_name='Начислено')),
+                ('estimated', models.IntegerField(default=0, verbose_name='Начислений по среднему расходу')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('house', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='consumption_rollups', to='home.house')),
+            ],
+            options={
+                'verbose_name': 'Итоги начислений дома за месяц',
+                'verbose_name_plural': 'Итоги начислений домов по месяцам',
+                'indexes': [models.Index(fields=['month', 'tariff_id'], name='rollup_month_tariff_idx')],
+                'constraints': [models.UniqueConstraint(fields=('house', 'month', 'tariff_id'), name='unique_rollup_per_house_month_tariff')],
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.1 on 2026-10-18 09:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0029_consumptionrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='calculationrun',
+            name='apartments_per_second_limit',
+            field=models.FloatField(blank=True, null=True, verbose_name='Ограничение скорости, квартир в секунду'),
+        ),
+        migrations.AddField(
+            model_name='calculationrun',
+            name='attempts',
+            field=models.IntegerField(default=1, verbose_name='Проходов расчета'),
+        ),
+        migrations.AddField(
+            model_name='calculationrun',
+            name='max_attempts',
+            field=models.IntegerField(default=1, verbose_name='Макс. проходов (повтор домов с ошибкой)'),
+        ),
+        migrations.AddField(
+            model_name='calculationrun',
+            name='trigger',
+            field=models.CharField(choices=[('manual', 'Вручную'), ('schedule', 'Закрытие месяца по расписанию')], default='manual', max_length=20, verbose_name='Запуск'),
+        ),
+        migrations.AddConstraint(
+            model_name='calculationrun',
+            constraint=models.UniqueConstraint(condition=models.Q(('trigger', 'schedule')), fields=('year', 'month'), name='unique_scheduled_run_per_month'),
+        ),
+    ]
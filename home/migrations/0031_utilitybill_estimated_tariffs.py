@@ -0,0 +1,44 @@
+# Generated by Django 5.1 on 2026-10-18 09:26
+
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def move_estimated_flags(apps, schema_editor):
+    """
+    Пометка "estimated" из строк начислений переносится в estimated_tariffs: строки charge
+    возвращаются к прежнему виду
+    """
+    UtilityBill = apps.get_model('home', 'UtilityBill')
+
+    changed = []
+    for bill in UtilityBill.objects.only('id', 'charge').iterator(chunk_size=BATCH_SIZE):
+        estimated = [line['id'] for line in bill.charge or [] if line.get('estimated')]
+        if not estimated:
+            continue
+        for line in bill.charge:
+            line.pop('estimated', None)
+        bill.estimated_tariffs = estimated
+        changed.append(bill)
+
+        if len(changed) >= BATCH_SIZE:
+            UtilityBill.objects.bulk_update(changed, ['charge', 'estimated_tariffs'])
+            changed = []
+    UtilityBill.objects.bulk_update(changed, ['charge', 'estimated_tariffs'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0030_calculationrun_month_close'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='utilitybill',
+            name='estimated_tariffs',
+            field=models.JSONField(blank=True, default=list, verbose_name='Тарифы, начисленные по среднему расходу'),
+        ),
+        migrations.RunPython(move_estimated_flags, migrations.RunPython.noop),
+    ]
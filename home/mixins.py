@@ -0,0 +1,66 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Prefetch
+from drf_yasg import openapi
+from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from .services.readings import get_readings_window, ReadingError, READINGS_ALL, READINGS_NONE
+from .services.response_cache import get_house_versions, make_etag, etag_matches, response_key
+
+class VersionedCacheMixin:
+  """
+  GET с кэшем по версии дома: при совпадении If-None-Match — 304, иначе данные ответа из кэша;
+  запросы к БД и сериализация выполняются только после изменения данных дома
+  """
+  def get_cache_house_id(self):
+    """
+    ID дома, по версии которого кэшируется ответ; None — ответ не кэшируется
+    """
+    return None
+
+  def versioned_get(self, request, get_response):
+    house_id = self.get_cache_house_id()
+    if house_id is None:
+      return get_response()
+
+    etag = make_etag(request.get_full_path(), get_house_versions(house_id))
+    headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+      return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    data = cache.get(response_key(etag))
+    if data is None:
+      response = get_response()
+      if response.status_code != status.HTTP_200_OK:
+        return response
+      cache.set(response_key(etag), response.data, settings.RESPONSE_CACHE_TIMEOUT)
+    else:
+      response = Response(data)
+
+    for header, value in headers.items():
+      response[header] = value
+    return response
+
+READINGS_WINDOW_PARAMETERS = [
+  openapi.Parameter('readings', openapi.IN_QUERY, type=openapi.TYPE_STRING, enum=[READINGS_ALL, READINGS_NONE],
+                    description='none — счётчики без показаний'),
+  openapi.Parameter('readings_since', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                    description='Показания начиная с месяца (YYYY-MM)'),
+  openapi.Parameter('readings_last', openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                    description='Только N последних показаний каждого счётчика')
+]
+
+class ReadingsWindowMixin:
+  """
+  Окно показаний счётчиков по параметрам readings, readings_since, readings_last:
+  ограничение применяется в запросе prefetch, лишняя история не загружается из БД
+  """
+  def get_readings_prefetch(self, lookup):
+    params = self.request.query_params
+    try:
+      readings = get_readings_window(params.get('readings'), params.get('readings_since'), params.get('readings_last'))
+    except ReadingError as e:
+      raise ValidationError({'error': str(e)})
+    return Prefetch(lookup, queryset=readings)
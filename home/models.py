@@ -39,7 +39,6 @@ class Meter(models.Model):
   meter_number = models.CharField(max_length=50, verbose_name='Номер счётчика')
   meter_type = models.ForeignKey(MeterType, related_name='meters', on_delete=models.PROTECT,
                                  verbose_name='Тип счётчика', default=1)
-  readings = models.JSONField(null=True, blank=True, verbose_name='Показания')
 
   class Meta:
     verbose_name = 'Счётчик'
@@ -48,18 +47,105 @@ class Meter(models.Model):
   def __str__(self):
     return f"Meter {self.id} in {self.apartment}"
 
+  @property
+  def readings(self):
+    """
+    Показания в прежнем виде {"YYYY-MM": значение}. Использует prefetch meter_readings, если он есть.
+    """
+    readings = sorted(self.meter_readings.all(), key=lambda reading: reading.period)
+    return {reading.period.strftime('%Y-%m'): reading.value for reading in readings}
+
+class MeterReading(models.Model):
+  meter = models.ForeignKey(Meter, related_name='meter_readings', on_delete=models.CASCADE, verbose_name='Счётчик')
+  period = models.DateField(verbose_name='Месяц')
+  value = models.DecimalField(max_digits=12, decimal_places=3, verbose_name='Показание')
+  consumption = models.DecimalField(max_digits=12, decimal_places=3, null=True, blank=True,
+                                    verbose_name='Расход с предыдущего показания')
+  consumption_months = models.PositiveSmallIntegerField(null=True, blank=True, verbose_name='Месяцев в расходе')
+  average_consumption = models.DecimalField(max_digits=12, decimal_places=3, null=True, blank=True,
+                                            verbose_name='Средний расход в месяц')
+
+  class Meta:
+    verbose_name = 'Показание счётчика'
+    verbose_name_plural = 'Показания счётчиков'
+    constraints = [
+      models.UniqueConstraint(fields=['meter', 'period'], name='unique_reading_per_meter_period')
+    ]
+    indexes = [
+      models.Index(fields=['period', 'meter'], name='reading_period_meter_idx')
+    ]
+
+  def __str__(self):
+    return f"Reading {self.value} for {self.period:%Y-%m} of meter {self.meter_id}"
+
 class UtilityBill(models.Model):
   apartment = models.ForeignKey(Apartment, related_name='bills', on_delete=models.CASCADE)
   month = models.DateField()
   charge = models.JSONField()
+  # Начисления по среднему расходу (нет показания за месяц) хранятся отдельно от строк charge
+  estimated_tariffs = models.JSONField(default=list, blank=True, verbose_name='Тарифы, начисленные по среднему расходу')
 
   class Meta:
     verbose_name = 'Квитанция'
     verbose_name_plural = 'Квитанции'
+    constraints = [
+      models.UniqueConstraint(fields=['apartment', 'month'], name='unique_bill_per_apartment_month')
+    ]
+    indexes = [
+      # Выборка квитанций за месяц (диапазон месяцев) постранично по id
+      models.Index(fields=['month', 'id'], name='bill_month_id_idx')
+    ]
 
   def __str__(self):
     return f"Bill for {self.apartment} for {self.month}"
 
+class StaleBill(models.Model):
+  apartment = models.ForeignKey(Apartment, related_name='stale_bills', on_delete=models.CASCADE)
+  month = models.DateField()
+  reason = models.CharField(max_length=20, choices=[('reading', 'Reading'), ('area', 'Area'), ('tariff', 'Tariff')])
+  marked_at = models.DateTimeField()
+
+  class Meta:
+    verbose_name = 'Устаревшая квитанция'
+    verbose_name_plural = 'Устаревшие квитанции'
+    constraints = [
+      models.UniqueConstraint(fields=['apartment', 'month'], name='unique_stale_bill_per_apartment_month')
+    ]
+
+  def __str__(self):
+    return f"Stale bill for {self.apartment_id} for {self.month} ({self.reason})"
+
+class ConsumptionRollup(models.Model):
+  """
+  Итоги начислений дома за месяц по тарифу, пересчитываются из квитанций после расчета дома
+  """
+  house = models.ForeignKey(House, related_name='consumption_rollups', on_delete=models.CASCADE)
+  month = models.DateField()
+  # id тарифа и типа счётчика без внешних ключей: итоги закрытых месяцев остаются после удаления тарифа
+  tariff_id = models.IntegerField(verbose_name='Тариф')
+  meter_type_id = models.IntegerField(null=True, blank=True, verbose_name='Тип счётчика')
+  name = models.CharField(max_length=100, verbose_name='Название')
+  unit = models.CharField(max_length=50, blank=True, verbose_name='Единица измерения')
+  apartments = models.IntegerField(default=0, verbose_name='Квартир с начислением')
+  consumption = models.DecimalField(max_digits=16, decimal_places=3, default=0, verbose_name='Расход')
+  cost = models.DecimalField(max_digits=16, decimal_places=2, default=0, verbose_name='Начислено')
+  estimated = models.IntegerField(default=0, verbose_name='Начислений по среднему расходу')
+  updated_at = models.DateTimeField(auto_now=True)
+
+  class Meta:
+    verbose_name = 'Итоги начислений дома за месяц'
+    verbose_name_plural = 'Итоги начислений домов по месяцам'
+    constraints = [
+      models.UniqueConstraint(fields=['house', 'month', 'tariff_id'], name='unique_rollup_per_house_month_tariff')
+    ]
+    indexes = [
+      # Итоги по городу за диапазон месяцев
+      models.Index(fields=['month', 'tariff_id'], name='rollup_month_tariff_idx')
+    ]
+
+  def __str__(self):
+    return f"Rollup {self.name} for house {self.house_id} for {self.month:%Y-%m}"
+
 class Tariff(models.Model):
   meter_type = models.ForeignKey(MeterType, null=True, blank=True, on_delete=models.SET_NULL, related_name='tariffs',
                                  verbose_name='Тип счётчика')
@@ -77,15 +163,55 @@ class Tariff(models.Model):
   def __str__(self):
     return f"{self.custom_name or self.meter_type.name}: {self.price_per_unit} per unit" if self.custom_name or self.meter_type else 'No Name'
 
+CALCULATION_STATUSES = [('в работе', 'In Progress'), ('готово', 'Completed'), ('ошибка', 'Error')]
+RUN_TRIGGERS = [('manual', 'Вручную'), ('schedule', 'Закрытие месяца по расписанию')]
+
+class CalculationRun(models.Model):
+  year = models.IntegerField()
+  month = models.IntegerField()
+  house_ids = models.JSONField(null=True, blank=True, verbose_name='Фильтр домов')
+  engine = models.CharField(max_length=20, default='decimal', verbose_name='Движок расчета')
+  status = models.CharField(max_length=50, choices=CALCULATION_STATUSES, default='в работе')
+  trigger = models.CharField(max_length=20, choices=RUN_TRIGGERS, default='manual', verbose_name='Запуск')
+  apartments_per_second_limit = models.FloatField(null=True, blank=True,
+                                                  verbose_name='Ограничение скорости, квартир в секунду')
+  attempts = models.IntegerField(default=1, verbose_name='Проходов расчета')
+  max_attempts = models.IntegerField(default=1, verbose_name='Макс. проходов (повтор домов с ошибкой)')
+  houses_total = models.IntegerField(default=0)
+  houses_done = models.IntegerField(default=0)
+  houses_failed = models.IntegerField(default=0)
+  apartments_total = models.IntegerField(default=0)
+  apartments_done = models.IntegerField(default=0)
+  summary = models.JSONField(null=True, blank=True)
+  created_at = models.DateTimeField(auto_now_add=True)
+  finished_at = models.DateTimeField(null=True, blank=True)
+
+  class Meta:
+    verbose_name = 'Расчет по городу'
+    verbose_name_plural = 'Расчеты по городу'
+    constraints = [
+      # Одно закрытие месяца по расписанию на месяц: повторный запуск расписания не создает второй расчет
+      models.UniqueConstraint(fields=['year', 'month'], condition=models.Q(trigger='schedule'),
+                              name='unique_scheduled_run_per_month'),
+    ]
+
+  def __str__(self):
+    return f"City calculation {self.id} ({self.year}-{self.month}): {self.status}"
+
 class CalculationProgress(models.Model):
+  run = models.ForeignKey(CalculationRun, null=True, blank=True, related_name='houses', on_delete=models.CASCADE)
   house_id = models.IntegerField()
   year = models.IntegerField()
   month = models.IntegerField()
-  status = models.CharField(max_length=50,
-                            choices=[('в работе', 'In Progress'), ('готово', 'Completed'), ('ошибка', 'Error')],
-                            default='в работе')
+  status = models.CharField(max_length=50, choices=CALCULATION_STATUSES, default='в работе')
   error_message = models.TextField(blank=True, null=True)
+  task_id = models.CharField(max_length=255, null=True, blank=True, db_index=True, verbose_name='ID задачи Celery')
+  total_apartments = models.IntegerField(default=0, verbose_name='Всего квартир')
+  processed_apartments = models.IntegerField(default=0, verbose_name='Рассчитано квартир')
+  last_apartment_id = models.BigIntegerField(null=True, blank=True, verbose_name='Последняя рассчитанная квартира')
+  profile = models.JSONField(null=True, blank=True, verbose_name='Профиль расчета')
   created_at = models.DateTimeField(auto_now_add=True)
+  updated_at = models.DateTimeField(auto_now=True)
 
   def __str__(self):
-    return f"Calculation for house {self.house_id} ({self.year}-{self.month}): {self.status}"
\ No newline at end of file
+    return f"Calculation for house {self.house_id} ({self.year}-{self.month}): {self.status}"
@@ -0,0 +1,11 @@
+from rest_framework.pagination import CursorPagination
+
+class BillCursorPagination(CursorPagination):
+  """
+  Постраничная выдача по ключу (id > последнего id страницы) вместо OFFSET:
+  время ответа не растет с номером страницы
+  """
+  page_size = 100
+  page_size_query_param = 'page_size'
+  max_page_size = 1000
+  ordering = 'id'
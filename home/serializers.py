@@ -1,22 +1,87 @@
 from rest_framework import serializers
-from .models import House, Apartment, Meter, MeterType, Tariff
+from .models import (House, Apartment, Meter, MeterReading, MeterType, Tariff, CalculationRun, CalculationProgress,
+                     UtilityBill)
+from .services.readings import parse_period, check_new_reading, append_reading, ReadingError
+from .services.reference_cache import get_meter_type
+from .services.consumption import refresh_consumption
+from .services.stale_bills import mark_stale_for_readings
 from rest_framework.exceptions import ValidationError
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
+from django.db import transaction
+
+class ReadingsField(serializers.DictField):
+  """
+  Показания в виде {"YYYY-MM": значение}. Хранятся построчно в MeterReading.
+  """
+  child = serializers.DecimalField(max_digits=12, decimal_places=3, coerce_to_string=False)
+
+  def __init__(self, **kwargs):
+    kwargs.setdefault('required', False)
+    kwargs.setdefault('allow_null', True)
+    super().__init__(**kwargs)
+
+  def to_internal_value(self, data):
+    readings = super().to_internal_value(data)
+    for month in readings:
+      try:
+        parse_period(month)
+      except ValueError:
+        raise serializers.ValidationError(f"Месяц {month} должен быть в формате YYYY-MM.")
+    return readings
 
 class MeterTypeSerializer(serializers.ModelSerializer):
   class Meta:
     model = MeterType
     fields = ['id', 'name', 'unit']
 
+class CachedMeterTypeSerializer(MeterTypeSerializer):
+  """
+  Тип счётчика по meter_type_id из справочного кэша, без запроса к БД
+  """
+  def get_attribute(self, instance):
+    return get_meter_type(instance.meter_type_id)
+
+class MeterTypeField(serializers.PrimaryKeyRelatedField):
+  """
+  Тип счётчика по id: проверка и поиск по справочному кэшу, без запроса к БД
+  """
+  def __init__(self, **kwargs):
+    kwargs.setdefault('queryset', MeterType.objects.all())
+    super().__init__(**kwargs)
+
+  def to_internal_value(self, data):
+    if isinstance(data, bool):
+      self.fail('incorrect_type', data_type=type(data).__name__)
+    try:
+      meter_type = get_meter_type(int(data))
+    except (TypeError, ValueError):
+      self.fail('incorrect_type', data_type=type(data).__name__)
+    if meter_type is None:
+      self.fail('does_not_exist', pk_value=data)
+    return meter_type
+
 class MeterSerializer(serializers.ModelSerializer):
-  meter_type = MeterTypeSerializer(read_only=True)
+  meter_type = CachedMeterTypeSerializer(read_only=True)
   apartment = serializers.PrimaryKeyRelatedField(queryset=Apartment.objects.all())
+  readings = ReadingsField()
 
   class Meta:
     model = Meter
     fields = ['id', 'meter_number', 'meter_type', 'readings', 'apartment']
 
+  def create(self, validated_data):
+    readings = validated_data.pop('readings', None) or {}
+
+    with transaction.atomic():
+      meter = super().create(validated_data)
+      created = MeterReading.objects.bulk_create([
+        MeterReading(meter=meter, period=parse_period(month), value=value) for month, value in readings.items()
+      ])
+      # bulk_create не вызывает сигналы показаний: расход и устаревшие квитанции обновляются явно, как при импорте
+      refresh_consumption([(meter.id, reading.period) for reading in created])
+      mark_stale_for_readings([(meter.apartment_id, reading.period) for reading in created])
+
+    return meter
+
   def to_representation(self, instance):
     representation = super().to_representation(instance)
     request = self.context.get('request')
@@ -29,73 +94,57 @@ class MeterSerializer(serializers.ModelSerializer):
       if len(value) != 1:
         raise serializers.ValidationError("Можно передать показания только за один месяц.")
 
-      current_month = datetime.now().strftime('%Y-%m')
-      previous_month = (datetime.now() - relativedelta(months=1)).strftime('%Y-%m')
-
       for month, reading in value.items():
-        # Проверка на отрицательное значение
-        if float(reading) < 0:
-          raise serializers.ValidationError(f"Показания за {month} не могут быть отрицательными.")
-
-        # Проверка на месяц (текущий / предыдущий)
-        if month != current_month and month != previous_month:
-          raise serializers.ValidationError(
-            f"Показания могут быть только за текущий ({current_month}) или предыдущий месяц ({previous_month})."
-          )
+        # Новый счетчик: значение неотрицательное, месяц текущий / предыдущий
+        try:
+          check_new_reading(month, reading)
+        except ReadingError as e:
+          raise serializers.ValidationError(str(e))
 
     return value
 
 class MeterByHouseSerializer(serializers.ModelSerializer):
-  meter_type = serializers.PrimaryKeyRelatedField(queryset=MeterType.objects.all())
+  meter_type = MeterTypeField()
   apartment_id = serializers.SerializerMethodField()
+  readings = ReadingsField()
 
   class Meta:
     model = Meter
     fields = ['id', 'apartment_id', 'meter_number', 'meter_type', 'readings']
 
   def get_apartment_id(self, obj):
-    return obj.apartment.id
+    return obj.apartment_id
 
   def update(self, instance, validated_data):
     meter_type = validated_data.pop('meter_type', None)
     new_readings = validated_data.get('readings')
 
-    if new_readings is not None:
-      if len(new_readings) != 1:
-        raise ValidationError("Передаваться могут показания только за один месяц за раз.")
-
-      new_month, new_value = list(new_readings.items())[0]
-
-      if float(new_value) < 0:
-        raise ValidationError("Показания не могут быть отрицательными.")
-
-      current_month = datetime.now().strftime('%Y-%m')
-      previous_month = (datetime.now() - relativedelta(months=1)).strftime('%Y-%m')
+    with transaction.atomic():
+      if new_readings is not None:
+        if len(new_readings) != 1:
+          raise ValidationError("Передаваться могут показания только за один месяц за раз.")
 
-      # Показаний нет, месяц текущий или предыдущий
-      if not instance.readings:
-        if new_month != current_month and new_month != previous_month:
-          raise ValidationError(
-            f"Показания могут быть только за текущий ({current_month}) или предыдущий месяц ({previous_month}).")
-      else:
-        # Показания есть, новый месяц не меньше самого раннего
-        earliest_month = min(instance.readings.keys())
-        if new_month < earliest_month:
-          raise ValidationError(
-            f"Новый месяц ({new_month}) не может быть меньше самого раннего ({earliest_month}) в существующих показаниях.")
+        new_month, new_value = list(new_readings.items())[0]
 
-      # Наличие показаний за указанный месяц
-      if new_month in instance.readings:
-        raise ValidationError(f"Показания за {new_month} уже существуют.")
+        try:
+          append_reading(instance.id, new_month, new_value)
+        except ReadingError as e:
+          raise ValidationError(str(e))
 
-      instance.readings[new_month] = new_value
+      # Записываем только изменившиеся поля счётчика
+      update_fields = []
+      meter_number = validated_data.get('meter_number', instance.meter_number)
+      if meter_number != instance.meter_number:
+        instance.meter_number = meter_number
+        update_fields.append('meter_number')
 
-    instance.meter_number = validated_data.get('meter_number', instance.meter_number)
+      if meter_type and meter_type.id != instance.meter_type_id:
+        instance.meter_type = meter_type
+        update_fields.append('meter_type')
 
-    if meter_type:
-      instance.meter_type = meter_type
+      if update_fields:
+        instance.save(update_fields=update_fields)
 
-    instance.save()
     return instance
 
 class ApartmentSerializer(serializers.ModelSerializer):
@@ -123,7 +172,7 @@ class ApartmentWithHouseSerializer(serializers.ModelSerializer):
     fields = ['id', 'number', 'area', 'house_id', 'meters']
 
   def get_house_id(self, obj):
-    return obj.house.id
+    return obj.house_id
 
 class HouseListSerializer(serializers.ModelSerializer):
   class Meta:
@@ -138,8 +187,39 @@ class HouseSerializer(serializers.ModelSerializer):
     fields = ['id', 'address', 'apartments']
 
 class TariffSerializer(serializers.ModelSerializer):
-  meter_type = MeterTypeSerializer(read_only=True)
+  meter_type = CachedMeterTypeSerializer(read_only=True)
 
   class Meta:
     model = Tariff
     fields = ['id', 'meter_type', 'custom_name', 'unit', 'price_per_unit']
+
+class UtilityBillSerializer(serializers.ModelSerializer):
+  apartment_id = serializers.IntegerField(read_only=True)
+  apartment_number = serializers.IntegerField(source='apartment.number', read_only=True)
+  house_id = serializers.IntegerField(source='apartment.house_id', read_only=True)
+  address = serializers.CharField(source='apartment.house.address', read_only=True)
+
+  class Meta:
+    model = UtilityBill
+    fields = ['id', 'apartment_id', 'apartment_number', 'house_id', 'address', 'month', 'charge', 'estimated_tariffs']
+
+class CalculationProfileSerializer(serializers.ModelSerializer):
+  class Meta:
+    model = CalculationProgress
+    fields = ['id', 'task_id', 'house_id', 'year', 'month', 'status', 'processed_apartments', 'profile', 'updated_at']
+
+class CalculationRunSerializer(serializers.ModelSerializer):
+  failures = serializers.SerializerMethodField()
+
+  class Meta:
+    model = CalculationRun
+    fields = ['id', 'year', 'month', 'house_ids', 'engine', 'status', 'trigger', 'apartments_per_second_limit',
+              'attempts', 'max_attempts', 'houses_total', 'houses_done', 'houses_failed', 'apartments_total',
+              'apartments_done', 'failures', 'summary', 'created_at', 'finished_at']
+
+  def get_failures(self, obj):
+    # Дома, рассчитанные при повторном проходе, не считаются ошибкой
+    return list(obj.houses
+                .filter(status='ошибка')
+                .exclude(house_id__in=obj.houses.filter(status='готово').values('house_id'))
+                .values('house_id', 'error_message'))
@@ -0,0 +1,140 @@
+"""
+Итоги начислений по домам, месяцам и тарифам (ConsumptionRollup).
+
+Итоги дома за месяц пересчитываются из квитанций один раз после расчета дома, поэтому аналитика
+читает только таблицу итогов и не разбирает JSON начислений при каждом запросе.
+"""
+from decimal import Decimal
+from dateutil.relativedelta import relativedelta
+from django.db import transaction
+from django.db.models import Max, Sum
+from home.models import ConsumptionRollup, UtilityBill
+from home.services.bills import parse_id, parse_month, BillFilterError
+from home.services.readings import format_period
+from home.services.reference_cache import get_tariffs
+
+# Кол-во квитанций, читаемых из БД за раз при пересчете итогов
+ROLLUP_CHUNK_SIZE = 2000
+
+ROLLUP_FIELDS = ['meter_type_id', 'name', 'unit', 'apartments', 'consumption', 'cost', 'estimated']
+
+def refresh_house_rollups(house_id, month):
+    """
+    Пересчет итогов дома за месяц (month — первое число месяца) по всем его квитанциям
+    """
+    meter_type_ids = {tariff.id: tariff.meter_type_id for tariff in get_tariffs()}
+    rollups = {}
+
+    bills = (UtilityBill.objects
+             .filter(apartment__house_id=house_id, month=month)
+             .values_list('charge', 'estimated_tariffs')
+             .iterator(chunk_size=ROLLUP_CHUNK_SIZE))
+    for charge, estimated_tariffs in bills:
+        for line in charge or []:
+            rollup = rollups.get(line['id'])
+            if rollup is None:
+                rollup = rollups[line['id']] = ConsumptionRollup(
+                    house_id=house_id, month=month, tariff_id=line['id'], meter_type_id=meter_type_ids.get(line['id']),
+                    name=line['name'], unit=line.get('unit') or '', consumption=Decimal(0), cost=Decimal(0)
+                )
+            rollup.apartments += 1
+            # Значения в JSON — float с двумя знаками, через str суммируются без погрешности
+            rollup.consumption += Decimal(str(line['consumption']))
+            rollup.cost += Decimal(str(line['cost']))
+            rollup.estimated += line['id'] in (estimated_tariffs or ())
+
+    with transaction.atomic():
+        (ConsumptionRollup.objects
+         .filter(house_id=house_id, month=month)
+         .exclude(tariff_id__in=list(rollups))
+         .delete())
+        ConsumptionRollup.objects.bulk_create(
+            list(rollups.values()),
+            update_conflicts=True,
+            unique_fields=['house', 'month', 'tariff_id'],
+            update_fields=ROLLUP_FIELDS + ['updated_at']
+        )
+
+    return len(rollups)
+
+def get_change(current, previous):
+    """
+    Изменение к предыдущему месяцу в процентах (None, если сравнивать не с чем)
+    """
+    if not previous:
+        return None
+    return round(float((current - previous) / previous * 100), 1)
+
+def get_consumption_analytics(house_id=None, month_from=None, month_to=None, meter_type_id=None):
+    """
+    Итоги по месяцам и тарифам для дома (или по всем домам) с изменением к предыдущему месяцу.
+    Параметры — строки из запроса; один запрос к таблице итогов.
+    """
+    rollups = ConsumptionRollup.objects.all()
+
+    if house_id:
+        house_id = parse_id(house_id, 'house_id')
+        rollups = rollups.filter(house_id=house_id)
+    if meter_type_id:
+        rollups = rollups.filter(meter_type_id=parse_id(meter_type_id, 'meter_type_id'))
+
+    month_from = parse_month(month_from, 'month_from') if month_from else None
+    month_to = parse_month(month_to, 'month_to') if month_to else None
+    if month_from and month_to and month_from > month_to:
+        raise BillFilterError("month_from не может быть позже month_to.")
+    # Предыдущий месяц загружается для сравнения с первым месяцем диапазона
+    if month_from:
+        rollups = rollups.filter(month__gte=month_from - relativedelta(months=1))
+    if month_to:
+        rollups = rollups.filter(month__lte=month_to)
+
+    rows = (rollups
+            .values('month', 'tariff_id')
+            .annotate(tariff_name=Max('name'), tariff_unit=Max('unit'), tariff_meter_type_id=Max('meter_type_id'),
+                      total_apartments=Sum('apartments'), total_consumption=Sum('consumption'),
+                      total_cost=Sum('cost'), total_estimated=Sum('estimated'))
+            .order_by('month', 'tariff_id'))
+
+    # Итоги по месяцам: месяц -> {tariff_id: итоги тарифа}
+    months = {}
+    for row in rows:
+        months.setdefault(row['month'], {})[row['tariff_id']] = row
+
+    result = []
+    previous = {}
+    previous_cost = None
+    previous_month = None
+    for month, by_tariff in months.items():
+        # Сравнение только с соседним месяцем: при пропуске месяца изменение не считается
+        if previous_month != month - relativedelta(months=1):
+            previous, previous_cost = {}, None
+        cost = sum((row['total_cost'] for row in by_tariff.values()), Decimal(0))
+
+        if month_from is None or month >= month_from:
+            result.append({
+                'month': format_period(month),
+                'cost': float(cost),
+                'cost_change_percent': get_change(cost, previous_cost),
+                'estimated': sum(row['total_estimated'] for row in by_tariff.values()),
+                'charges': [
+                    {
+                        'tariff_id': tariff_id,
+                        'name': row['tariff_name'],
+                        'unit': row['tariff_unit'],
+                        'meter_type_id': row['tariff_meter_type_id'],
+                        'apartments': row['total_apartments'],
+                        'consumption': float(row['total_consumption']),
+                        'cost': float(row['total_cost']),
+                        'estimated': row['total_estimated'],
+                        'consumption_change_percent': get_change(
+                            row['total_consumption'],
+                            previous[tariff_id]['total_consumption'] if tariff_id in previous else None
+                        ),
+                    }
+                    for tariff_id, row in by_tariff.items()
+                ],
+            })
+
+        previous, previous_cost, previous_month = by_tariff, cost, month
+
+    return {'house_id': house_id or None, 'months': result}
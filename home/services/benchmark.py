@@ -0,0 +1,236 @@
+"""
+Замеры производительности расчета и основных эндпоинтов чтения.
+
+Для каждого масштаба (кол-во квартир в доме) в транзакции создается синтетический дом и замеряются:
+  - calculate_utility_bills_for_house (каждым движком),
+  - путь через задачу Celery (task.apply, в текущем процессе, с учетом прогресса),
+  - эндпоинты дома, квартиры, счётчиков по дому и квитанций (холодный и закэшированный ответ).
+По каждому замеру: p50 / p99 / среднее время, квартир в секунду и пик памяти Python (tracemalloc).
+После замеров транзакция откатывается: дом, недостающие справочники (типы счётчиков, тарифы), прогресс
+и квитанции не попадают в БД и не видны другим подключениям, ключи кэша дома сбрасываются.
+Фиксация транзакции поэтому в замеры не входит.
+
+Отдельно run_concurrency_benchmark сравнивает запущенные синхронный (WSGI) и асинхронный (ASGI) серверы
+под одновременной нагрузкой: запросов в секунду, p50 / p99 и кол-во ошибок.
+"""
+import math
+import os
+import platform
+import statistics
+import subprocess
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import django
+from django.conf import settings
+from django.db import connection, transaction
+from django.test import Client
+from home.models import House
+from home.services.calc_tarif import calculate_utility_bills_for_house, ENGINES
+from home.services.dataset import generate_dataset
+from home.services.reference_cache import reference_cache
+from home.services.response_cache import discard_house_cache
+
+def percentile(values, percent):
+    """
+    Перцентиль по ближайшему рангу
+    """
+    ordered = sorted(values)
+    rank = max(math.ceil(percent / 100 * len(ordered)) - 1, 0)
+    return ordered[rank]
+
+def measure(func, repeats, apartments=None):
+    """
+    repeats замеров времени func и отдельный прогон под tracemalloc для пика памяти
+    """
+    durations = []
+    for _ in range(repeats):
+        started_at = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - started_at)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    p50 = percentile(durations, 50)
+    result = {
+        'repeats': repeats,
+        'p50_ms': round(p50 * 1000, 3),
+        'p99_ms': round(percentile(durations, 99) * 1000, 3),
+        'mean_ms': round(statistics.mean(durations) * 1000, 3),
+        'peak_memory_kb': round(peak / 1024, 1),
+    }
+    if apartments:
+        result['apartments_per_second'] = round(apartments / p50, 1) if p50 else None
+    return result
+
+def get_client():
+    hosts = [host for host in settings.ALLOWED_HOSTS if host != '*' and not host.startswith('.')]
+    return Client(HTTP_HOST=hosts[0]) if hosts else Client()
+
+def benchmark_endpoints(client, house, repeats):
+    apartment_id = house.apartments.order_by('id').values_list('id', flat=True).first()
+    urls = {
+        'house_detail': f'/api/house/{house.id}/',
+        'house_detail_last_readings': f'/api/house/{house.id}/?readings_last=3',
+        'apartment_detail': f'/api/apartment/{apartment_id}/',
+        'meters_by_house': f'/api/meters/house/{house.id}/',
+        'bills': f'/api/bills/?house_id={house.id}',
+    }
+    results = {}
+
+    for name, url in urls.items():
+        separator = '&' if '?' in url else '?'
+        counter = iter(range(10 ** 9))
+
+        def get_cold():
+            # Уникальный параметр — новый ключ кэша ответа: каждый раз полная выборка и сериализация
+            response = client.get(f'{url}{separator}bench={next(counter)}')
+            assert response.status_code == 200, f'{url}: {response.status_code}'
+
+        def get_cached():
+            response = client.get(url)
+            assert response.status_code == 200, f'{url}: {response.status_code}'
+
+        get_cached()
+        results[name] = {'cold': measure(get_cold, repeats), 'cached': measure(get_cached, repeats)}
+
+    return results
+
+def run_benchmark(scales, meters_per_apartment=3, years=3, repeats=5, year=None, month=None, engines=ENGINES,
+                  task=None, seed=1, cleanup=True):
+    """
+    Замеры по масштабам scales (кол-во квартир в доме). task — задача расчета дома,
+    запускаемая через task.apply (None — путь через Celery не замеряется).
+    cleanup=False — созданные данные фиксируются в БД.
+    """
+    now = datetime.now()
+    year = year or now.year
+    month = month or now.month
+    client = get_client()
+
+    report = {
+        'started_at': now.isoformat(timespec='seconds'),
+        'environment': get_environment(),
+        'parameters': {
+            'scales': list(scales), 'meters_per_apartment': meters_per_apartment, 'years': years,
+            'repeats': repeats, 'year': year, 'month': month, 'engines': list(engines),
+            'chunk_apartments': settings.CALC_CHUNK_APARTMENTS,
+        },
+        'results': [],
+    }
+
+    for apartments in scales:
+        with transaction.atomic():
+            house_ids, counts = generate_dataset(1, apartments, meters_per_apartment, years, seed=seed,
+                                                 address_prefix='Бенчмарк')
+            house = House.objects.get(id=house_ids[0])
+            apartment_ids = list(house.apartments.values_list('id', flat=True))
+            scale = {'apartments': apartments, 'dataset': counts, 'calculation': {}}
+
+            try:
+                for engine in engines:
+                    scale['calculation'][engine] = measure(
+                        lambda: calculate_utility_bills_for_house(house.id, year, month, engine),
+                        repeats, apartments
+                    )
+
+                if task is not None:
+                    scale['celery_task'] = measure(
+                        lambda: task.apply(args=(house.id, year, month, 0, engines[0])).get(),
+                        repeats, apartments
+                    )
+
+                scale['endpoints'] = benchmark_endpoints(client, house, repeats)
+            finally:
+                if cleanup:
+                    transaction.set_rollback(True)
+                    discard_house_cache(house.id, apartment_ids)
+                    # Копия справочников процесса могла загрузить откатываемые тарифы
+                    reference_cache.clear()
+
+        report['results'].append(scale)
+
+    report['finished_at'] = datetime.now().isoformat(timespec='seconds')
+    return report
+
+def get_environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=settings.BASE_DIR, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'machine': platform.machine(),
+        'processor_count': os.cpu_count(),
+    }
+
+def fetch(url, timeout):
+    """
+    GET url: (время в секундах, успешен ли ответ)
+    """
+    started_at = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            response.read()
+            ok = response.status == 200
+    except (urllib.error.URLError, OSError):
+        ok = False
+    return time.perf_counter() - started_at, ok
+
+def measure_concurrency(urls, concurrency, requests, timeout=30):
+    """
+    requests запросов по urls (по кругу) в concurrency потоков
+    """
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda number: fetch(urls[number % len(urls)], timeout), range(requests)))
+    elapsed = time.perf_counter() - started_at
+
+    durations = [duration for duration, ok in results if ok]
+    return {
+        'requests': requests,
+        'errors': requests - len(durations),
+        'requests_per_second': round(len(durations) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(durations, 50) * 1000, 3) if durations else None,
+        'p99_ms': round(percentile(durations, 99) * 1000, 3) if durations else None,
+    }
+
+def run_concurrency_benchmark(servers, endpoints, concurrency_levels, requests, timeout=30):
+    """
+    Замеры запущенных серверов servers ({сервер: базовый URL}) по эндпоинтам endpoints
+    ({эндпоинт: {сервер: [пути, запрашиваемые по кругу]}}) при каждом уровне одновременности
+    """
+    report = {
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'parameters': {
+            'servers': servers, 'endpoints': endpoints, 'concurrency': list(concurrency_levels), 'requests': requests,
+        },
+        'results': [],
+    }
+
+    for concurrency in concurrency_levels:
+        for name, paths in endpoints.items():
+            for server, base_url in servers.items():
+                urls = [f"{base_url.rstrip('/')}{path}" for path in paths[server]]
+                # Прогрев: соединения с БД и справочный кэш процессов сервера
+                measure_concurrency(urls, concurrency, concurrency, timeout)
+                report['results'].append({
+                    'server': server, 'endpoint': name, 'concurrency': concurrency,
+                    **measure_concurrency(urls, concurrency, requests, timeout),
+                })
+
+    report['finished_at'] = datetime.now().isoformat(timespec='seconds')
+    return report
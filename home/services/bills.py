@@ -0,0 +1,43 @@
+from home.models import UtilityBill
+from home.services.readings import parse_period
+
+class BillFilterError(ValueError):
+    pass
+
+def parse_id(value, name):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise BillFilterError(f"Параметр {name} должен быть целым числом.")
+    if value <= 0:
+        raise BillFilterError(f"Параметр {name} должен быть положительным.")
+    return value
+
+def parse_month(value, name):
+    try:
+        return parse_period(value)
+    except (TypeError, ValueError):
+        raise BillFilterError(f"Параметр {name} должен быть в формате YYYY-MM.")
+
+def filter_bills(house_id=None, apartment_id=None, month_from=None, month_to=None):
+    """
+    Квитанции вместе с квартирой и домом, отфильтрованные по параметрам запроса (строкам).
+    Границы месяцев month_from / month_to в формате YYYY-MM включаются в выборку.
+    """
+    bills = UtilityBill.objects.select_related('apartment__house')
+
+    if house_id:
+        bills = bills.filter(apartment__house_id=parse_id(house_id, 'house_id'))
+    if apartment_id:
+        bills = bills.filter(apartment_id=parse_id(apartment_id, 'apartment_id'))
+
+    month_from = parse_month(month_from, 'month_from') if month_from else None
+    month_to = parse_month(month_to, 'month_to') if month_to else None
+    if month_from and month_to and month_from > month_to:
+        raise BillFilterError("month_from не может быть позже month_to.")
+    if month_from:
+        bills = bills.filter(month__gte=month_from)
+    if month_to:
+        bills = bills.filter(month__lte=month_to)
+
+    return bills
@@ -0,0 +1,78 @@
+"""
+Потоковая выгрузка квитанций в NDJSON / CSV.
+
+Строки читаются из БД серверным курсором (QuerySet.iterator) пачками по EXPORT_CHUNK_SIZE
+и сразу отдаются клиенту: в памяти находится не больше одной пачки независимо от объема выгрузки.
+Начисления выгружаются JSON-текстом из БД, без разбора и повторной сериализации.
+"""
+import csv
+import io
+import json
+from django.db.models import TextField
+from django.db.models.functions import Cast
+from home.services.readings_import import FORMAT_CSV, FORMAT_NDJSON, FORMATS
+
+# Кол-во строк, читаемых из курсора и отдаваемых клиенту за раз
+EXPORT_CHUNK_SIZE = 2000
+
+EXPORT_FIELDS = ['id', 'apartment_id', 'apartment_number', 'house_id', 'address', 'month', 'charge']
+
+CONTENT_TYPES = {
+    FORMAT_NDJSON: 'application/x-ndjson',
+    FORMAT_CSV: 'text/csv',
+}
+
+def iter_bill_rows(bills, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Кортежи (id, apartment_id, apartment_number, house_id, address, month, charge JSON-текстом)
+    в порядке (месяц, id) — тот же порядок, что у индекса bill_month_id_idx
+    """
+    return (bills
+            .order_by('month', 'id')
+            .annotate(charge_json=Cast('charge', output_field=TextField()))
+            .values_list('id', 'apartment_id', 'apartment__number', 'apartment__house_id',
+                         'apartment__house__address', 'month', 'charge_json')
+            .iterator(chunk_size=chunk_size))
+
+def format_ndjson_row(row):
+    *fields, charge = row
+    record = dict(zip(EXPORT_FIELDS, fields))
+    record['month'] = record['month'].isoformat()
+    # Начисления уже JSON-текст, подставляем как есть
+    return f'{json.dumps(record, ensure_ascii=False)[:-1]}, "charge": {charge}}}\n'
+
+def iter_ndjson_chunks(rows, chunk_size):
+    chunk = []
+    for row in rows:
+        chunk.append(format_ndjson_row(row))
+        if len(chunk) >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+def iter_csv_chunks(rows, chunk_size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+
+    for line, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if line % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+def export_bills(bills, file_format=FORMAT_NDJSON, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Выгрузка квитанций (QuerySet из filter_bills) кусками текста
+    """
+    if file_format not in FORMATS:
+        raise ValueError(f"Формат выгрузки должен быть одним из: {', '.join(FORMATS)}.")
+
+    rows = iter_bill_rows(bills, chunk_size)
+    if file_format == FORMAT_CSV:
+        return iter_csv_chunks(rows, chunk_size)
+    return iter_ndjson_chunks(rows, chunk_size)
@@ -0,0 +1,151 @@
+"""
+Векторизованный расчет начислений на NumPy.
+
+Площади, цены и показания переводятся в целые младшие единицы (сотые доли м², копейки,
+тысячные доли показания), расход и стоимость считаются для всего дома разом в int64
+с округлением ROUND_HALF_UP. Строки, для которых целочисленный результат может
+разойтись с Decimal-движком (показание не укладывается в три знака, ровно половина
+копейки, оценка по среднему), досчитываются построчно через calculate_meter_charge.
+"""
+try:
+    import numpy as np
+except ImportError:  # numpy — необязательная зависимость
+    np = None
+
+from home.services.calc_tarif import calculate_meter_charge
+from home.services.profiling import NULL_PROFILER
+
+# Показания переводятся в целые тысячные доли единицы
+READING_SCALE = 1000
+# Предел |показание| * цена, до которого погрешность float не влияет на округление до копеек
+SAFE_READING_PRICE = 10 ** 10
+
+def round_half_up(values, divisor):
+    """
+    Целочисленное деление с округлением ROUND_HALF_UP (половина — от нуля, как в Decimal)
+    """
+    return np.sign(values) * ((np.abs(values) + divisor // 2) // divisor)
+
+def to_kopecks(value):
+    return int(value * 100)
+
+def calculate_area_costs(areas, prices):
+    """
+    Стоимость по площади для всех квартир и тарифов: матрица (квартиры x тарифы) в копейках
+    """
+    area_cents = np.array([to_kopecks(area) for area in areas], dtype=np.int64)
+    price_kopecks = np.array([to_kopecks(price) for price in prices], dtype=np.int64)
+    return round_half_up(np.outer(area_cents, price_kopecks), 100)
+
+def calculate_meter_costs(current_readings, previous_readings, price_kopecks):
+    """
+    Расход (в сотых) и стоимость (в копейках) по счетчикам, а также маска строк,
+    для которых целочисленный результат гарантированно совпадает с Decimal-движком
+    """
+    current = np.array(current_readings, dtype=np.float64)
+    previous = np.array(previous_readings, dtype=np.float64)
+    prices = np.array(price_kopecks, dtype=np.int64)
+
+    current_scaled = np.rint(current * READING_SCALE)
+    previous_scaled = np.rint(previous * READING_SCALE)
+
+    exact = (current_scaled / READING_SCALE == current) & (previous_scaled / READING_SCALE == previous)
+    exact &= np.maximum(np.abs(current), np.abs(previous)) * (prices / 100) < SAFE_READING_PRICE
+
+    consumption = np.where(exact, current_scaled - previous_scaled, 0).astype(np.int64)
+    raw_cost = consumption * prices
+
+    # Ровно половина: результат Decimal зависит от двоичного представления показаний
+    exact &= (np.abs(consumption) % 10 != 5) & (np.abs(raw_cost) % 1000 != 500)
+
+    return round_half_up(consumption, 10), round_half_up(raw_cost, 1000), exact
+
+def calculate_charges_numpy(apartments, tariffs_with_meter_type, tariffs_not_meter_type,
+                            current_period, previous_period, profiler=NULL_PROFILER):
+    """
+    Векторизованный расчет: для каждой квартиры возвращает (calc_rent, absent_meters)
+    в том же виде и порядке, что и calculate_charges_decimal
+    """
+    if np is None:
+        raise RuntimeError("Для движка numpy требуется установленный пакет numpy.")
+
+    area_tariffs = list(tariffs_not_meter_type.items())
+    area_costs = calculate_area_costs(
+        [apartment.area for apartment in apartments],
+        [tariff.price_per_unit for _, tariff in area_tariffs]
+    )
+    area_costs = (area_costs / 100).tolist()
+    meter_price_kopecks = {
+        meter_type_id: to_kopecks(tariff.price_per_unit)
+        for meter_type_id, tariff in tariffs_with_meter_type.items()
+    }
+
+    charges = []
+    metered = []  # (calc_rent, позиция строки, счетчик, тариф)
+    current_readings = []
+    previous_readings = []
+    price_kopecks = []
+
+    for apartment, apartment_area_costs in zip(apartments, area_costs):
+        area = float(apartment.area)
+        calc_rent = [
+            {
+                "id": tariff.id,
+                "name": custom_name,
+                "consumption": area,
+                "unit": tariff.unit or "m²",
+                "cost": cost
+            }
+            for (custom_name, tariff), cost in zip(area_tariffs, apartment_area_costs)
+        ]
+        absent_meters = []
+
+        for meter in apartment.meters.all():
+            tariff = tariffs_with_meter_type.get(meter.meter_type_id)
+            if not tariff:
+                continue
+            meter_type = tariff.meter_type
+
+            readings = meter.readings or {}
+            current_reading = readings.get(current_period)
+            previous_reading = readings.get(previous_period)
+
+            if current_reading is None:
+                if previous_reading is None:
+                    absent_meters.append({
+                        "id": tariff.id,
+                        "name": meter_type.name
+                    })
+                else:
+                    # Оценка по среднему расходу считается построчно
+                    calc_rent.append(calculate_meter_charge(meter, tariff, current_period, previous_period, profiler))
+                continue
+
+            metered.append((calc_rent, len(calc_rent), meter, tariff))
+            calc_rent.append(None)
+            current_readings.append(current_reading)
+            previous_readings.append(previous_reading or 0)
+            price_kopecks.append(meter_price_kopecks[meter.meter_type_id])
+
+        charges.append((calc_rent, absent_meters))
+
+    if metered:
+        consumption, cost, exact = calculate_meter_costs(current_readings, previous_readings, price_kopecks)
+        consumption = (consumption / 100).tolist()
+        cost = (cost / 100).tolist()
+        exact = exact.tolist()
+
+        for line, (calc_rent, position, meter, tariff) in enumerate(metered):
+            if not exact[line]:
+                calc_rent[position] = calculate_meter_charge(meter, tariff, current_period, previous_period, profiler)
+                continue
+
+            calc_rent[position] = {
+                "id": tariff.id,
+                "name": tariff.meter_type.name,
+                "consumption": consumption[line],
+                "unit": tariff.meter_type.unit,
+                "cost": cost[line]
+            }
+
+    return charges
@@ -1,118 +1,289 @@
-from datetime import datetime
+import logging
+import time
+from datetime import date, datetime
 from decimal import Decimal, ROUND_HALF_UP
+from dateutil.relativedelta import relativedelta
+from django.conf import settings
 from django.db import transaction
-from home.models import House, Tariff, UtilityBill
+from django.db.models import Prefetch, prefetch_related_objects
+from django.utils import timezone
+from home.metrics import observe_house_calculation
+from home.models import House, Meter, MeterReading, StaleBill, UtilityBill
+from home.services.profiling import NULL_PROFILER
+from home.services.reference_cache import get_tariffs
+
+logger = logging.getLogger(__name__)
+
+# Размер пачки для массовой записи квитанций
+BILLS_BATCH_SIZE = 1000
+
+# За сколько предыдущих месяцев считается средний расход при отсутствии показаний
+AVERAGE_MONTHS = 3
+
+# Движки расчета начислений
+ENGINE_DECIMAL = 'decimal'
+ENGINE_NUMPY = 'numpy'
+ENGINES = (ENGINE_DECIMAL, ENGINE_NUMPY)
 
 def round_decimal(value, places):
     return value.quantize(Decimal(10) ** -places, rounding=ROUND_HALF_UP)
 
-def get_average_consumption(meter, current_period, last_n=3):
+def get_average_consumption(meter, previous_period):
+    """
+    Средний помесячный расход за AVERAGE_MONTHS месяцев по показанию предыдущего месяца:
+    хранится в показании и обновляется при записи показаний (services.consumption)
+    """
+    for reading in meter.meter_readings.all():
+        if reading.period.strftime('%Y-%m') == previous_period:
+            return reading.average_consumption or Decimal(0)
+    return Decimal(0)
+
+def get_periods(year, month):
+    current_period = f"{year}-{str(month).zfill(2)}"
+    previous_period = f"{year}-{str(month - 1).zfill(2)}" if month > 1 else f"{year-1}-12"
+    return current_period, previous_period
+
+def load_tariffs():
+    """
+    Делит тарифы из справочного кэша на тарифы по счетчикам и тарифы по площади
+    """
+    tariffs_with_meter_type = {}
+    tariffs_not_meter_type = {}
+
+    for tariff in get_tariffs():
+        if tariff.meter_type_id is None:
+            tariffs_not_meter_type[tariff.custom_name] = tariff
+        else:
+            tariffs_with_meter_type[tariff.meter_type_id] = tariff
+
+    return tariffs_with_meter_type, tariffs_not_meter_type
+
+def get_meters_prefetch(year, month):
+    """
+    Счетчики квартир с показаниями: фиксированное число запросов независимо от размера дома.
+    Показания загружаются только за расчетный и предыдущий месяц: средний расход для оценки
+    пропущенного показания хранится в показании предыдущего месяца.
+    """
+    period_to = date(year, month, 1)
+    period_from = period_to - relativedelta(months=1)
+
+    readings = MeterReading.objects.filter(period__range=(period_from, period_to))
+    meters = Meter.objects.prefetch_related(Prefetch('meter_readings', queryset=readings))
+    return Prefetch('meters', queryset=meters)
+
+def calculate_area_charge(apartment, custom_name, tariff):
+    cost = round_decimal(tariff.price_per_unit * apartment.area, 2)
+    return {
+        "id": tariff.id,
+        "name": custom_name,
+        "consumption": float(apartment.area),
+        "unit": tariff.unit or "m²",
+        "cost": float(cost)
+    }
+
+def calculate_meter_charge(meter, tariff, current_period, previous_period, profiler=NULL_PROFILER):
+    meter_type = tariff.meter_type
     readings = meter.readings or {}
-    year, month = map(int, current_period.split('-'))
-
-    consumptions = []
-
-    for _ in range(last_n):
-        month -= 1
-        if month == 0:
-            year -= 1
-            month = 12
-        period = f"{year}-{str(month).zfill(2)}"
-
-        current_reading = readings.get(period)
-        if current_reading is not None:
-            if len(consumptions) == 0:
-                previous_reading = 0
-            else:
-                previous_reading = readings.get(f"{year}-{str(month + 1).zfill(2)}", 0)
-            consumptions.append(current_reading - previous_reading)
-
-    if consumptions:
-        return sum(consumptions) / len(consumptions)
-    else:
-        return Decimal(0)
 
-@transaction.atomic
-def calculate_utility_bills_for_house(house_id, year, month):
-    try:
-        current_period = f"{year}-{str(month).zfill(2)}"
-        previous_period = f"{year}-{str(month - 1).zfill(2)}" if month > 1 else f"{year-1}-12"
+    current_reading = readings.get(current_period)
+    previous_reading = readings.get(previous_period, Decimal(0))
 
-        house = House.objects.get(id=house_id)
+    # Если текущих показаний нет, берем средний расход за последние 3 месяца
+    if current_reading is None:
+        with profiler.stage('estimate_averages'):
+            consumption = get_average_consumption(meter, previous_period)
+    else:
+        consumption = Decimal(current_reading) - Decimal(previous_reading)
 
-        tariffs_with_meter_type = {tariff.meter_type.id: tariff for tariff in Tariff.objects.filter(meter_type__isnull=False)}
-        tariffs_not_meter_type = {tariff.custom_name: tariff for tariff in Tariff.objects.filter(meter_type__isnull=True)}
+    cost = round_decimal(consumption * tariff.price_per_unit, 2)
+    return {
+        "id": tariff.id,
+        "name": meter_type.name,
+        "consumption": float(round_decimal(consumption, 2)),
+        "unit": meter_type.unit,
+        "cost": float(cost)
+    }
 
-        result = []
+def calculate_apartment_charges(apartment, tariffs_with_meter_type, tariffs_not_meter_type,
+                                current_period, previous_period, profiler=NULL_PROFILER):
+    calc_rent = []  # расчет по тарифам каждой квартиры
+    absent_meters = []  # счетчики, у которых нет данных за запрашиваемый период
 
-        for apartment in house.apartments.all():
-            calc_rent = []  # расчет по тарифам каждой квартиры
-            absent_meters = []  # счетчики, у которых нет данных за запрашиваемый период
+    # Расчет тарифов без счетчиков, по площади
+    for custom_name, tariff in tariffs_not_meter_type.items():
+        calc_rent.append(calculate_area_charge(apartment, custom_name, tariff))
 
-            # Расчет тарифов без счетчиков, по площади
-            for custom_name, tariff in tariffs_not_meter_type.items():
-                cost = round_decimal(tariff.price_per_unit * apartment.area, 2)
-                calc_rent.append({
-                    "id": tariff.id,
-                    "name": custom_name,
-                    "consumption": float(apartment.area),
-                    "unit": tariff.unit or "m²",
-                    "cost": float(cost)
-                })
+    # Расчет тарифов по счетчикам
+    for meter in apartment.meters.all():
+        tariff = tariffs_with_meter_type.get(meter.meter_type_id)
+        if not tariff:
+            continue
+        meter_type = tariff.meter_type
 
-            # Расчет тарифов по счетчикам
-            for meter in apartment.meters.all():
-                meter_type = meter.meter_type
-                tariff = tariffs_with_meter_type.get(meter_type.id)
-                if not tariff:
-                    continue
-
-                readings = meter.readings or {}
-
-                if previous_period not in readings and current_period not in readings:
-                    absent_meters.append({
-                        "id": tariff.id,
-                        "name": meter_type.name
-                    })
-                    continue
-
-                current_reading = readings.get(current_period)
-                previous_reading = readings.get(previous_period, Decimal(0))
-
-                # Если текущих показаний нет, рассчитываем средний расход за последние 3 месяца
-                if current_reading is None:
-                    consumption = get_average_consumption(meter, current_period)
-                else:
-                    consumption = Decimal(current_reading) - Decimal(previous_reading)
-
-                cost = round_decimal(consumption * tariff.price_per_unit, 2)
-                calc_rent.append({
-                    "id": tariff.id,
-                    "name": meter_type.name,
-                    "consumption": float(round_decimal(consumption, 2)),
-                    "unit": meter_type.unit,
-                    "cost": float(cost)
-                })
+        readings = meter.readings or {}
 
-            result.append({
-                "apartment_id": apartment.id,
-                "apartment_number": apartment.number,
-                "house_id": house.id,
-                "address": house.address,
-                "date": datetime(year, month, 1),
-                "calc_rent": calc_rent,
-                "absent_meters": absent_meters
+        if previous_period not in readings and current_period not in readings:
+            absent_meters.append({
+                "id": tariff.id,
+                "name": meter_type.name
             })
+            continue
+
+        calc_rent.append(calculate_meter_charge(meter, tariff, current_period, previous_period, profiler))
 
-            UtilityBill.objects.update_or_create(
-                apartment=apartment,
-                month=datetime(year, month, 1),
-                defaults={
-                    'charge': calc_rent
-                }
-            )
+    return calc_rent, absent_meters
 
-        return result
-    except Exception as e:
-        raise e
+def get_estimated_tariff_ids(apartment, tariffs_with_meter_type, current_period, previous_period):
+    """
+    Тарифы квартиры, начисленные по среднему расходу: показания за месяц нет, за предыдущий есть.
+    Не зависит от движка расчета и хранится в квитанции отдельно от строк начислений.
+    """
+    estimated = []
+    for meter in apartment.meters.all():
+        tariff = tariffs_with_meter_type.get(meter.meter_type_id)
+        readings = meter.readings
+        if tariff and current_period not in readings and previous_period in readings:
+            estimated.append(tariff.id)
+    return estimated
+
+def calculate_charges_decimal(apartments, tariffs_with_meter_type, tariffs_not_meter_type,
+                              current_period, previous_period, profiler=NULL_PROFILER):
+    """
+    Построчный расчет на Decimal: для каждой квартиры возвращает (calc_rent, absent_meters)
+    """
+    return [
+        calculate_apartment_charges(apartment, tariffs_with_meter_type, tariffs_not_meter_type,
+                                    current_period, previous_period, profiler)
+        for apartment in apartments
+    ]
+
+def get_charges_engine(engine):
+    if engine == ENGINE_DECIMAL:
+        return calculate_charges_decimal
+    if engine == ENGINE_NUMPY:
+        # numpy — необязательная зависимость, импортируем только при выборе движка
+        from home.services.calc_numpy import calculate_charges_numpy
+        return calculate_charges_numpy
+    raise ValueError(f"Неизвестный движок расчета: {engine}")
+
+def save_utility_bills(bills, calculated_at):
+    """
+    Записывает квитанции пачками одним upsert'ом по (квартира, месяц) и снимает с них пометки
+    об устаревании, сделанные до начала расчета
+    """
+    UtilityBill.objects.bulk_create(
+        bills,
+        batch_size=BILLS_BATCH_SIZE,
+        update_conflicts=True,
+        unique_fields=['apartment', 'month'],
+        update_fields=['charge', 'estimated_tariffs']
+    )
+    StaleBill.objects.filter(
+        apartment_id__in=[bill.apartment_id for bill in bills],
+        month=bills[0].month,
+        marked_at__lte=calculated_at
+    ).delete()
+
+def iter_apartment_chunks(house, year, month, chunk_size, last_apartment_id=None, apartment_ids=None,
+                          profiler=NULL_PROFILER):
+    """
+    Квартиры дома пачками по chunk_size в порядке id, начиная после last_apartment_id,
+    со счетчиками и показаниями
+    """
+    meters_prefetch = get_meters_prefetch(year, month)
+    while True:
+        apartments = house.apartments.order_by('id')
+        if apartment_ids is not None:
+            apartments = apartments.filter(id__in=apartment_ids)
+        if last_apartment_id is not None:
+            apartments = apartments.filter(id__gt=last_apartment_id)
+
+        with profiler.stage('load_apartments'):
+            apartments = list(apartments[:chunk_size])
+        if not apartments:
+            return
+
+        with profiler.stage('load_meters'):
+            prefetch_related_objects(apartments, meters_prefetch)
+
+        yield apartments
+        last_apartment_id = apartments[-1].id
+
+def save_checkpoint(progress, apartments):
+    progress.last_apartment_id = apartments[-1].id
+    progress.processed_apartments += len(apartments)
+    progress.save(update_fields=['last_apartment_id', 'processed_apartments', 'updated_at'])
+
+def calculate_utility_bills_for_house(house_id, year, month, engine=ENGINE_DECIMAL, progress=None,
+                                      apartment_ids=None, profiler=NULL_PROFILER):
+    """
+    Расчет квитанций дома пачками квартир, каждая пачка записывается в своей транзакции.
+    Если передан progress, вместе с пачкой в нем сохраняется контрольная точка,
+    а расчет продолжается с квартиры, следующей за progress.last_apartment_id.
+    apartment_ids ограничивает расчет отдельными квартирами дома (пересчет устаревших квитанций).
+    profiler собирает время по этапам расчета (см. services.profiling).
+    """
+    calculate_charges = get_charges_engine(engine)
+    started_at = time.perf_counter()
+    result = []
+    profiler.start()
+    try:
+        calculate_house(house_id, year, month, calculate_charges, progress, apartment_ids, result, profiler)
+    except Exception:
+        observe_house_calculation(engine, 'error', len(result), time.perf_counter() - started_at)
+        raise
+    finally:
+        profiler.stop()
+
+    elapsed = time.perf_counter() - started_at
+    observe_house_calculation(engine, 'ok', len(result), elapsed)
+    logger.info("Расчет дома %s за %s-%02d (%s): %s квартир за %.3f с (%.1f кв/с)",
+                house_id, year, month, engine, len(result), elapsed, len(result) / elapsed if elapsed else 0)
+
+    return result
+
+def calculate_house(house_id, year, month, calculate_charges, progress, apartment_ids, result, profiler):
+    """
+    Расчет и запись квитанций дома; строки результата добавляются в result по мере записи пачек
+    """
+    calculated_at = timezone.now()
+    current_period, previous_period = get_periods(year, month)
+
+    with profiler.stage('load_house'):
+        house = House.objects.get(id=house_id)
+        tariffs_with_meter_type, tariffs_not_meter_type = load_tariffs()
+
+        last_apartment_id = None
+        if progress is not None:
+            last_apartment_id = progress.last_apartment_id
+            if not progress.total_apartments:
+                progress.total_apartments = house.apartments.count()
+                progress.save(update_fields=['total_apartments', 'updated_at'])
+
+    for apartments in iter_apartment_chunks(house, year, month, settings.CALC_CHUNK_APARTMENTS, last_apartment_id,
+                                            apartment_ids, profiler):
+        with profiler.stage('calculate'):
+            charges = calculate_charges(apartments, tariffs_with_meter_type, tariffs_not_meter_type,
+                                        current_period, previous_period, profiler)
+
+        with profiler.stage('build_bills'):
+            bills = []
+            for apartment, (calc_rent, absent_meters) in zip(apartments, charges):
+                result.append({
+                    "apartment_id": apartment.id,
+                    "apartment_number": apartment.number,
+                    "house_id": house.id,
+                    "address": house.address,
+                    "date": datetime(year, month, 1),
+                    "calc_rent": calc_rent,
+                    "absent_meters": absent_meters
+                })
+                estimated_tariffs = get_estimated_tariff_ids(apartment, tariffs_with_meter_type,
+                                                             current_period, previous_period)
+                bills.append(UtilityBill(apartment=apartment, month=date(year, month, 1), charge=calc_rent,
+                                         estimated_tariffs=estimated_tariffs))
 
+        with profiler.stage('save_bills'), transaction.atomic():
+            save_utility_bills(bills, calculated_at)
+            if progress is not None:
+                save_checkpoint(progress, apartments)
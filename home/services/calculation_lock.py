@@ -0,0 +1,54 @@
+"""
+Один расчет дома за месяц одновременно.
+
+Пока расчет дома за месяц в очереди или выполняется, в кэше Django (Redis, общий для всех процессов)
+хранится id его задачи; повторные запросы получают этот id вместо запуска новой задачи.
+Ключ ставится атомарно (cache.add) до отправки задачи и снимается задачей после успешного расчета
+или последней неудачной попытки. CALC_LOCK_TIMEOUT ограничивает срок ключа на случай потерянной задачи;
+ключ задачи, уже завершенной по данным бэкенда результатов, считается устаревшим.
+"""
+import uuid
+from celery import states
+from celery.result import AsyncResult
+from django.conf import settings
+from django.core.cache import cache
+
+def calculation_lock_key(house_id, year, month):
+    return f'calculation_lock:{house_id}:{year}-{month:02d}'
+
+def start_house_calculation(house_id, year, month, start, force=False):
+    """
+    Запуск расчета дома за месяц или присоединение к уже запущенному.
+    start(task_id) отправляет задачу с переданным id. force — запустить новый расчет, даже если
+    есть текущий (последующие запросы присоединяются к новому).
+    Возвращает (id задачи, присоединен ли запрос к уже запущенному расчету).
+    """
+    key = calculation_lock_key(house_id, year, month)
+    task_id = str(uuid.uuid4())
+
+    if force:
+        cache.set(key, task_id, timeout=settings.CALC_LOCK_TIMEOUT)
+    else:
+        while not cache.add(key, task_id, timeout=settings.CALC_LOCK_TIMEOUT):
+            current_task_id = cache.get(key)
+            if current_task_id is None:
+                # Ключ сняли между add и get: повторная попытка
+                continue
+            if AsyncResult(current_task_id).state not in states.READY_STATES:
+                return current_task_id, True
+            release_house_calculation(house_id, year, month, current_task_id)
+
+    try:
+        start(task_id)
+    except Exception:
+        release_house_calculation(house_id, year, month, task_id)
+        raise
+    return task_id, False
+
+def release_house_calculation(house_id, year, month, task_id):
+    """
+    Снятие ключа, если он принадлежит задаче task_id (после принудительного запуска ключ у новой задачи)
+    """
+    key = calculation_lock_key(house_id, year, month)
+    if cache.get(key) == task_id:
+        cache.delete(key)
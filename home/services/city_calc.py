@@ -0,0 +1,57 @@
+from django.db.models import Count
+from home.models import House, CalculationProgress
+
+def select_houses(house_ids=None):
+    """
+    Дома для расчета по городу вместе с количеством квартир: [(house_id, apartments_count), ...]
+    """
+    houses = House.objects.annotate(apartments_count=Count('apartments'))
+    if house_ids:
+        houses = houses.filter(id__in=house_ids)
+    return list(houses.values_list('id', 'apartments_count'))
+
+def build_house_chunks(houses, max_apartments):
+    """
+    Раскладывает дома по пачкам примерно по max_apartments квартир.
+    Крупные дома идут первыми и занимают пачку целиком, мелкие собираются вместе.
+    """
+    chunks = []
+    chunk = []
+    chunk_apartments = 0
+
+    for house_id, apartments_count in sorted(houses, key=lambda house: house[1], reverse=True):
+        if chunk and chunk_apartments + apartments_count > max_apartments:
+            chunks.append(chunk)
+            chunk = []
+            chunk_apartments = 0
+        chunk.append(house_id)
+        chunk_apartments += apartments_count
+
+    if chunk:
+        chunks.append(chunk)
+
+    return chunks
+
+def get_failed_house_ids(run_id):
+    """
+    Дома расчета по городу с ошибкой, не рассчитанные и при повторе
+    """
+    progress = CalculationProgress.objects.filter(run_id=run_id)
+    return list(progress
+                .filter(status="ошибка")
+                .exclude(house_id__in=progress.filter(status="готово").values('house_id'))
+                .values_list('house_id', flat=True)
+                .distinct())
+
+def get_chunk_delays(chunks, apartments_counts, limit):
+    """
+    Бюджет limit квартир в секунду распределяется при запуске пачек: пачка запускается, когда бюджет
+    с начала прохода покрывает квартиры всех предыдущих пачек. Задержки в секундах по порядку пачек;
+    без ограничения все пачки запускаются сразу.
+    """
+    delays = []
+    planned = 0
+    for chunk in chunks:
+        delays.append(planned / limit if limit else 0)
+        planned += sum(apartments_counts.get(house_id, 0) for house_id in chunk)
+    return delays
@@ -0,0 +1,104 @@
+"""
+Расход по показаниям счётчиков, хранимый вместе с показаниями.
+
+Для каждого показания сохраняются:
+  - consumption — расход с предыдущего показания счётчика (у первого показания не определен),
+  - consumption_months — за сколько месяцев накоплен этот расход (больше 1, если месяцы пропущены),
+  - average_consumption — средний помесячный расход за AVERAGE_MONTHS месяцев по этот месяц включительно.
+При записи показания пересчитываются только показания того же счётчика начиная с его месяца,
+поэтому оценка расхода при пропуске показания в расчете — чтение одного поля.
+"""
+from collections import deque
+from decimal import Decimal, ROUND_HALF_UP
+from dateutil.relativedelta import relativedelta
+from django.db.models import F, Q, Window
+from django.db.models.functions import Lead
+from home.models import MeterReading
+from home.services.calc_tarif import AVERAGE_MONTHS
+
+# Кол-во счётчиков, показания которых пересчитываются одним запросом, и размер пачки bulk_update
+CONSUMPTION_BATCH_SIZE = 1000
+
+CONSUMPTION_FIELDS = ['consumption', 'consumption_months', 'average_consumption']
+
+def months_between(start, end):
+    return (end.year - start.year) * 12 + end.month - start.month
+
+def compute_consumption(readings, since=None):
+    """
+    readings — показания одного счётчика по возрастанию месяца (начиная с последнего показания
+    до since - AVERAGE_MONTHS или с первого). Заполняет поля расхода у показаний с месяцем не раньше since
+    и возвращает те из них, у которых значения изменились.
+    """
+    changed = []
+    previous = None
+    # Интервалы между показаниями, попадающие в окно среднего: (месяц окончания, расход, месяцев)
+    intervals = deque()
+
+    for reading in readings:
+        consumption = months = None
+        if previous is not None:
+            consumption = reading.value - previous.value
+            months = months_between(previous.period, reading.period)
+            intervals.append((reading.period, consumption, months))
+        previous = reading
+
+        window_start = reading.period - relativedelta(months=AVERAGE_MONTHS)
+        while intervals and intervals[0][0] <= window_start:
+            intervals.popleft()
+
+        if since is not None and reading.period < since:
+            continue
+
+        total_months = sum(interval_months for _, _, interval_months in intervals)
+        average = None
+        if total_months:
+            average = (sum(interval_consumption for _, interval_consumption, _ in intervals) / total_months
+                       ).quantize(Decimal('0.001'), rounding=ROUND_HALF_UP)
+
+        values = (consumption, months, average)
+        if (reading.consumption, reading.consumption_months, reading.average_consumption) != values:
+            reading.consumption, reading.consumption_months, reading.average_consumption = values
+            changed.append(reading)
+
+    return changed
+
+def load_readings_since(since):
+    """
+    Показания счётчиков since ({meter_id: месяц}), нужные для пересчета: начиная с последнего показания
+    до (месяц - AVERAGE_MONTHS). Один запрос; фильтр по LEAD выполняется после оконной функции.
+    """
+    start = min(since.values()) - relativedelta(months=AVERAGE_MONTHS)
+    return (MeterReading.objects
+            .filter(meter_id__in=since)
+            .annotate(next_period=Window(Lead('period'), partition_by=F('meter_id'), order_by=F('period').asc()))
+            .filter(Q(period__gte=start) | Q(next_period__gte=start))
+            .order_by('meter_id', 'period'))
+
+def refresh_consumption(changes, batch_size=CONSUMPTION_BATCH_SIZE):
+    """
+    Пересчет расхода после записи, изменения или удаления показаний.
+    changes — пары (meter_id, месяц измененного показания). Возвращает кол-во обновленных показаний.
+    """
+    since = {}
+    for meter_id, period in changes:
+        since[meter_id] = min(since.get(meter_id, period), period)
+
+    meter_ids = sorted(since)
+    updated = 0
+    for offset in range(0, len(meter_ids), batch_size):
+        batch_since = {meter_id: since[meter_id] for meter_id in meter_ids[offset:offset + batch_size]}
+
+        by_meter = {}
+        for reading in load_readings_since(batch_since):
+            by_meter.setdefault(reading.meter_id, []).append(reading)
+
+        changed = []
+        for meter_id, readings in by_meter.items():
+            changed.extend(compute_consumption(readings, batch_since[meter_id]))
+
+        if changed:
+            MeterReading.objects.bulk_update(changed, CONSUMPTION_FIELDS, batch_size=batch_size)
+        updated += len(changed)
+
+    return updated
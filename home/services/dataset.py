@@ -0,0 +1,122 @@
+"""
+Генерация синтетических данных для нагрузочных проверок: дома, квартиры, счётчики
+и помесячные показания за несколько лет с пропусками.
+"""
+import random
+from datetime import date
+from decimal import Decimal
+from dateutil.relativedelta import relativedelta
+from django.db import transaction
+from home.models import House, Apartment, Meter, MeterReading, MeterType, Tariff
+from home.services.consumption import refresh_consumption
+
+# Размер пачки для bulk_create
+DATASET_BATCH_SIZE = 5000
+
+# Типы счётчиков и тарифы, создаваемые при отсутствии: (название, единица, цена)
+METER_TYPES = [
+    ('Холодная вода', 'м³', Decimal('45.50')),
+    ('Горячая вода', 'м³', Decimal('210.80')),
+    ('Электроэнергия', 'кВт·ч', Decimal('6.17')),
+]
+AREA_TARIFFS = [
+    ('Содержание жилья', 'м²', Decimal('28.40')),
+    ('Капитальный ремонт', 'м²', Decimal('12.15')),
+]
+
+# Средний месячный расход по типу счётчика (по порядку METER_TYPES)
+MONTHLY_CONSUMPTION = [Decimal('6'), Decimal('3.5'), Decimal('180')]
+
+def ensure_reference_data():
+    """
+    Типы счётчиков и тарифы: существующие используются, недостающие создаются
+    """
+    meter_types = []
+    for name, unit, price in METER_TYPES:
+        meter_type, _ = MeterType.objects.get_or_create(name=name, defaults={'unit': unit})
+        Tariff.objects.get_or_create(meter_type=meter_type, defaults={'unit': unit, 'price_per_unit': price})
+        meter_types.append(meter_type)
+
+    for name, unit, price in AREA_TARIFFS:
+        Tariff.objects.get_or_create(custom_name=name, defaults={'unit': unit, 'price_per_unit': price})
+
+    return meter_types
+
+def iter_months(last_month, years):
+    first_month = last_month - relativedelta(months=years * 12 - 1)
+    month = first_month
+    while month <= last_month:
+        yield month
+        month += relativedelta(months=1)
+
+def generate_readings(meters, months, gap_rate, rng):
+    """
+    Накопительные показания: расход колеблется вокруг среднего, пропущенный месяц не записывается,
+    но расход за него входит в следующее показание
+    """
+    for meter, meter_type_index in meters:
+        average = MONTHLY_CONSUMPTION[meter_type_index % len(MONTHLY_CONSUMPTION)]
+        value = Decimal(rng.randint(0, 500))
+        for month in months:
+            value += (average * Decimal(rng.uniform(0.5, 1.5))).quantize(Decimal('0.001'))
+            if rng.random() < gap_rate:
+                continue
+            yield MeterReading(meter=meter, period=month, value=value)
+
+def bulk_create_in_batches(model, objects, batch_size):
+    batch = []
+    created = 0
+    for obj in objects:
+        batch.append(obj)
+        if len(batch) >= batch_size:
+            model.objects.bulk_create(batch)
+            created += len(batch)
+            batch = []
+    if batch:
+        model.objects.bulk_create(batch)
+        created += len(batch)
+    return created
+
+def generate_dataset(houses, apartments_per_house, meters_per_apartment, years, gap_rate=0.05,
+                     last_month=None, seed=None, address_prefix='Синтетическая ул.', batch_size=DATASET_BATCH_SIZE):
+    """
+    Создает houses домов по apartments_per_house квартир, у каждой meters_per_apartment счётчиков
+    с показаниями за years лет по last_month включительно. Возвращает id домов и кол-во созданных строк.
+    """
+    rng = random.Random(seed)
+    last_month = last_month or date.today().replace(day=1)
+    months = list(iter_months(last_month, years))
+    meter_types = ensure_reference_data()
+
+    counts = {'houses': 0, 'apartments': 0, 'meters': 0, 'readings': 0}
+    house_ids = []
+
+    first_number = House.objects.filter(address__startswith=address_prefix).count() + 1
+    for number in range(first_number, first_number + houses):
+        with transaction.atomic():
+            house = House.objects.create(address=f'{address_prefix}, д. {number}')
+            apartment_objects = Apartment.objects.bulk_create([
+                Apartment(house=house, number=apartment_number,
+                          area=Decimal(rng.randint(2500, 12000)) / 100)
+                for apartment_number in range(1, apartments_per_house + 1)
+            ], batch_size=batch_size)
+            meters = Meter.objects.bulk_create([
+                Meter(apartment=apartment, meter_number=f'{house.id}-{apartment.number}-{index}',
+                      meter_type=meter_types[index % len(meter_types)])
+                for apartment in apartment_objects for index in range(meters_per_apartment)
+            ], batch_size=batch_size)
+            readings = bulk_create_in_batches(
+                MeterReading,
+                generate_readings([(meter, index % meters_per_apartment) for index, meter in enumerate(meters)],
+                                  months, gap_rate, rng),
+                batch_size
+            )
+            refresh_consumption([(meter.id, months[0]) for meter in meters])
+
+        house_ids.append(house.id)
+        counts['houses'] += 1
+        counts['apartments'] += len(apartment_objects)
+        counts['meters'] += len(meters)
+        counts['readings'] += readings
+
+    return house_ids, counts
@@ -0,0 +1,173 @@
+"""
+Профилирование расчета квитанций по этапам (загрузка, расчет, запись).
+
+Включается для отдельного запуска: время каждого этапа суммируется по всем пачкам квартир,
+время вложенного этапа (например, estimate_averages внутри calculate) не входит во время внешнего,
+поэтому доли этапов в сумме не превышают 100%; дополнительно можно снять профиль cProfile и пик памяти tracemalloc. Без профилирования
+используется NULL_PROFILER, этапы которого ничего не делают.
+"""
+import cProfile
+import pstats
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+# Дополнительные инструменты профилирования
+TOOL_CPROFILE = 'cprofile'
+TOOL_TRACEMALLOC = 'tracemalloc'
+PROFILE_TOOLS = (TOOL_CPROFILE, TOOL_TRACEMALLOC)
+
+# Кол-во функций cProfile и строк tracemalloc в сохраненном профиле
+PROFILE_TOP = 25
+
+class NullProfiler:
+    """
+    Профилирование выключено
+    """
+    def __init__(self):
+        self.context = nullcontext()
+
+    def stage(self, name):
+        return self.context
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def to_dict(self):
+        return None
+
+NULL_PROFILER = NullProfiler()
+
+class CalculationProfiler:
+    """
+    Время по этапам расчета и, по выбору, профиль cProfile и снимок памяти tracemalloc
+    """
+    def __init__(self, tools=(), top=PROFILE_TOP):
+        unknown = set(tools) - set(PROFILE_TOOLS)
+        if unknown:
+            raise ValueError(f"Неизвестные инструменты профилирования: {', '.join(sorted(unknown))}")
+
+        self.tools = [tool for tool in PROFILE_TOOLS if tool in tools]
+        self.top = top
+        self.stages = {}
+        # Время вложенных этапов по открытым этапам (стек)
+        self.nested = []
+        self.started_at = None
+        self.duration = None
+        self.cprofile = None
+        self.cprofile_stats = None
+        self.tracemalloc_started = False
+        self.memory = None
+
+    @contextmanager
+    def stage(self, name):
+        started_at = time.perf_counter()
+        self.nested.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started_at
+            nested = self.nested.pop()
+            if self.nested:
+                self.nested[-1] += elapsed
+            stage = self.stages.setdefault(name, [0.0, 0])
+            stage[0] += elapsed - nested
+            stage[1] += 1
+
+    def start(self):
+        if TOOL_TRACEMALLOC in self.tools:
+            # tracemalloc мог быть запущен снаружи (например, бенчмарком), тогда только сбрасываем пик
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.start()
+                self.tracemalloc_started = True
+
+        if TOOL_CPROFILE in self.tools:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+        self.started_at = time.perf_counter()
+
+    def stop(self):
+        self.duration = time.perf_counter() - self.started_at
+
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile_stats = self.get_cprofile_stats()
+            self.cprofile = None
+
+        if TOOL_TRACEMALLOC in self.tools and tracemalloc.is_tracing():
+            self.memory = self.get_memory_stats()
+            if self.tracemalloc_started:
+                tracemalloc.stop()
+                self.tracemalloc_started = False
+
+    def get_cprofile_stats(self):
+        """
+        Функции с наибольшим накопленным временем
+        """
+        stats = pstats.Stats(self.cprofile)
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:self.top]
+        return [
+            {
+                'function': f'{filename}:{line}({name})',
+                'calls': calls,
+                'total_seconds': round(total_time, 6),
+                'cumulative_seconds': round(cumulative_time, 6),
+            }
+            for (filename, line, name), (_, calls, total_time, cumulative_time, _) in rows
+        ]
+
+    def get_memory_stats(self):
+        """
+        Пик памяти Python за расчет и строки кода, удерживающие больше всего памяти к его концу
+        """
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ])
+        return {
+            'peak_kb': round(peak / 1024, 1),
+            'top': [
+                {
+                    'location': f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}',
+                    'size_kb': round(stat.size / 1024, 1),
+                    'count': stat.count,
+                }
+                for stat in snapshot.statistics('lineno')[:self.top]
+            ],
+        }
+
+    def to_dict(self):
+        duration = self.duration or 0
+        profile = {
+            'tools': self.tools,
+            'duration_seconds': round(duration, 6),
+            'stages': {
+                name: {
+                    'seconds': round(seconds, 6),
+                    'calls': calls,
+                    'share': round(seconds / duration, 4) if duration else 0,
+                }
+                for name, (seconds, calls) in self.stages.items()
+            },
+        }
+        if self.cprofile_stats is not None:
+            profile['cprofile'] = self.cprofile_stats
+        if self.memory is not None:
+            profile['tracemalloc'] = self.memory
+        return profile
+
+def create_profiler(tools=None):
+    """
+    tools=None — профилирование выключено, список (в т.ч. пустой) — время по этапам
+    и перечисленные инструменты
+    """
+    if tools is None:
+        return NULL_PROFILER
+    return CalculationProfiler(tools)
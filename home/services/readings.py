@@ -0,0 +1,113 @@
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Min, Q, Window
+from django.db.models.functions import RowNumber
+from home.models import Meter, MeterReading
+
+PERIOD_FORMAT = '%Y-%m'
+
+# Значения параметра readings: все показания или без показаний
+READINGS_ALL = 'all'
+READINGS_NONE = 'none'
+
+class ReadingError(ValueError):
+    pass
+
+def parse_period(period):
+    """
+    'YYYY-MM' -> первое число месяца
+    """
+    return datetime.strptime(period, PERIOD_FORMAT).date()
+
+def format_period(value):
+    return value.strftime(PERIOD_FORMAT)
+
+def get_allowed_months(now=None):
+    """
+    Текущий и предыдущий месяц — допустимые месяцы первого показания счетчика
+    """
+    now = now or datetime.now()
+    return now.strftime(PERIOD_FORMAT), (now - relativedelta(months=1)).strftime(PERIOD_FORMAT)
+
+def check_new_reading(month, value, earliest_month=None, exists=False, allowed_months=None):
+    """
+    Правила приема нового показания:
+      - значение не может быть отрицательным
+      - если показаний нет, месяц текущий или предыдущий
+      - если показания есть, месяц не меньше самого раннего
+      - за месяц еще нет показаний
+    """
+    if value < 0:
+        raise ReadingError(f"Показания за {month} не могут быть отрицательными.")
+
+    current_month, previous_month = allowed_months or get_allowed_months()
+
+    if earliest_month is None:
+        if month != current_month and month != previous_month:
+            raise ReadingError(
+                f"Показания могут быть только за текущий ({current_month}) или предыдущий месяц ({previous_month}).")
+    elif month < earliest_month:
+        raise ReadingError(
+            f"Новый месяц ({month}) не может быть меньше самого раннего ({earliest_month}) в существующих показаниях.")
+
+    if exists:
+        raise ReadingError(f"Показания за {month} уже существуют.")
+
+@transaction.atomic
+def append_reading(meter_id, month, value):
+    """
+    Добавление одного показания. Строка счетчика блокируется (SELECT ... FOR UPDATE), поэтому проверки
+    и вставка выполняются атомарно: одновременные передачи по одному счетчику не теряются и не дублируются,
+    передачи по разным счетчикам друг друга не ждут.
+    """
+    period = parse_period(month)
+
+    list(Meter.objects.select_for_update().filter(id=meter_id).values_list('id', flat=True))
+
+    state = MeterReading.objects.filter(meter_id=meter_id).aggregate(
+        earliest=Min('period'),
+        exists=Count('id', filter=Q(period=period))
+    )
+    earliest_month = format_period(state['earliest']) if state['earliest'] else None
+    check_new_reading(month, value, earliest_month, state['exists'] > 0)
+
+    try:
+        with transaction.atomic():
+            return MeterReading.objects.create(meter_id=meter_id, period=period, value=value)
+    except IntegrityError:
+        # Уникальность (счетчик, месяц) — последняя линия защиты
+        raise ReadingError(f"Показания за {month} уже существуют.")
+
+def get_readings_window(include=None, since=None, last=None):
+    """
+    QuerySet показаний для prefetch по параметрам запроса (строкам):
+      - include='none' — показания не загружаются
+      - since='YYYY-MM' — показания начиная с месяца
+      - last=N — N последних показаний каждого счетчика (ROW_NUMBER() по счетчику в том же запросе)
+    """
+    readings = MeterReading.objects.all()
+
+    if include not in (None, READINGS_ALL, READINGS_NONE):
+        raise ReadingError(f"Параметр readings должен быть одним из: {READINGS_ALL}, {READINGS_NONE}.")
+    if include == READINGS_NONE:
+        return readings.none()
+
+    if since:
+        try:
+            readings = readings.filter(period__gte=parse_period(since))
+        except ValueError:
+            raise ReadingError("Параметр readings_since должен быть в формате YYYY-MM.")
+
+    if last:
+        try:
+            last = int(last)
+        except ValueError:
+            last = 0
+        if last <= 0:
+            raise ReadingError("Параметр readings_last должен быть положительным целым числом.")
+        readings = (readings
+                    .annotate(position=Window(RowNumber(), partition_by=F('meter_id'), order_by=F('period').desc()))
+                    .filter(position__lte=last))
+
+    return readings
@@ -0,0 +1,176 @@
+import codecs
+import csv
+import json
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from django.db import transaction
+from django.db.models import Min
+from home.models import Apartment, Meter, MeterReading
+from home.services.readings import parse_period, format_period, get_allowed_months, check_new_reading, ReadingError
+from home.services.response_cache import bump_house_versions
+from home.services.stale_bills import mark_stale_for_readings
+from home.services.consumption import refresh_consumption
+
+FORMAT_CSV = 'csv'
+FORMAT_NDJSON = 'ndjson'
+FORMATS = (FORMAT_CSV, FORMAT_NDJSON)
+
+# Кол-во строк, проверяемых и записываемых за один проход
+IMPORT_BATCH_SIZE = 5000
+# Кол-во ошибок, которые попадают в отчет построчно; сверх этого учитывается только их кол-во (failed)
+IMPORT_MAX_ERRORS = 1000
+
+def detect_format(filename, default=FORMAT_CSV):
+    if filename and filename.lower().endswith(('.ndjson', '.jsonl')):
+        return FORMAT_NDJSON
+    if filename and filename.lower().endswith('.csv'):
+        return FORMAT_CSV
+    return default
+
+def iter_text_lines(stream, encoding='utf-8-sig'):
+    """
+    Построчное чтение бинарного потока (загруженного файла) без чтения его целиком в память
+    """
+    return codecs.iterdecode(stream, encoding)
+
+def iter_csv_rows(lines):
+    """
+    Строки CSV с заголовком meter_id,period,value: (номер строки, dict)
+    """
+    reader = csv.DictReader(lines)
+    for row in reader:
+        yield reader.line_num, row
+
+def iter_ndjson_rows(lines):
+    """
+    Строки NDJSON вида {"meter_id": 1, "period": "2024-06", "value": 150}: (номер строки, dict или ошибка)
+    """
+    for line_num, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield line_num, "Строка не является корректным JSON."
+            continue
+        yield line_num, row if isinstance(row, dict) else "Строка должна быть JSON-объектом."
+
+def iter_rows(lines, file_format):
+    if file_format == FORMAT_NDJSON:
+        return iter_ndjson_rows(lines)
+    return iter_csv_rows(lines)
+
+def parse_row(row):
+    """
+    Разбор строки файла в (meter_id, 'YYYY-MM', date, Decimal)
+    """
+    if not isinstance(row, dict):
+        raise ReadingError(row)
+
+    try:
+        meter_id = int(row.get('meter_id'))
+    except (TypeError, ValueError):
+        raise ReadingError("Некорректный meter_id.")
+
+    month = str(row.get('period') or '').strip()
+    try:
+        period = parse_period(month)
+    except ValueError:
+        raise ReadingError(f"Месяц {month} должен быть в формате YYYY-MM.")
+
+    try:
+        value = Decimal(str(row.get('value')).strip())
+    except InvalidOperation:
+        raise ReadingError("Некорректное значение показания.")
+    if not value.is_finite() or value.as_tuple().exponent < -3 or abs(value) >= 10 ** 9:
+        raise ReadingError("Показание должно быть числом не более чем с 3 знаками после запятой.")
+
+    return meter_id, format_period(period), period, value
+
+@transaction.atomic
+def import_batch(rows, allowed_months):
+    """
+    Проверка пачки по тем же правилам, что и при передаче показаний через API, и запись одним bulk_create.
+    Возвращает (кол-во записанных строк, ошибки по строкам).
+    """
+    errors = []
+    parsed = []
+
+    for line_num, row in rows:
+        try:
+            parsed.append((line_num, *parse_row(row)))
+        except ReadingError as e:
+            errors.append({'row': line_num, 'error': str(e)})
+
+    meter_ids = {meter_id for _, meter_id, _, _, _ in parsed}
+    periods = {period for _, _, _, period, _ in parsed}
+
+    # Три запроса на пачку: существующие счетчики (с блокировкой строк, как при добавлении одного показания),
+    # самые ранние месяцы, уже внесенные показания
+    known_meters = dict(Meter.objects.select_for_update().filter(id__in=meter_ids).order_by('id')
+                        .values_list('id', 'apartment_id'))
+    earliest = {
+        meter_id: format_period(earliest_period)
+        for meter_id, earliest_period in (MeterReading.objects
+                                          .filter(meter_id__in=meter_ids)
+                                          .values('meter_id')
+                                          .annotate(earliest=Min('period'))
+                                          .values_list('meter_id', 'earliest'))
+    }
+    existing = set(MeterReading.objects
+                   .filter(meter_id__in=meter_ids, period__in=periods)
+                   .values_list('meter_id', 'period'))
+
+    readings = []
+    for line_num, meter_id, month, period, value in parsed:
+        if meter_id not in known_meters:
+            errors.append({'row': line_num, 'error': f"Счётчик {meter_id} не найден."})
+            continue
+
+        try:
+            check_new_reading(month, value, earliest.get(meter_id), (meter_id, period) in existing, allowed_months)
+        except ReadingError as e:
+            errors.append({'row': line_num, 'error': str(e)})
+            continue
+
+        # Учитываем принятые строки для следующих строк того же файла
+        existing.add((meter_id, period))
+        earliest[meter_id] = min(earliest.get(meter_id, month), month)
+        readings.append(MeterReading(meter_id=meter_id, period=period, value=value))
+
+    # Без ignore_conflicts: строки счетчиков заблокированы и проверены, а пропущенная вставка
+    # была бы учтена как записанная
+    MeterReading.objects.bulk_create(readings)
+    # bulk_create не вызывает сигналы, поэтому расход, уже рассчитанные квитанции и версии домов обновляются явно
+    apartment_ids = {known_meters[reading.meter_id] for reading in readings}
+    refresh_consumption([(reading.meter_id, reading.period) for reading in readings])
+    mark_stale_for_readings([(known_meters[reading.meter_id], reading.period) for reading in readings])
+    if apartment_ids:
+        bump_house_versions(Apartment.objects.filter(id__in=apartment_ids).values_list('house_id', flat=True).distinct())
+
+    errors.sort(key=lambda error: error['row'])
+    return len(readings), errors
+
+def import_readings(lines, file_format=FORMAT_CSV, batch_size=IMPORT_BATCH_SIZE, max_errors=IMPORT_MAX_ERRORS):
+    """
+    Потоковый импорт показаний: файл читается и проверяется пачками по batch_size строк,
+    в памяти одновременно находится не больше одной пачки.
+    В отчете построчно только первые max_errors ошибок, failed — кол-во всех строк с ошибками.
+    """
+    allowed_months = get_allowed_months()
+    rows = iter_rows(lines, file_format)
+    report = {'total': 0, 'created': 0, 'failed': 0, 'errors': []}
+
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+
+        created, errors = import_batch(batch, allowed_months)
+        report['total'] += len(batch)
+        report['created'] += created
+        report['failed'] += len(errors)
+        report['errors'].extend(errors[:max(max_errors - len(report['errors']), 0)])
+
+    return report
@@ -0,0 +1,172 @@
+"""
+Справочные данные (тарифы и типы счётчиков) в памяти процесса.
+
+Таблицы маленькие и меняются редко, поэтому загружаются целиком двумя запросами
+и живут в процессе до инвалидации. При изменении тарифа или типа счётчика все процессы
+(web и воркеры Celery) получают сообщение через Redis pub/sub и сбрасывают свою копию;
+при REFERENCE_CACHE_BUS = 'local' сообщение доходит только до текущего процесса.
+REFERENCE_CACHE_TTL ограничивает срок жизни копии на случай потерянного сообщения.
+"""
+import logging
+import os
+import threading
+import time
+from django.conf import settings
+from home.models import MeterType, Tariff
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'communal_task:reference_data'
+MESSAGE_INVALIDATE = 'invalidate'
+
+BUS_LOCAL = 'local'
+BUS_REDIS = 'redis'
+
+# Пауза перед переподключением слушателя к Redis
+RECONNECT_DELAY = 5
+
+class LocalBus:
+    """
+    Шина в пределах одного процесса: подписчики вызываются сразу при публикации
+    """
+    def __init__(self):
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def notify(self, message):
+        for callback in self.subscribers:
+            callback(message)
+
+    def publish(self, message):
+        self.notify(message)
+
+class RedisBus(LocalBus):
+    """
+    Шина через Redis pub/sub: сообщения получают все процессы, подписанные на канал.
+    Слушатель — фоновый поток, запускается заново в дочернем процессе после fork (prefork Celery).
+    """
+    def __init__(self, url, channel=CHANNEL):
+        import redis
+        super().__init__()
+        self.redis = redis
+        self.client = redis.Redis.from_url(url)
+        self.channel = channel
+        self.listener_pid = None
+        self.lock = threading.Lock()
+
+    def subscribe(self, callback):
+        super().subscribe(callback)
+        self.start_listener()
+
+    def start_listener(self):
+        with self.lock:
+            if self.listener_pid == os.getpid():
+                return
+            self.listener_pid = os.getpid()
+            threading.Thread(target=self.listen, name='reference-cache-listener', daemon=True).start()
+
+    def listen(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # Пока слушатель не был подключен, сообщения могли быть потеряны
+                self.notify(MESSAGE_INVALIDATE)
+                for message in pubsub.listen():
+                    self.notify(message['data'].decode())
+            except self.redis.RedisError as e:
+                logger.warning("Нет подписки на %s, повтор через %s с: %s", self.channel, RECONNECT_DELAY, e)
+                time.sleep(RECONNECT_DELAY)
+
+    def publish(self, message):
+        # Текущий процесс сбрасывает копию сразу, не дожидаясь сообщения из Redis
+        self.notify(message)
+        try:
+            self.client.publish(self.channel, message)
+        except self.redis.RedisError as e:
+            logger.warning("Не удалось отправить %s в %s: %s", message, self.channel, e)
+
+def create_bus():
+    if settings.REFERENCE_CACHE_BUS == BUS_LOCAL:
+        return LocalBus()
+    if settings.REFERENCE_CACHE_BUS == BUS_REDIS:
+        return RedisBus(settings.REFERENCE_CACHE_REDIS_URL)
+    raise ValueError(f"Неизвестная шина справочного кэша: {settings.REFERENCE_CACHE_BUS}")
+
+class ReferenceData:
+    def __init__(self, tariffs, meter_types):
+        self.tariffs = tariffs
+        self.meter_types = meter_types
+
+class ReferenceCache:
+    def __init__(self):
+        self.data = None
+        self.loaded_at = 0
+        # Увеличивается при каждой инвалидации: загрузка, начатая до нее, не сохраняется
+        self.generation = 0
+        self.bus = None
+        self.lock = threading.Lock()
+
+    def get_bus(self):
+        with self.lock:
+            if self.bus is None:
+                self.bus = create_bus()
+                self.bus.subscribe(self.on_message)
+        return self.bus
+
+    def get(self):
+        data = self.data
+        if data is None or time.monotonic() - self.loaded_at > settings.REFERENCE_CACHE_TTL:
+            data = self.load()
+        return data
+
+    def load(self):
+        self.get_bus()
+        generation = self.generation
+
+        meter_types = {meter_type.id: meter_type for meter_type in MeterType.objects.all()}
+        tariffs = list(Tariff.objects.order_by('id'))
+        for tariff in tariffs:
+            if tariff.meter_type_id is not None:
+                tariff.meter_type = meter_types.get(tariff.meter_type_id)
+
+        data = ReferenceData(tariffs, meter_types)
+        with self.lock:
+            if generation == self.generation:
+                self.data = data
+                self.loaded_at = time.monotonic()
+        return data
+
+    def on_message(self, message):
+        if message == MESSAGE_INVALIDATE:
+            self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.data = None
+
+    def invalidate(self):
+        """
+        Сброс копий справочников во всех процессах
+        """
+        self.get_bus().publish(MESSAGE_INVALIDATE)
+
+reference_cache = ReferenceCache()
+
+def get_tariffs():
+    """
+    Все тарифы с подставленными типами счётчиков. Объекты общие для процесса — не изменять.
+    """
+    return reference_cache.get().tariffs
+
+def get_meter_types():
+    return reference_cache.get().meter_types
+
+def get_meter_type(meter_type_id):
+    return get_meter_types().get(meter_type_id)
+
+def invalidate_reference_cache():
+    reference_cache.invalidate()
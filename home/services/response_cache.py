@@ -0,0 +1,97 @@
+"""
+Кэш ответов GET для данных дома (квартиры, счётчики, показания).
+
+У каждого дома есть счетчик версии в кэше Django, он увеличивается после фиксации транзакции,
+изменившей дом, его квартиры, счётчики или показания; общая версия справочников увеличивается
+при изменении типов счётчиков. ETag ответа строится из пути запроса и этих версий, поэтому
+для If-None-Match достаточно одного обращения к кэшу, а готовые данные ответа хранятся
+в кэше под ключом ETag до следующего изменения.
+"""
+import hashlib
+import time
+from django.core.cache import cache
+from django.db import transaction
+from home.models import Apartment
+
+REFERENCE_VERSION_KEY = 'version:reference'
+
+def house_version_key(house_id):
+    return f'version:house:{house_id}'
+
+def apartment_house_key(apartment_id):
+    return f'apartment_house:{apartment_id}'
+
+def response_key(etag):
+    return f'response:{etag}'
+
+def new_version():
+    # Начальное значение по времени: после вытеснения счетчика из кэша версии не повторяются
+    return time.time_ns() // 1000
+
+def get_versions(keys):
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        for key in missing:
+            cache.add(key, new_version(), timeout=None)
+        # Счетчик мог создать параллельный запрос, перечитываем
+        versions.update(cache.get_many(missing))
+    return [versions.get(key) for key in keys]
+
+def get_house_versions(house_id):
+    return get_versions([house_version_key(house_id), REFERENCE_VERSION_KEY])
+
+def bump_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, new_version(), timeout=None)
+
+def bump_house_versions(house_ids):
+    """
+    Новая версия домов после фиксации текущей транзакции: запрос, прочитавший версию
+    до фиксации, сохранит ответ под старой версией, которая больше не будет запрошена
+    """
+    house_ids = {house_id for house_id in house_ids if house_id is not None}
+    if house_ids:
+        transaction.on_commit(lambda: [bump_version(house_version_key(house_id)) for house_id in house_ids])
+
+def bump_reference_version():
+    transaction.on_commit(lambda: bump_version(REFERENCE_VERSION_KEY))
+
+def discard_house_cache(house_id, apartment_ids):
+    """
+    Сброс кэша дома, которого нет в БД (например, созданного в откаченной транзакции): версия
+    увеличивается сразу, без ожидания фиксации, соответствие квартира -> дом удаляется
+    """
+    bump_version(house_version_key(house_id))
+    cache.delete_many([apartment_house_key(apartment_id) for apartment_id in apartment_ids])
+
+def get_apartment_house_id(apartment_id):
+    """
+    ID дома квартиры из кэша, при промахе — одним запросом
+    """
+    key = apartment_house_key(apartment_id)
+    house_id = cache.get(key)
+    if house_id is None:
+        house_id = Apartment.objects.filter(id=apartment_id).values_list('house_id', flat=True).first()
+        if house_id is not None:
+            cache.set(key, house_id, timeout=None)
+    return house_id
+
+def set_apartment_house_id(apartment_id, house_id):
+    if house_id is None:
+        cache.delete(apartment_house_key(apartment_id))
+    else:
+        cache.set(apartment_house_key(apartment_id), house_id, timeout=None)
+
+def make_etag(path, versions):
+    digest = hashlib.md5(f'{path}:{versions}'.encode()).hexdigest()
+    return f'"{digest}"'
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return etag in (tag.strip().removeprefix('W/') for tag in if_none_match.split(','))
@@ -0,0 +1,119 @@
+from collections import defaultdict
+from dateutil.relativedelta import relativedelta
+from django.db.models import Max
+from django.utils import timezone
+from home.models import Meter, StaleBill, UtilityBill
+from home.services.analytics import refresh_house_rollups
+from home.services.calc_tarif import calculate_utility_bills_for_house, AVERAGE_MONTHS
+
+# Кол-во устаревших квитанций, пересчитываемых за один проход
+STALE_BATCH_SIZE = 1000
+
+REASON_READING = 'reading'
+REASON_AREA = 'area'
+REASON_TARIFF = 'tariff'
+
+def mark_stale(bills, reason):
+    """
+    Помечает устаревшими уже рассчитанные квитанции: bills — пары (apartment_id, month)
+    """
+    marked_at = timezone.now()
+    StaleBill.objects.bulk_create(
+        [StaleBill(apartment_id=apartment_id, month=month, reason=reason, marked_at=marked_at)
+         for apartment_id, month in bills],
+        update_conflicts=True,
+        unique_fields=['apartment', 'month'],
+        update_fields=['reason', 'marked_at']
+    )
+
+def mark_stale_for_readings(readings):
+    """
+    Показание за месяц P влияет на квитанции за P (текущее показание), P+1 (предыдущее показание)
+    и до P+AVERAGE_MONTHS (оценка по среднему при пропуске). readings — пары (apartment_id, period).
+    """
+    affected = defaultdict(list)
+    for apartment_id, period in readings:
+        affected[apartment_id].append((period, period + relativedelta(months=AVERAGE_MONTHS)))
+
+    if not affected:
+        return
+
+    month_from = min(start for ranges in affected.values() for start, _ in ranges)
+    month_to = max(end for ranges in affected.values() for _, end in ranges)
+
+    bills = (UtilityBill.objects
+             .filter(apartment_id__in=affected.keys(), month__range=(month_from, month_to))
+             .values_list('apartment_id', 'month'))
+
+    mark_stale(
+        [(apartment_id, month) for apartment_id, month in bills
+         if any(start <= month <= end for start, end in affected[apartment_id])],
+        REASON_READING
+    )
+
+def mark_stale_for_apartment(apartment_id):
+    """
+    Исправленная площадь квартиры была неверной во всех ее квитанциях
+    """
+    mark_stale(UtilityBill.objects.filter(apartment_id=apartment_id).values_list('apartment_id', 'month'),
+               REASON_AREA)
+
+def mark_stale_for_tariff(tariff):
+    """
+    Тарифы не хранят историю цен, поэтому новая цена относится к последнему рассчитанному месяцу:
+    закрытые месяцы не пересчитываются по новой цене задним числом.
+    Тариф по счетчикам начисляется только квартирам со счетчиком его типа, тариф по площади — всем квартирам.
+    """
+    last_month = UtilityBill.objects.aggregate(last_month=Max('month'))['last_month']
+    if last_month is None:
+        return
+
+    bills = UtilityBill.objects.filter(month=last_month)
+    if tariff.meter_type_id is not None:
+        bills = bills.filter(apartment__in=Meter.objects.filter(meter_type_id=tariff.meter_type_id)
+                                                         .values('apartment_id'))
+    mark_stale(bills.values_list('apartment_id', 'month'), REASON_TARIFF)
+
+def recalculate_stale_bills(batch_size=STALE_BATCH_SIZE):
+    """
+    Пересчет только устаревших квитанций пачками по batch_size: внутри пачки квартиры группируются
+    по (дом, месяц) и считаются тем же движком, что и полный расчет дома.
+    Проход ограничен пометками, существовавшими на его начало, и идет по возрастанию id: пометка,
+    оставшаяся после пересчета (сделана во время прохода или расчет не удался), ждет следующего прохода.
+    """
+    recalculated = 0
+    failed = []
+    houses = set()
+
+    last_id = StaleBill.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+    after_id = 0
+    while True:
+        stale = list(StaleBill.objects
+                     .filter(id__gt=after_id, id__lte=last_id)
+                     .order_by('id')
+                     .values_list('id', 'apartment_id', 'apartment__house_id', 'month')[:batch_size])
+        if not stale:
+            break
+        after_id = stale[-1][0]
+
+        groups = defaultdict(list)
+        for _, apartment_id, house_id, month in stale:
+            groups[(house_id, month)].append(apartment_id)
+
+        for (house_id, month), apartment_ids in groups.items():
+            try:
+                result = calculate_utility_bills_for_house(house_id, month.year, month.month,
+                                                           apartment_ids=apartment_ids)
+            except Exception as e:
+                failed.extend((apartment_id, str(e)) for apartment_id in apartment_ids)
+                continue
+            recalculated += len(result)
+            houses.add((house_id, month))
+
+    for house_id, month in houses:
+        refresh_house_rollups(house_id, month)
+
+    return {
+        'recalculated': recalculated,
+        'failed': [{'apartment_id': apartment_id, 'error': error} for apartment_id, error in failed]
+    }
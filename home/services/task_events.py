@@ -0,0 +1,238 @@
+"""
+События хода расчета задачи (прогресс по пачкам квартир, итог или ошибка) для потоковой выдачи клиентам.
+
+Задача публикует каждое событие в канал задачи Redis pub/sub и сохраняет его как последнее состояние
+(с TTL). Ожидающий клиент держит одну подписку на канал: последнее состояние читается из Redis,
+дальше события приходят по подписке, без повторных чтений БД. При TASK_EVENTS_BUS = 'local'
+события доставляются только внутри текущего процесса (разработка и тесты).
+У каждого события задачи возрастающий номер seq: клиент продолжает с последнего полученного.
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_PREFIX = 'communal_task:task_events:'
+
+EVENT_PROGRESS = 'progress'
+EVENT_STATUS = 'status'
+EVENT_DONE = 'done'
+EVENT_ERROR = 'error'
+# После этих событий новых событий задачи не будет
+FINAL_EVENTS = (EVENT_DONE, EVENT_ERROR)
+
+BUS_LOCAL = 'local'
+BUS_REDIS = 'redis'
+
+def make_event(task_id, seq, event, data):
+    return {'task_id': task_id, 'seq': seq, 'event': event, 'data': data}
+
+def is_final(event):
+    return event['event'] in FINAL_EVENTS
+
+def dump_event(event):
+    return json.dumps(event, cls=DjangoJSONEncoder, ensure_ascii=False)
+
+class LocalSubscription:
+    def __init__(self, bus, task_id):
+        self.bus = bus
+        self.task_id = task_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+
+    async def get(self, timeout):
+        """
+        Следующее событие или None, если за timeout секунд событий не было
+        """
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def close(self):
+        self.bus.unsubscribe(self)
+
+class LocalBus:
+    """
+    События в пределах одного процесса; публикация возможна из любого потока
+    """
+    def __init__(self):
+        self.events = {}
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+
+    def publish(self, task_id, event, data):
+        with self.lock:
+            seq = self.events[task_id]['seq'] + 1 if task_id in self.events else 1
+            message = self.events[task_id] = make_event(task_id, seq, event, data)
+            subscriptions = list(self.subscriptions.get(task_id, ()))
+        # Через JSON, как и при доставке через Redis
+        message = json.loads(dump_event(message))
+        for subscription in subscriptions:
+            subscription.loop.call_soon_threadsafe(subscription.queue.put_nowait, message)
+        return message
+
+    async def aget_last(self, task_id):
+        with self.lock:
+            event = self.events.get(task_id)
+        return json.loads(dump_event(event)) if event else None
+
+    async def subscribe(self, task_id):
+        subscription = LocalSubscription(self, task_id)
+        with self.lock:
+            self.subscriptions.setdefault(task_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.task_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.subscriptions.pop(subscription.task_id, None)
+
+class RedisSubscription:
+    def __init__(self, client, pubsub):
+        self.client = client
+        self.pubsub = pubsub
+
+    async def get(self, timeout):
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=remaining)
+            if message is not None:
+                return json.loads(message['data'])
+        return None
+
+    async def close(self):
+        await self.pubsub.aclose()
+        await self.client.aclose()
+
+class RedisBus:
+    """
+    События через Redis: номер события — INCR, последнее событие — ключ с TTL, доставка — PUBLISH.
+    Публикация синхронная (задачи Celery), подписка асинхронная (ASGI).
+    """
+    def __init__(self, url, ttl):
+        import redis
+        self.redis = redis
+        self.url = url
+        self.ttl = ttl
+        self.client = redis.Redis.from_url(url)
+
+    def publish(self, task_id, event, data):
+        channel = f'{CHANNEL_PREFIX}{task_id}'
+        try:
+            seq = self.client.incr(f'{channel}:seq')
+            message = make_event(task_id, seq, event, data)
+            payload = dump_event(message)
+            pipeline = self.client.pipeline(transaction=False)
+            pipeline.expire(f'{channel}:seq', self.ttl)
+            pipeline.set(f'{channel}:last', payload, ex=self.ttl)
+            pipeline.publish(channel, payload)
+            pipeline.execute()
+        except self.redis.RedisError as e:
+            # Ход расчета не должен зависеть от доставки событий
+            logger.warning("Не удалось отправить событие %s задачи %s: %s", event, task_id, e)
+            return None
+        return json.loads(payload)
+
+    def get_async_client(self):
+        # Клиент на время запроса: соединения redis.asyncio привязаны к циклу событий
+        from redis import asyncio as aioredis
+        return aioredis.Redis.from_url(self.url)
+
+    async def aget_last(self, task_id):
+        client = self.get_async_client()
+        try:
+            payload = await client.get(f'{CHANNEL_PREFIX}{task_id}:last')
+        finally:
+            await client.aclose()
+        return json.loads(payload) if payload else None
+
+    async def subscribe(self, task_id):
+        client = self.get_async_client()
+        pubsub = client.pubsub()
+        await pubsub.subscribe(f'{CHANNEL_PREFIX}{task_id}')
+        return RedisSubscription(client, pubsub)
+
+buses = {}
+buses_lock = threading.Lock()
+
+def get_bus():
+    with buses_lock:
+        bus = buses.get(settings.TASK_EVENTS_BUS)
+        if bus is None:
+            if settings.TASK_EVENTS_BUS == BUS_LOCAL:
+                bus = LocalBus()
+            elif settings.TASK_EVENTS_BUS == BUS_REDIS:
+                bus = RedisBus(settings.TASK_EVENTS_REDIS_URL, settings.TASK_EVENTS_TTL)
+            else:
+                raise ValueError(f"Неизвестная шина событий задач: {settings.TASK_EVENTS_BUS}")
+            buses[settings.TASK_EVENTS_BUS] = bus
+    return bus
+
+def publish_task_event(task_id, event, data):
+    """
+    Публикация события задачи; возвращает событие с номером (None, если отправить не удалось)
+    """
+    return get_bus().publish(task_id, event, data)
+
+def get_progress_data(progress):
+    """
+    Данные события прогресса — в том же виде, что и ответ опроса статуса расчета
+    """
+    return {
+        'status': 'Расчет квартплаты выполняется',
+        'progress': {
+            'house_id': progress.house_id,
+            'processed_apartments': progress.processed_apartments,
+            'total_apartments': progress.total_apartments,
+            'last_apartment_id': progress.last_apartment_id,
+        },
+    }
+
+async def iter_task_events(task_id, after=None, timeout=None, get_initial=None):
+    """
+    События задачи с номером больше after (None — у клиента нет событий, сначала отдается текущее
+    состояние), затем новые по подписке. Завершается после итогового события; None — за
+    TASK_EVENTS_KEEPALIVE секунд событий не было (для поддержания соединения).
+    timeout ограничивает общее время ожидания.
+    get_initial — корутина (task_id) -> событие с seq 0 для задачи без сохраненных событий
+    (например, состояние из бэкенда результатов); вызывается один раз.
+    """
+    bus = get_bus()
+    deadline = time.monotonic() + (timeout if timeout is not None else settings.TASK_EVENTS_STREAM_TIMEOUT)
+
+    # Подписка до чтения последнего события: событие между чтением и подпиской не теряется
+    subscription = await bus.subscribe(task_id)
+    try:
+        last = await bus.aget_last(task_id)
+        if last is None and get_initial is not None:
+            last = await get_initial(task_id)
+        if last is not None:
+            # Итоговое событие отдается и повторно: клиент, переподключившийся после него, завершает ожидание
+            if after is None or last['seq'] > after or is_final(last):
+                yield last
+            if is_final(last):
+                return
+            after = max(after or 0, last['seq'])
+        after = after or 0
+
+        while (remaining := deadline - time.monotonic()) > 0:
+            event = await subscription.get(min(remaining, settings.TASK_EVENTS_KEEPALIVE))
+            if event is None:
+                yield None
+                continue
+            if event['seq'] <= after:
+                continue
+            yield event
+            after = event['seq']
+            if is_final(event):
+                return
+    finally:
+        await subscription.close()
@@ -0,0 +1,42 @@
+"""
+Состояние и результат задач Celery (бэкенд результатов django-db) для опроса статуса расчета.
+"""
+from celery import current_app
+from celery.result import AsyncResult
+from django_celery_results.models import TaskResult
+from home.models import CalculationProgress
+
+# Задача еще не завершена: в ответе прогресс расчета
+UNFINISHED_STATES = ('PENDING', 'STARTED', 'RETRY')
+
+def get_task_state(task_id):
+    """
+    (состояние, результат) задачи; результат ошибки — исключение.
+    Результат незавершенной задачи не читается: AsyncResult делает для него еще один запрос.
+    """
+    task_result = AsyncResult(task_id)
+    state = task_result.state
+    if state in UNFINISHED_STATES:
+        return state, None
+    return state, task_result.result
+
+async def aget_task_state(task_id):
+    """
+    То же, что get_task_state, через async ORM: строка TaskResult читается без блокировки цикла событий
+    и декодируется бэкендом результатов
+    """
+    task_result = await TaskResult.objects.filter(task_id=task_id).afirst()
+    if task_result is None:
+        return 'PENDING', None
+
+    backend = current_app.backend
+    result = backend.decode_content(task_result, task_result.result)
+    if task_result.status in backend.EXCEPTION_STATES:
+        result = backend.exception_to_python(result)
+    return task_result.status, result
+
+def get_task_progress(task_id):
+    return CalculationProgress.objects.filter(task_id=task_id).order_by('-id').first()
+
+async def aget_task_progress(task_id):
+    return await CalculationProgress.objects.filter(task_id=task_id).order_by('-id').afirst()
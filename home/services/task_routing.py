@@ -0,0 +1,37 @@
+"""
+Очереди задач расчета по стоимости и происхождению.
+
+  - calc_interactive — расчет одного дома по запросу пользователя, небольшие дома;
+  - calc_large — расчет одного дома по запросу, стоимость больше CALC_LARGE_HOUSE_COST;
+  - calc_batch — расчет по городу, пересчет устаревших квитанций и пакетные запуски.
+Каждую очередь обслуживают свои воркеры (см. docker-compose.yml), поэтому расчет небольшого дома
+не ждет ни крупного дома, ни пакетного расчета. Стоимость — кол-во квартир и счётчиков дома:
+столько строк читается и записывается при расчете.
+"""
+from django.conf import settings
+from django.db.models import Count
+from home.models import House
+
+QUEUE_INTERACTIVE = 'calc_interactive'
+QUEUE_LARGE = 'calc_large'
+QUEUE_BATCH = 'calc_batch'
+
+ORIGIN_INTERACTIVE = 'interactive'
+ORIGIN_BATCH = 'batch'
+ORIGINS = (ORIGIN_INTERACTIVE, ORIGIN_BATCH)
+
+def estimate_house_cost(house_id):
+    """
+    Стоимость расчета дома (квартиры + счётчики) одним запросом; None, если дома нет
+    """
+    counts = (House.objects
+              .filter(id=house_id)
+              .annotate(apartments_count=Count('apartments', distinct=True), meters_count=Count('apartments__meters'))
+              .values_list('apartments_count', 'meters_count')
+              .first())
+    return sum(counts) if counts is not None else None
+
+def get_calculation_queue(cost, origin=ORIGIN_INTERACTIVE):
+    if origin == ORIGIN_BATCH:
+        return QUEUE_BATCH
+    return QUEUE_LARGE if cost > settings.CALC_LARGE_HOUSE_COST else QUEUE_INTERACTIVE
@@ -0,0 +1,113 @@
+from functools import partial
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from .models import House, Apartment, Meter, MeterReading, MeterType, Tariff, CalculationProgress
+from .services.reference_cache import reference_cache, invalidate_reference_cache
+from .services.response_cache import (bump_house_versions, bump_reference_version, get_apartment_house_id,
+                                      set_apartment_house_id)
+from .services.stale_bills import mark_stale_for_readings, mark_stale_for_apartment, mark_stale_for_tariff
+from .services.consumption import refresh_consumption
+from .services.task_events import publish_task_event, get_progress_data, EVENT_PROGRESS
+
+def remember_fields(sender, instance, *fields):
+  """
+  Сохраняет значения полей до изменения (одним запросом), чтобы в post_save понять, менялись ли они
+  """
+  previous = {}
+  if instance.pk:
+    previous = sender.objects.filter(pk=instance.pk).values(*fields).first() or {}
+  for field in fields:
+    setattr(instance, f'_previous_{field}', previous.get(field))
+
+def is_cascade(sender, origin):
+  """
+  Удаление вызвано удалением родительского объекта, а не самого объекта
+  """
+  return not (isinstance(origin, sender) or getattr(origin, 'model', None) is sender)
+
+@receiver(pre_save, sender=Apartment)
+def remember_apartment_fields(sender, instance, **kwargs):
+  remember_fields(sender, instance, 'area', 'house_id')
+
+@receiver(post_save, sender=Apartment)
+def apartment_area_changed(sender, instance, created, **kwargs):
+  if not created and instance._previous_area != instance.area:
+    mark_stale_for_apartment(instance.pk)
+
+@receiver(pre_save, sender=Tariff)
+def remember_tariff_price(sender, instance, **kwargs):
+  remember_fields(sender, instance, 'price_per_unit')
+
+@receiver(post_save, sender=Tariff)
+def tariff_price_changed(sender, instance, created, **kwargs):
+  if not created and instance._previous_price_per_unit != instance.price_per_unit:
+    mark_stale_for_tariff(instance)
+
+@receiver(pre_save, sender=MeterReading)
+def remember_reading_period(sender, instance, **kwargs):
+  remember_fields(sender, instance, 'period')
+
+@receiver(post_save, sender=MeterReading)
+def meter_reading_saved(sender, instance, created, **kwargs):
+  mark_stale_for_readings([(instance.meter.apartment_id, instance.period)])
+  # Расход меняется у этого показания и следующих; при переносе на другой месяц — начиная с более раннего
+  period = min(filter(None, [instance.period, instance._previous_period]))
+  refresh_consumption([(instance.meter_id, period)])
+
+@receiver(post_delete, sender=MeterReading)
+def meter_reading_deleted(sender, instance, origin=None, **kwargs):
+  # При каскадном удалении счётчика или квартиры квитанции не помечаются и расход не пересчитывается
+  if not is_cascade(sender, origin):
+    mark_stale_for_readings([(instance.meter.apartment_id, instance.period)])
+    refresh_consumption([(instance.meter_id, instance.period)])
+
+@receiver(post_save, sender=Tariff)
+@receiver(post_delete, sender=Tariff)
+@receiver(post_save, sender=MeterType)
+@receiver(post_delete, sender=MeterType)
+def reference_data_changed(sender, **kwargs):
+  # Копия текущего процесса сбрасывается сразу, остальные процессы — после фиксации транзакции
+  reference_cache.clear()
+  transaction.on_commit(invalidate_reference_cache)
+
+@receiver(post_save, sender=MeterType)
+@receiver(post_delete, sender=MeterType)
+def meter_type_changed(sender, **kwargs):
+  bump_reference_version()
+
+@receiver(post_save, sender=House)
+@receiver(post_delete, sender=House)
+def house_changed(sender, instance, **kwargs):
+  bump_house_versions([instance.pk])
+
+@receiver(post_save, sender=Apartment)
+def apartment_saved(sender, instance, **kwargs):
+  # Квартиру могли перенести в другой дом: меняются оба дома
+  bump_house_versions([instance.house_id, instance._previous_house_id])
+  set_apartment_house_id(instance.pk, instance.house_id)
+
+@receiver(post_delete, sender=Apartment)
+def apartment_deleted(sender, instance, **kwargs):
+  bump_house_versions([instance.house_id])
+  set_apartment_house_id(instance.pk, None)
+
+@receiver(post_save, sender=Meter)
+@receiver(post_delete, sender=Meter)
+def meter_changed(sender, instance, origin=None, **kwargs):
+  if origin is None or not is_cascade(sender, origin):
+    bump_house_versions([get_apartment_house_id(instance.apartment_id)])
+
+@receiver(post_save, sender=MeterReading)
+@receiver(post_delete, sender=MeterReading)
+def meter_reading_changed(sender, instance, origin=None, **kwargs):
+  # При каскадном удалении версию дома меняет удаление счётчика или квартиры
+  if origin is None or not is_cascade(sender, origin):
+    bump_house_versions([get_apartment_house_id(instance.meter.apartment_id)])
+
+@receiver(post_save, sender=CalculationProgress)
+def calculation_progress_saved(sender, instance, **kwargs):
+  # Контрольная точка пачки сохраняется в транзакции пачки: событие — после ее фиксации
+  if instance.task_id:
+    data = get_progress_data(instance)
+    transaction.on_commit(partial(publish_task_event, instance.task_id, EVENT_PROGRESS, data))
@@ -1,3 +1,1191 @@
-from django.test import TestCase
+import asyncio
+import csv
+import io
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from datetime import date
+from functools import partial
+from decimal import Decimal
+from unittest import skipIf
+from unittest.mock import patch
+from urllib.parse import parse_qs, urlencode, urlsplit
+from asgiref.sync import sync_to_async
+from celery import current_app
+from celery.exceptions import ChordError, Retry
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import OperationalError, connection, connections
+from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django_celery_results.models import TaskResult
+from kombu.serialization import dumps, loads
+from prometheus_client import values
+from .metrics import (render_metrics, get_process_identifier,
+                      worker_process_shutdown as metrics_worker_process_shutdown)
+from .mixins import VersionedCacheMixin
+from .models import (House, Apartment, Meter, MeterReading, MeterType, Tariff, UtilityBill, StaleBill,
+                     CalculationRun, CalculationProgress)
+from .celery_tasks import (run_house_calculation, calculate_utility_bills_for_house_task, calculate_houses_chunk_task,
+                           calculate_city_bills_task, close_month_task, finish_city_calculation_task)
+from .services.calc_numpy import np
+from .services.calc_tarif import (calculate_utility_bills_for_house, calculate_charges_decimal, calculate_meter_charge,
+                                   BILLS_BATCH_SIZE, ENGINE_DECIMAL)
+from .services.calculation_lock import start_house_calculation, release_house_calculation
+from .services.stale_bills import mark_stale, recalculate_stale_bills
+from .services.task_routing import (estimate_house_cost, get_calculation_queue, ORIGIN_BATCH, QUEUE_BATCH,
+                                    QUEUE_INTERACTIVE, QUEUE_LARGE)
+from .services.readings import append_reading, get_allowed_months, parse_period, ReadingError
+from .services.readings_import import import_readings, FORMAT_CSV, FORMAT_NDJSON
+from .services.bills_export import export_bills, EXPORT_FIELDS
+from .services.consumption import refresh_consumption, CONSUMPTION_FIELDS, CONSUMPTION_BATCH_SIZE
+from .services.profiling import CalculationProfiler, PROFILE_TOOLS
+from .services.reference_cache import (reference_cache, get_tariffs, invalidate_reference_cache, ReferenceCache,
+                                       LocalBus)
+from .services.task_events import buses as task_event_buses
+from .services.dataset import generate_dataset, METER_TYPES, AREA_TARIFFS
+from .services.benchmark import run_benchmark
+from .services.response_cache import apartment_house_key
 
-# Create your tests here.
+# Кол-во строк (домов, квартир, счётчиков, квитанций), на которых проверяется бюджет запросов:
+# бюджет не должен зависеть от объема данных
+SIZES = (10, 1000)
+
+# Страницы списков в админке: сессия, пользователь, счетчики страницы и фильтры
+ADMIN_BUDGETS = {
+  '/admin/home/meter/': 10,
+  '/admin/home/apartment/': 6,
+  '/admin/home/tariff/': 7,
+  '/admin/home/house/': 5,
+}
+
+
+class QueryBudgetTestCase(TestCase):
+  """
+  Каждый эндпоинт укладывается в фиксированное кол-во SQL-запросов при 10 и 1000 строк.
+  Рост кол-ва запросов вместе с кол-вом строк (N+1) ломает тест.
+  """
+  def setUp(self):
+    cache.clear()
+    reference_cache.clear()
+    task_event_buses.clear()
+
+  def create_dataset(self, size):
+    """
+    size домов; в первом доме size квартир, у каждой счётчик с тремя показаниями,
+    квитанция и пометка об устаревании
+    """
+    water = MeterType.objects.create(name='ХВС', unit='м3')
+    Tariff.objects.create(meter_type=water, price_per_unit=Decimal('40.50'))
+    Tariff.objects.create(custom_name=f'Содержание {size}', unit='м2', price_per_unit=Decimal('25.00'))
+
+    houses = House.objects.bulk_create([House(address=f'Дом {size}-{number}') for number in range(size)])
+    house = houses[0]
+    apartments = Apartment.objects.bulk_create([
+      Apartment(house=house, number=number, area=Decimal('45.50')) for number in range(size)
+    ])
+    meters = Meter.objects.bulk_create([
+      Meter(apartment=apartment, meter_number=f'M-{apartment.id}', meter_type=water) for apartment in apartments
+    ])
+    MeterReading.objects.bulk_create([
+      MeterReading(meter=meter, period=date(2024, month, 1), value=Decimal(month * 10))
+      for meter in meters for month in (6, 7, 8)
+    ])
+    UtilityBill.objects.bulk_create([
+      UtilityBill(apartment=apartment, month=date(2024, 8, 1), charge=[]) for apartment in apartments
+    ])
+    StaleBill.objects.bulk_create([
+      StaleBill(apartment=apartment, month=date(2024, 8, 1), reason='reading', marked_at=timezone.now())
+      for apartment in apartments
+    ])
+    run = CalculationRun.objects.create(year=2024, month=8, house_ids=[house.id], houses_total=1)
+    CalculationProgress.objects.create(run=run, house_id=house.id, year=2024, month=8, status='ошибка',
+                                       error_message='Ошибка', task_id=f'task-{size}', profile={'stages': {}})
+
+    return house, apartments[0], meters[0], water, run
+
+  def insert_batches(self, model, rows, batch_size=None):
+    """
+    Кол-во INSERT при bulk_create: бэкенд может ограничивать кол-во параметров в запросе (SQLite)
+    """
+    fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+    max_batch_size = connection.ops.bulk_batch_size(fields, [None] * rows)
+    return math.ceil(rows / min(batch_size or max_batch_size, max_batch_size))
+
+  def update_batches(self, fields, rows, batch_size):
+    """
+    Кол-во UPDATE при bulk_update (ограничение кол-ва параметров в запросе, как у insert_batches)
+    """
+    max_batch_size = connection.ops.bulk_batch_size(['pk', 'pk'] + fields, [None] * rows)
+    return math.ceil(rows / min(batch_size, max_batch_size))
+
+  def assertQueryBudget(self, budget, method, url, data=None, **kwargs):
+    with CaptureQueriesContext(connection) as queries:
+      response = getattr(self.client, method)(url, data, **kwargs)
+      if response.streaming:
+        b''.join(response.streaming_content)
+
+    self.assertLess(response.status_code, 400, getattr(response, 'content', b'')[:500])
+    self.assertEqual(
+      len(queries), budget,
+      f'{method.upper()} {url}: {len(queries)} SQL-запросов вместо {budget}\n' +
+      '\n'.join(query['sql'] for query in queries.captured_queries)
+    )
+    if not response.streaming:
+      self.assertEqual(response['X-DB-Query-Count'], str(budget))
+    return response
+
+  def check_budgets(self, size):
+    house, apartment, meter, meter_type, run = self.create_dataset(size)
+    json = {'content_type': 'application/json'}
+    month = timezone.now().strftime('%Y-%m')
+    readings_file = io.BytesIO(''.join(
+      ['meter_id,period,value\n'] + [f'{meter.id + offset},{month},1000\n' for offset in range(size)]
+    ).encode())
+    readings_file.name = 'readings.csv'
+
+    self.assertQueryBudget(1, 'get', '/api/houses/')
+    self.assertQueryBudget(2, 'post', '/api/houses/', {'address': f'Новый дом {size}'}, **json)
+    self.assertQueryBudget(6, 'get', f'/api/house/{house.id}/')
+    self.assertQueryBudget(4, 'get', f'/api/house/{house.id}/?readings_last=1')
+    self.assertQueryBudget(10, 'put', f'/api/house/{house.id}/', {'address': f'Дом {size}'}, **json)
+    self.assertQueryBudget(3, 'post', '/api/apartments/', {'house': house.id, 'number': 0, 'area': '30.00'}, **json)
+    self.assertQueryBudget(4, 'get', f'/api/apartment/{apartment.id}/')
+    self.assertQueryBudget(8, 'put', f'/api/apartment/{apartment.id}/', {'number': 1, 'area': '45.50'}, **json)
+    self.assertQueryBudget(2, 'get', f'/api/meters/house/{house.id}/')
+    self.assertQueryBudget(2, 'get', f'/api/meters/house/{house.id}/?apartment_id={apartment.id}')
+    self.assertQueryBudget(2, 'get', f'/api/meter/{meter.id}/')
+    self.assertQueryBudget(17, 'put', f'/api/meter/{meter.id}/',
+                           {'meter_number': 'M-new', 'meter_type': meter_type.id, 'readings': {'2024-09': 100}}, **json)
+    self.assertQueryBudget(2, 'get', '/api/meters/')
+    self.assertQueryBudget(8, 'post', '/api/meters/',
+                           {'meter_number': 'M-2', 'apartment': apartment.id, 'readings': {month: 1}}, **json)
+    self.assertQueryBudget(1, 'get', '/api/meter-types/')
+    self.assertQueryBudget(1, 'get', f'/api/meter-types/{meter_type.id}/')
+    self.assertQueryBudget(1, 'get', f'/api/bills/?house_id={house.id}&month_from=2024-08')
+    self.assertQueryBudget(1, 'get', f'/api/bills/export/?house_id={house.id}')
+    self.assertQueryBudget(1, 'get', '/api/bills/export/?export_format=csv')
+    self.assertQueryBudget(1, 'get', '/api/bills/stale/')
+    self.assertQueryBudget(1, 'get', f'/api/analytics/consumption/?house_id={house.id}&month_from=2024-08')
+    self.assertQueryBudget(1, 'get', '/api/analytics/consumption/')
+    self.assertQueryBudget(2, 'get', f'/api/calculations/{run.id}/')
+    self.assertQueryBudget(2, 'get', '/api/tasks/unknown-task/result/')
+    self.assertQueryBudget(1, 'get', f'/api/tasks/task-{size}/profile/')
+    self.assertQueryBudget(8 + self.insert_batches(MeterReading, size) +
+                           self.update_batches(CONSUMPTION_FIELDS, size, CONSUMPTION_BATCH_SIZE),
+                           'post', '/api/readings/import/', {'file': readings_file})
+
+  def test_query_budgets(self):
+    for size in SIZES:
+      with self.subTest(size=size):
+        self.check_budgets(size)
+
+  def test_bills_json_shape(self):
+    """
+    Результат расчета побайтно, а начисления квитанции по значению совпадают с прежним JSON расчета по одной квартире
+    """
+    water = MeterType.objects.create(name='ХВС', unit='м3')
+    hot = MeterType.objects.create(name='ГВС', unit='м3')
+    water_tariff = Tariff.objects.create(meter_type=water, price_per_unit=Decimal('40.50'))
+    hot_tariff = Tariff.objects.create(meter_type=hot, price_per_unit=Decimal('200.00'))
+    area_tariff = Tariff.objects.create(custom_name='Содержание', unit='м2', price_per_unit=Decimal('25.00'))
+    house = House.objects.create(address='Ленина, 1')
+    apartment = Apartment.objects.create(house=house, number=7, area=Decimal('45.50'))
+    meter = Meter.objects.create(apartment=apartment, meter_number='ХВС-1', meter_type=water)
+    Meter.objects.create(apartment=apartment, meter_number='ГВС-1', meter_type=hot)
+    MeterReading.objects.create(meter=meter, period=date(2024, 7, 1), value=Decimal('10'))
+    MeterReading.objects.create(meter=meter, period=date(2024, 8, 1), value=Decimal('22.345'))
+
+    calc_rent = (
+      f'[{{"id": {area_tariff.id}, "name": "Содержание", "consumption": 45.5, "unit": "м2", "cost": 1137.5}}, '
+      f'{{"id": {water_tariff.id}, "name": "ХВС", "consumption": 12.35, "unit": "м3", "cost": 499.97}}]'
+    )
+    expected = (
+      f'[{{"apartment_id": {apartment.id}, "apartment_number": 7, "house_id": {house.id}, "address": "Ленина, 1", '
+      f'"date": "2024-08-01T00:00:00", "calc_rent": {calc_rent}, '
+      f'"absent_meters": [{{"id": {hot_tariff.id}, "name": "ГВС"}}]}}]'
+    )
+
+    result = calculate_utility_bills_for_house(house.id, 2024, 8)
+    self.assertEqual(json.dumps(result, cls=DjangoJSONEncoder, ensure_ascii=False), expected)
+    # jsonb (PostgreSQL) не сохраняет порядок ключей: начисления квитанции сравниваются по значению
+    self.assertEqual(UtilityBill.objects.get(apartment=apartment).charge, json.loads(calc_rent))
+
+  @skipIf(np is None, 'numpy не установлен')
+  def test_numpy_engine(self):
+    """
+    Движок numpy дает те же начисления, что и Decimal, включая строки, досчитываемые построчно
+    """
+    water = MeterType.objects.create(name='ХВС', unit='м3')
+    Tariff.objects.create(meter_type=water, price_per_unit=Decimal('40.50'))
+    Tariff.objects.create(custom_name='Содержание', unit='м2', price_per_unit=Decimal('3.33'))
+    house = House.objects.create(address='Ленина, 2')
+    # (июнь, июль, август); построчно: расход с пятеркой в тысячных, ровно половина копейки, оценка по среднему
+    readings = [
+      (None, '10', '22.345'),
+      (None, '10', '10.010'),
+      (None, '100.5', '115.7'),
+      (None, '50', '40'),
+      (None, None, '5.5'),
+      ('5', '7', None),
+      (None, None, None),
+    ]
+    for number, values in enumerate(readings):
+      apartment = Apartment.objects.create(house=house, number=number, area=Decimal('45.55') + number)
+      meter = Meter.objects.create(apartment=apartment, meter_number=f'ХВС-{number}', meter_type=water)
+      for month, value in zip((6, 7, 8), values):
+        if value is not None:
+          MeterReading.objects.create(meter=meter, period=date(2024, month, 1), value=Decimal(value))
+
+    expected = calculate_utility_bills_for_house(house.id, 2024, 8, engine='decimal')
+    with patch('home.services.calc_numpy.calculate_meter_charge', wraps=calculate_meter_charge) as row_charge:
+      result = calculate_utility_bills_for_house(house.id, 2024, 8, engine='numpy')
+
+    self.assertEqual(row_charge.call_count, 3)
+    self.assertEqual(json.dumps(result, cls=DjangoJSONEncoder), json.dumps(expected, cls=DjangoJSONEncoder))
+
+  @override_settings(CALC_CHUNK_APARTMENTS=5000)
+  def test_calculation_query_budget(self):
+    for size in SIZES:
+      with self.subTest(size=size):
+        house, *_ = self.create_dataset(size)
+        calculate_utility_bills_for_house(house.id, 2024, 8)
+        with self.assertNumQueries(8 + self.insert_batches(UtilityBill, size, BILLS_BATCH_SIZE)):
+          result = calculate_utility_bills_for_house(house.id, 2024, 8)
+        self.assertEqual(len(result), size)
+
+  @override_settings(CALC_CHUNK_APARTMENTS=4)
+  def test_calculation_resume(self):
+    """
+    Расчет, упавший посреди дома, продолжается с контрольной точки: повторной доставкой задачи
+    и повторным проходом расчета по городу (с той же записью прогресса)
+    """
+    house, *_ = self.create_dataset(10)
+    apartment_ids = list(house.apartments.order_by('id').values_list('id', flat=True))
+    chunks = []
+
+    def crash_on_second_chunk(apartments, *args):
+      chunks.append(len(apartments))
+      if len(chunks) == 2:
+        raise OperationalError('Соединение с БД потеряно')
+      return calculate_charges_decimal(apartments, *args)
+
+    with patch('home.services.calc_tarif.calculate_charges_decimal', side_effect=crash_on_second_chunk):
+      with self.assertRaises(OperationalError):
+        run_house_calculation(house.id, 2024, 8, task_id='resumed')
+      progress = CalculationProgress.objects.get(task_id='resumed')
+      self.assertEqual((progress.status, progress.processed_apartments, progress.last_apartment_id),
+                       ('ошибка', 4, apartment_ids[3]))
+      self.assertEqual(UtilityBill.objects.filter(apartment__house=house, charge=[]).count(), 6)
+
+      resumed, result = run_house_calculation(house.id, 2024, 8, task_id='resumed')
+    self.assertEqual(chunks, [4, 4, 4, 2])
+    self.assertEqual((resumed.id, resumed.status, resumed.processed_apartments, len(result)),
+                     (progress.id, 'готово', 10, 6))
+    self.assertFalse(UtilityBill.objects.filter(apartment__house=house, charge=[]).exists())
+
+    run = CalculationRun.objects.create(year=2024, month=8, house_ids=[house.id], houses_total=1, max_attempts=2)
+    chunks.clear()
+    eager = current_app.conf.task_always_eager
+    current_app.conf.task_always_eager = True
+    try:
+      with patch('home.services.calc_tarif.calculate_charges_decimal', side_effect=crash_on_second_chunk):
+        calculate_houses_chunk_task.apply(args=(run.id, [house.id]))
+        finish_city_calculation_task([], run.id)
+    finally:
+      current_app.conf.task_always_eager = eager
+
+    self.assertEqual(chunks, [4, 4, 4, 2])
+    progress = CalculationProgress.objects.get(run=run)
+    self.assertEqual((progress.status, progress.processed_apartments), ('готово', 10))
+    run.refresh_from_db()
+    self.assertEqual((run.status, run.attempts, run.houses_done, run.houses_failed, run.apartments_done),
+                     ('готово', 2, 1, 0, 10))
+
+  def test_readings_import(self):
+    """
+    Импорт пачками: ошибки по номерам строк, принятые строки записаны вместе с расходом и пометками
+    об устаревании квитанций; упавшая пачка откатывается, предыдущие остаются записанными
+    """
+    house, apartment, meter, *_ = self.create_dataset(10)
+    meters = list(Meter.objects.filter(apartment__house=house).order_by('id'))
+    StaleBill.objects.all().delete()
+    UtilityBill.objects.create(apartment=apartment, month=date(2024, 9, 1), charge=[])
+
+    lines = [
+      'meter_id,period,value\n',
+      f'{meters[0].id},2024-09,100\n',
+      f'{meters[0].id},2024-09,110\n',
+      '999999,2024-09,1\n',
+      f'{meters[1].id},2024-13,1\n',
+      f'{meters[1].id},2024-09,abc\n',
+      f'{meters[1].id},2024-05,1\n',
+      f'{meters[1].id},2024-09,-5\n',
+      f'{meters[2].id},2024-09,95\n',
+    ]
+    report = import_readings(lines, FORMAT_CSV, batch_size=3)
+    self.assertEqual(report, {'total': 8, 'created': 2, 'failed': 6, 'errors': [
+      {'row': 3, 'error': 'Показания за 2024-09 уже существуют.'},
+      {'row': 4, 'error': 'Счётчик 999999 не найден.'},
+      {'row': 5, 'error': 'Месяц 2024-13 должен быть в формате YYYY-MM.'},
+      {'row': 6, 'error': 'Некорректное значение показания.'},
+      {'row': 7, 'error': 'Новый месяц (2024-05) не может быть меньше самого раннего (2024-06) в существующих показаниях.'},
+      {'row': 8, 'error': 'Показания за 2024-09 не могут быть отрицательными.'},
+    ]})
+    self.assertEqual(
+      list(MeterReading.objects.filter(period=date(2024, 9, 1)).order_by('meter_id')
+           .values_list('meter_id', 'value', 'consumption')),
+      [(meters[0].id, Decimal('100'), Decimal('20')), (meters[2].id, Decimal('95'), Decimal('15'))]
+    )
+    self.assertEqual(list(StaleBill.objects.values_list('apartment_id', 'month')), [(apartment.id, date(2024, 9, 1))])
+
+    # Построчно в отчете только первые max_errors ошибок, кол-во считается по всем
+    report = import_readings(lines, FORMAT_CSV, batch_size=3, max_errors=4)
+    self.assertEqual((report['total'], report['created'], report['failed']), (8, 0, 8))
+    self.assertEqual([error['row'] for error in report['errors']], [2, 3, 4, 5])
+
+    lines = ['meter_id,period,value\n'] + [f'{meter.id},2024-10,{value}\n' for meter, value in zip(meters, (120, 130))]
+    with patch('home.services.readings_import.refresh_consumption', side_effect=[0, OperationalError('Ошибка БД')]):
+      with self.assertRaises(OperationalError):
+        import_readings(lines, FORMAT_CSV, batch_size=1)
+    self.assertEqual(list(MeterReading.objects.filter(period=date(2024, 10, 1)).values_list('meter_id', flat=True)),
+                     [meters[0].id])
+
+  def test_meter_created_with_readings(self):
+    """
+    Показание, переданное при создании счётчика, помечает квитанцию за месяц устаревшей и учитывается
+    в расходе и среднем расходе следующих показаний
+    """
+    _, apartment, _, water, _ = self.create_dataset(10)
+    current_month, previous_month = get_allowed_months()
+    StaleBill.objects.all().delete()
+    UtilityBill.objects.create(apartment=apartment, month=parse_period(previous_month), charge=[])
+
+    response = self.client.post('/api/meters/', {'meter_number': 'ХВС-2', 'apartment': apartment.id,
+                                                 'readings': {previous_month: 100}}, content_type='application/json')
+    self.assertEqual(response.status_code, 201, response.content)
+    self.assertEqual(list(StaleBill.objects.values_list('apartment_id', 'month')),
+                     [(apartment.id, parse_period(previous_month))])
+
+    meter_id = response.json()['id']
+    response = self.client.put(f'/api/meter/{meter_id}/', {'meter_number': 'ХВС-2', 'meter_type': water.id,
+                                                            'readings': {current_month: 112}},
+                               content_type='application/json')
+    self.assertEqual(response.status_code, 200, response.content)
+    self.assertEqual(
+      list(MeterReading.objects.filter(meter_id=meter_id).order_by('period')
+           .values_list('consumption', 'consumption_months', 'average_consumption')),
+      [(None, None, None), (Decimal('12'), 1, Decimal('12'))]
+    )
+
+  def test_append_reading_rejected(self):
+    """
+    Повторное показание и показание раньше самого раннего отклоняются ошибкой проверки (400), а не 500;
+    нарушение уникальности (счетчик, месяц) при пропущенной проверке — тоже
+    """
+    _, _, meter, water, _ = self.create_dataset(10)
+    url = f'/api/meter/{meter.id}/'
+
+    def put_reading(month):
+      return self.client.put(url, {'meter_number': meter.meter_number, 'meter_type': water.id,
+                                   'readings': {month: 1000}}, content_type='application/json')
+
+    for month, error in [('2024-08', 'Показания за 2024-08 уже существуют.'),
+                         ('2024-05', 'Новый месяц (2024-05) не может быть меньше самого раннего (2024-06) '
+                                     'в существующих показаниях.')]:
+      with self.subTest(month=month):
+        response = put_reading(month)
+        self.assertEqual((response.status_code, response.json()), (400, [error]))
+
+    with patch('home.services.readings.check_new_reading'):
+      response = put_reading('2024-07')
+    self.assertEqual((response.status_code, response.json()), (400, ['Показания за 2024-07 уже существуют.']))
+    self.assertEqual(meter.meter_readings.count(), 3)
+
+  def test_stale_marking(self):
+    """
+    Устаревшими помечаются только квитанции, на которые влияет изменение: цена тарифа по счетчикам —
+    квартиры со счетчиком этого типа за последний рассчитанный месяц, площадь — все квитанции квартиры,
+    показание — месяц показания и следующие
+    """
+    house, apartment, meter, water, _ = self.create_dataset(10)
+    hot = MeterType.objects.create(name='ГВС', unit='м3')
+    hot_tariff = Tariff.objects.create(meter_type=hot, price_per_unit=Decimal('200.00'))
+    Meter.objects.create(apartment=apartment, meter_number='ГВС-1', meter_type=hot)
+    UtilityBill.objects.create(apartment=apartment, month=date(2024, 7, 1), charge=[])
+    area_tariff = Tariff.objects.get(meter_type__isnull=True)
+    july, august = date(2024, 7, 1), date(2024, 8, 1)
+    all_august = [(apartment_id, august) for apartment_id in house.apartments.values_list('id', flat=True)]
+
+    def marked(change, reason):
+      StaleBill.objects.all().delete()
+      change()
+      self.assertFalse(StaleBill.objects.exclude(reason=reason).exists())
+      return sorted(StaleBill.objects.values_list('apartment_id', 'month'))
+
+    def set_price(tariff, price):
+      def change():
+        tariff.price_per_unit = Decimal(price)
+        tariff.save()
+      return change
+
+    def set_area():
+      apartment.area = Decimal('50.00')
+      apartment.save()
+
+    def set_reading():
+      reading = meter.meter_readings.get(period=date(2024, 6, 1))
+      reading.value = Decimal('5')
+      reading.save()
+
+    self.assertEqual(marked(set_price(hot_tariff, '210.00'), 'tariff'), [(apartment.id, august)])
+    self.assertEqual(marked(set_price(Tariff.objects.get(meter_type=water), '41.00'), 'tariff'), all_august)
+    self.assertEqual(marked(set_price(area_tariff, '26.00'), 'tariff'), all_august)
+    self.assertEqual(marked(set_price(area_tariff, '26.00'), 'tariff'), [])
+    self.assertEqual(marked(set_area, 'area'), [(apartment.id, july), (apartment.id, august)])
+    self.assertEqual(marked(set_reading, 'reading'), [(apartment.id, july), (apartment.id, august)])
+
+  def test_recalculate_stale_bills(self):
+    """
+    Проход пересчитывает пометки, существовавшие на его начало, и завершается, даже если квитанции
+    помечаются заново во время прохода; новые пометки пересчитывает следующий проход
+    """
+    house, *_ = self.create_dataset(10)
+
+    def recalculate_and_mark_again(house_id, year, month, **kwargs):
+      result = calculate_utility_bills_for_house(house_id, year, month, **kwargs)
+      mark_stale([(row['apartment_id'], date(year, month, 1)) for row in result], 'reading')
+      return result
+
+    with patch('home.services.stale_bills.calculate_utility_bills_for_house', side_effect=recalculate_and_mark_again):
+      self.assertEqual(recalculate_stale_bills(batch_size=4), {'recalculated': 10, 'failed': []})
+    self.assertEqual(StaleBill.objects.count(), 10)
+    self.assertFalse(UtilityBill.objects.filter(apartment__house=house, charge=[]).exists())
+
+    self.assertEqual(recalculate_stale_bills(batch_size=4), {'recalculated': 10, 'failed': []})
+    self.assertFalse(StaleBill.objects.exists())
+    self.assertEqual(recalculate_stale_bills(), {'recalculated': 0, 'failed': []})
+
+  @override_settings(REFERENCE_CACHE_BUS='local')
+  def test_reference_cache_invalidation(self):
+    """
+    Изменение тарифа или типа счётчика сбрасывает копии справочников во всех процессах через шину;
+    загрузка, начатая до сброса, не сохраняется
+    """
+    water = MeterType.objects.create(name='ХВС', unit='м3')
+    tariff = Tariff.objects.create(meter_type=water, price_per_unit=Decimal('40.50'))
+    bus = reference_cache.get_bus()
+    self.assertIsInstance(bus, LocalBus)
+    # Копия другого процесса, подписанная на ту же шину
+    process = ReferenceCache()
+    process.bus = bus
+    bus.subscribe(process.on_message)
+    self.addCleanup(bus.subscribers.remove, process.on_message)
+
+    def prices():
+      return [(tariff.price_per_unit, tariff.meter_type.name) for tariff in process.get().tariffs]
+
+    with self.assertNumQueries(2):
+      self.assertEqual(prices(), [(Decimal('40.50'), 'ХВС')])
+    with self.assertNumQueries(0):
+      prices()
+
+    with self.captureOnCommitCallbacks(execute=True):
+      tariff.price_per_unit = Decimal('41.00')
+      tariff.save()
+    self.assertIsNone(process.data)
+    self.assertEqual(prices(), [(Decimal('41.00'), 'ХВС')])
+
+    with self.captureOnCommitCallbacks(execute=True):
+      water.name = 'Холодная вода'
+      water.save()
+    self.assertIsNone(process.data)
+    self.assertEqual(prices(), [(Decimal('41.00'), 'Холодная вода')])
+    self.assertEqual(get_tariffs()[0].meter_type.name, 'Холодная вода')
+
+    generation = process.generation
+    meter_types = MeterType.objects.all
+
+    def invalidate_during_load():
+      invalidate_reference_cache()
+      return meter_types()
+
+    with patch.object(MeterType.objects, 'all', side_effect=invalidate_during_load):
+      process.load()
+    self.assertEqual((process.generation, process.data), (generation + 1, None))
+
+  def get_bill_pages(self, url):
+    """
+    Все страницы списка квитанций по ссылкам next: (id квитанций по страницам, ссылки next)
+    """
+    pages, links = [], []
+    while url:
+      response = self.client.get(url)
+      self.assertEqual(response.status_code, 200, response.content)
+      pages.append([bill['id'] for bill in response.json()['results']])
+      url = response.json()['next']
+      links.append(url)
+    return pages, links
+
+  def test_bills_pagination(self):
+    """
+    Курсор: строгий порядок id без повторов и пропусков, фильтры сохраняются в ссылке next,
+    вставка квитанций между запросами не сдвигает страницы; неверные фильтры — 400
+    """
+    house, apartment, *_ = self.create_dataset(10)
+    other = Apartment.objects.create(house=House.objects.exclude(id=house.id).first(), number=1, area=Decimal('30'))
+    UtilityBill.objects.bulk_create([
+      UtilityBill(apartment=bill_apartment, month=date(2024, month, 1), charge=[])
+      for bill_apartment in [*Apartment.objects.filter(house=house), other] for month in (6, 7)
+    ] + [UtilityBill(apartment=other, month=date(2024, 8, 1), charge=[])])
+
+    filters = {'house_id': str(house.id), 'month_from': '2024-07', 'month_to': '2024-08'}
+    expected = list(UtilityBill.objects.filter(apartment__house=house, month__gte=date(2024, 7, 1))
+                    .order_by('id').values_list('id', flat=True))
+    pages, links = self.get_bill_pages(f'/api/bills/?page_size=3&{urlencode(filters)}')
+    self.assertEqual([len(page) for page in pages], [3] * 6 + [2])
+    self.assertEqual(sum(pages, []), expected)
+    for link in links[:-1]:
+      query = parse_qs(urlsplit(link).query)
+      self.assertEqual({name: query[name] for name in filters}, {name: [value] for name, value in filters.items()})
+      self.assertEqual(query['page_size'], ['3'])
+    self.assertIsNone(links[-1])
+
+    pages, _ = self.get_bill_pages(f'/api/bills/?page_size=2&apartment_id={apartment.id}&month_to=2024-07')
+    self.assertEqual(sum(pages, []), list(UtilityBill.objects.filter(apartment=apartment, month__lte=date(2024, 7, 1))
+                                          .order_by('id').values_list('id', flat=True)))
+
+    # Новые квитанции получают большие id и оказываются в конце выдачи, уже выданные страницы не сдвигаются
+    first_page = self.client.get(f'/api/bills/?page_size=3&house_id={house.id}').json()
+    second_page = self.client.get(first_page['next']).json()
+    UtilityBill.objects.bulk_create([
+      UtilityBill(apartment=bill_apartment, month=date(2024, 9, 1), charge=[])
+      for bill_apartment in Apartment.objects.filter(house=house)
+    ])
+    self.assertEqual(self.client.get(first_page['next']).json()['results'], second_page['results'])
+    pages, _ = self.get_bill_pages(second_page['next'])
+    ids = [bill['id'] for bill in first_page['results'] + second_page['results']] + sum(pages, [])
+    self.assertEqual(ids, list(UtilityBill.objects.filter(apartment__house=house).order_by('id')
+                               .values_list('id', flat=True)))
+
+    for query, error in (
+      ('house_id=abc', 'Параметр house_id должен быть целым числом.'),
+      ('apartment_id=0', 'Параметр apartment_id должен быть положительным.'),
+      ('month_from=2024-13', 'Параметр month_from должен быть в формате YYYY-MM.'),
+      ('month_from=2024-08&month_to=2024-07', 'month_from не может быть позже month_to.'),
+    ):
+      with self.subTest(query=query):
+        response = self.client.get(f'/api/bills/?{query}')
+        self.assertEqual((response.status_code, response.json()), (400, {'error': error}))
+
+  def test_bills_export(self):
+    """
+    CSV и NDJSON выгрузки разбираются обратно в те же квитанции: заголовок, кол-во строк, значения полей
+    (начисления JSON, месяц YYYY-MM-DD), порядок (месяц, id) и фильтры запроса
+    """
+    house, apartment, *_ = self.create_dataset(10)
+    other = Apartment.objects.create(house=House.objects.exclude(id=house.id).first(), number=1, area=Decimal('30'))
+    charge = [{'id': 1, 'name': 'Содержание, "общее"', 'consumption': 45.5, 'unit': 'м2', 'cost': 1137.5}]
+    UtilityBill.objects.filter(apartment=apartment).update(charge=charge)
+    UtilityBill.objects.bulk_create([
+      UtilityBill(apartment=bill_apartment, month=date(2024, 7, 1), charge=[])
+      for bill_apartment in (apartment, other)
+    ] + [UtilityBill(apartment=other, month=date(2024, 8, 1), charge=charge)])
+
+    def expected_rows(bills):
+      return [
+        {'id': bill.id, 'apartment_id': bill.apartment_id, 'apartment_number': bill.apartment.number,
+         'house_id': bill.apartment.house_id, 'address': bill.apartment.house.address,
+         'month': bill.month.isoformat(), 'charge': bill.charge}
+        for bill in bills.select_related('apartment__house').order_by('month', 'id')
+      ]
+
+    def export(query):
+      response = self.client.get(f'/api/bills/export/?{query}')
+      self.assertEqual(response.status_code, 200)
+      return response, b''.join(response.streaming_content).decode()
+
+    house_bills = expected_rows(UtilityBill.objects.filter(apartment__house=house))
+    self.assertEqual(len(house_bills), 11)
+
+    response, content = export(f'export_format=csv&house_id={house.id}')
+    self.assertEqual(response['Content-Type'], 'text/csv')
+    self.assertEqual(response['Content-Disposition'], 'attachment; filename="bills.csv"')
+    reader = csv.DictReader(io.StringIO(content))
+    self.assertEqual(reader.fieldnames, EXPORT_FIELDS)
+    rows = [{**row, 'id': int(row['id']), 'apartment_id': int(row['apartment_id']),
+             'apartment_number': int(row['apartment_number']), 'house_id': int(row['house_id']),
+             'charge': json.loads(row['charge'])} for row in reader]
+    self.assertEqual(rows, house_bills)
+
+    response, content = export(f'export_format=ndjson&house_id={house.id}')
+    self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+    records = [json.loads(line) for line in content.splitlines()]
+    self.assertEqual([list(record) for record in records], [EXPORT_FIELDS] * len(records))
+    self.assertEqual(records, house_bills)
+
+    response, content = export(f'apartment_id={other.id}&month_from=2024-08&month_to=2024-08')
+    self.assertEqual([json.loads(line) for line in content.splitlines()],
+                     expected_rows(UtilityBill.objects.filter(apartment=other, month=date(2024, 8, 1))))
+    response, content = export('export_format=csv&month_to=2024-07')
+    self.assertEqual([int(row['id']) for row in csv.DictReader(io.StringIO(content))],
+                     [row['id'] for row in expected_rows(UtilityBill.objects.filter(month=date(2024, 7, 1)))])
+
+    # Несколько кусков: заголовок CSV один, строки не теряются на границах кусков
+    chunks = list(export_bills(UtilityBill.objects.all(), FORMAT_CSV, chunk_size=3))
+    self.assertEqual(len(chunks), 5)
+    self.assertEqual(len(list(csv.DictReader(io.StringIO(''.join(chunks))))), 13)
+    chunks = list(export_bills(UtilityBill.objects.all(), FORMAT_NDJSON, chunk_size=3))
+    self.assertEqual([chunk.count('\n') for chunk in chunks], [3, 3, 3, 3, 1])
+
+    for query, error in (
+      ('export_format=xml', 'Формат выгрузки должен быть одним из: csv, ndjson.'),
+      ('house_id=abc', 'Параметр house_id должен быть целым числом.'),
+      ('month_to=2024-13', 'Параметр month_to должен быть в формате YYYY-MM.'),
+    ):
+      with self.subTest(query=query):
+        response = self.client.get(f'/api/bills/export/?{query}')
+        self.assertEqual((response.status_code, response.json()), (400, {'error': error}))
+
+  def test_versioned_cache(self):
+    """
+    Повторный GET с If-None-Match получает 304 без запросов к БД; после нового показания — новый ETag и данные
+    """
+    house, apartment, meter, *_ = self.create_dataset(10)
+    urls = [f'/api/house/{house.id}/', f'/api/apartment/{apartment.id}/', f'/api/meters/house/{house.id}/']
+    for month, url in enumerate(urls, start=9):
+      with self.subTest(url=url):
+        response = self.client.get(url)
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+          response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual((response.status_code, response['ETag']), (304, etag))
+
+        with self.captureOnCommitCallbacks(execute=True):
+          MeterReading.objects.create(meter=meter, period=date(2024, month, 1), value=Decimal(month * 10))
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertIn(f'"2024-{month:02d}"', response.content.decode())
+
+    self.assertIsNone(VersionedCacheMixin().get_cache_house_id())
+
+  def test_readings_window(self):
+    """
+    readings_last=N, readings_since=YYYY-MM и readings=none отдают ровно ожидаемые месяцы и значения
+    каждого счётчика на всех эндпоинтах со счётчиками; неверные параметры — 400
+    """
+    house, apartment, meter, water, _ = self.create_dataset(10)
+    other = Meter.objects.create(apartment=apartment, meter_number='ХВС-2', meter_type=water)
+    MeterReading.objects.bulk_create([
+      MeterReading(meter=other, period=date(2024, month, 1), value=Decimal(month)) for month in (3, 5)
+    ])
+    urls = {
+      'house': f'/api/house/{house.id}/',
+      'apartment': f'/api/apartment/{apartment.id}/',
+      'meters_by_house': f'/api/meters/house/{house.id}/?apartment_id={apartment.id}',
+      'meters': '/api/meters/',
+    }
+
+    def get_readings(name, query):
+      url = urls[name]
+      response = self.client.get(f"{url}{'&' if '?' in url else '?'}{query}")
+      self.assertEqual(response.status_code, 200, response.content)
+      data = response.json()
+      if name == 'house':
+        data = next(item for item in data['apartments'] if item['id'] == apartment.id)
+      if name in ('house', 'apartment'):
+        data = data['meters']
+      return {item['id']: item['readings'] for item in data if item['id'] in (meter.id, other.id)}
+
+    for query, expected in (
+      ('', {meter.id: {'2024-06': 60.0, '2024-07': 70.0, '2024-08': 80.0}, other.id: {'2024-03': 3.0, '2024-05': 5.0}}),
+      ('readings=all', {meter.id: {'2024-06': 60.0, '2024-07': 70.0, '2024-08': 80.0},
+                        other.id: {'2024-03': 3.0, '2024-05': 5.0}}),
+      ('readings_last=1', {meter.id: {'2024-08': 80.0}, other.id: {'2024-05': 5.0}}),
+      ('readings_last=2', {meter.id: {'2024-07': 70.0, '2024-08': 80.0}, other.id: {'2024-03': 3.0, '2024-05': 5.0}}),
+      ('readings_since=2024-05', {meter.id: {'2024-06': 60.0, '2024-07': 70.0, '2024-08': 80.0},
+                                  other.id: {'2024-05': 5.0}}),
+      ('readings_since=2024-07', {meter.id: {'2024-07': 70.0, '2024-08': 80.0}, other.id: {}}),
+      ('readings_since=2024-04&readings_last=1', {meter.id: {'2024-08': 80.0}, other.id: {'2024-05': 5.0}}),
+      ('readings=none', {meter.id: {}, other.id: {}}),
+      ('readings=none&readings_last=1', {meter.id: {}, other.id: {}}),
+    ):
+      for name in urls:
+        with self.subTest(query=query, endpoint=name):
+          self.assertEqual(get_readings(name, query), expected)
+
+    for query, error in (
+      ('readings=some', 'Параметр readings должен быть одним из: all, none.'),
+      ('readings_since=2024-13', 'Параметр readings_since должен быть в формате YYYY-MM.'),
+      ('readings_since=2024', 'Параметр readings_since должен быть в формате YYYY-MM.'),
+      ('readings_last=0', 'Параметр readings_last должен быть положительным целым числом.'),
+      ('readings_last=-1', 'Параметр readings_last должен быть положительным целым числом.'),
+      ('readings_last=abc', 'Параметр readings_last должен быть положительным целым числом.'),
+    ):
+      for name, url in urls.items():
+        with self.subTest(query=query, endpoint=name):
+          response = self.client.get(f"{url}{'&' if '?' in url else '?'}{query}")
+          self.assertEqual((response.status_code, response.json()), (400, {'error': error}))
+
+  def test_benchmark(self):
+    """
+    Генератор создает ожидаемый объем данных с рассчитанным расходом; замеры на маленьком доме
+    проходят целиком и не оставляют в БД и кэше ничего созданного
+    """
+    house_ids, counts = generate_dataset(2, 3, 2, 1, gap_rate=0, last_month=date(2024, 8, 1), seed=1,
+                                         address_prefix='Тест')
+    self.assertEqual(counts, {'houses': 2, 'apartments': 6, 'meters': 12, 'readings': 144})
+    self.assertEqual(list(House.objects.filter(id__in=house_ids).values_list('address', flat=True)),
+                     ['Тест, д. 1', 'Тест, д. 2'])
+    readings = MeterReading.objects.filter(meter__apartment__house_id__in=house_ids)
+    self.assertEqual((readings.filter(period=date(2023, 9, 1)).count(), readings.filter(consumption=None).count()),
+                     (12, 12))
+    self.assertEqual(Tariff.objects.count(), len(METER_TYPES) + len(AREA_TARIFFS))
+
+    def snapshot():
+      return {model.__name__: list(model.objects.order_by('id').values_list('id', flat=True))
+              for model in (House, Apartment, Meter, MeterReading, MeterType, Tariff, UtilityBill,
+                            CalculationProgress, CalculationRun)}
+
+    # Недостающий тариф замеры создают заново и откатывают вместе с остальными данными
+    Tariff.objects.filter(custom_name=AREA_TARIFFS[-1][0]).delete()
+    before = snapshot()
+    last_apartment_id = max(before['Apartment'])
+    benchmark_apartment_ids = range(last_apartment_id + 1, last_apartment_id + 4)
+    report = run_benchmark([3], meters_per_apartment=2, years=1, repeats=1, year=2024, month=8,
+                           engines=(ENGINE_DECIMAL,), task=calculate_utility_bills_for_house_task)
+
+    scale, = report['results']
+    self.assertEqual((scale['dataset']['apartments'], scale['dataset']['meters']), (3, 6))
+    self.assertEqual(set(scale['calculation']), {ENGINE_DECIMAL})
+    self.assertEqual(scale['calculation'][ENGINE_DECIMAL]['repeats'], 1)
+    self.assertIn('celery_task', scale)
+    self.assertEqual(set(scale['endpoints']),
+                     {'house_detail', 'house_detail_last_readings', 'apartment_detail', 'meters_by_house', 'bills'})
+    self.assertEqual(snapshot(), before)
+    self.assertFalse(House.objects.filter(address__startswith='Бенчмарк').exists())
+    self.assertEqual(cache.get_many([apartment_house_key(apartment_id) for apartment_id in benchmark_apartment_ids]), {})
+    self.assertEqual(len(get_tariffs()), len(before['Tariff']))
+
+  def test_metrics(self):
+    """
+    /metrics отдает метрики HTTP-запросов, задач Celery, расчета и БД; с чужого адреса — 403
+    """
+    house, *_ = self.create_dataset(10)
+    self.client.get('/api/houses/')
+    calculate_utility_bills_for_house_task.apply(args=(house.id, 2024, 8))
+
+    response = self.client.get('/metrics')
+    self.assertEqual(response.status_code, 200)
+    metrics = response.content.decode()
+    task = calculate_utility_bills_for_house_task.name
+    for sample in ['http_request_seconds_count{method="GET",route="api/houses/$",status="200"}',
+                   'http_request_db_queries_count{method="GET",route="api/houses/$"}',
+                   f'celery_task_seconds_count{{task="{task}"}}',
+                   f'celery_tasks_total{{state="SUCCESS",task="{task}"}}',
+                   'billing_house_calculation_seconds_count{engine="decimal",status="ok"}',
+                   'billing_apartments_calculated_total{engine="decimal"}',
+                   'db_query_seconds_count{alias="default"}']:
+      self.assertIn(sample, metrics)
+
+    self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.1').status_code, 403)
+
+  def test_metrics_shared_directory(self):
+    """
+    Общий каталог метрик нескольких контейнеров: процессы с одинаковым PID пишут в разные файлы,
+    /metrics суммирует их, завершение процесса воркера удаляет только его файлы живых значений
+    """
+    with tempfile.TemporaryDirectory() as directory, patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_DIR': directory}):
+      for host, amount in (('asgi', 1), ('celery', 2)):
+        value_class = values.MultiProcessValue(lambda host=host: f'{host}-7')
+        value_class('counter', 'shared_test', 'shared_test_total', (), (), 'Тест').inc(amount)
+        value_class('gauge', 'shared_live', 'shared_live', (), (), 'Тест', 'livesum').set(amount)
+      self.assertEqual(sorted(os.listdir(directory)), ['counter_asgi-7.db', 'counter_celery-7.db',
+                                                       'gauge_livesum_asgi-7.db', 'gauge_livesum_celery-7.db'])
+      self.assertIn('shared_test_total 3.0', render_metrics().decode())
+
+      with patch('home.metrics.PROCESS_HOST', 'celery'):
+        self.assertEqual(get_process_identifier(7), 'celery-7')
+        metrics_worker_process_shutdown(pid=7)
+      self.assertEqual(sorted(os.listdir(directory)), ['counter_asgi-7.db', 'counter_celery-7.db',
+                                                       'gauge_livesum_asgi-7.db'])
+
+  def test_calculation_profile(self):
+    house, *_ = self.create_dataset(10)
+    progress, _ = run_house_calculation(house.id, 2024, 8, task_id='profiled', profile=list(PROFILE_TOOLS))
+
+    self.assertEqual(
+      set(progress.profile['stages']),
+      {'load_house', 'load_apartments', 'load_meters', 'calculate', 'build_bills', 'save_bills'}
+    )
+    self.assertTrue(progress.profile['cprofile'])
+    self.assertGreater(progress.profile['tracemalloc']['peak_kb'], 0)
+
+    response = self.client.get('/api/tasks/profiled/profile/')
+    self.assertEqual(response.json()['profile'], progress.profile)
+
+    progress, _ = run_house_calculation(house.id, 2024, 8, task_id='not-profiled')
+    self.assertIsNone(progress.profile)
+
+  def test_profiler_nested_stages(self):
+    """
+    Время вложенного этапа не входит во время внешнего: доли этапов в сумме не больше 100%
+    """
+    profiler = CalculationProfiler()
+    # start, calculate, estimate_averages (дважды), конец calculate, stop
+    with patch('home.services.profiling.time.perf_counter', side_effect=[0, 0, 1, 3, 4, 5, 10, 10]):
+      profiler.start()
+      with profiler.stage('calculate'):
+        for _ in range(2):
+          with profiler.stage('estimate_averages'):
+            pass
+      profiler.stop()
+
+    self.assertEqual(profiler.to_dict()['stages'], {
+      'calculate': {'seconds': 7, 'calls': 1, 'share': 0.7},
+      'estimate_averages': {'seconds': 3, 'calls': 2, 'share': 0.3},
+    })
+
+    house, *_ = self.create_dataset(10)
+    progress, _ = run_house_calculation(house.id, 2024, 9, task_id='estimated', profile=[])
+    stages = progress.profile['stages']
+    self.assertEqual(stages['estimate_averages']['calls'], 10)
+    # Допуск на округление времени этапов до микросекунд
+    self.assertLessEqual(sum(stage['seconds'] for stage in stages.values()),
+                         progress.profile['duration_seconds'] + 1e-5)
+
+  def test_consumption_aggregates(self):
+    house, apartment, meter, water, _ = self.create_dataset(10)
+    meter.meter_readings.all().delete()
+    # Переход через год и пропущенный январь: расход за два месяца делится на два
+    for period, value in [((2023, 11), 100), ((2023, 12), 110), ((2024, 2), 130), ((2024, 3), 145)]:
+      MeterReading.objects.create(meter=meter, period=date(*period, 1), value=Decimal(value))
+
+    def aggregates():
+      return [(reading.period.strftime('%Y-%m'), reading.consumption, reading.consumption_months,
+               reading.average_consumption) for reading in meter.meter_readings.order_by('period')]
+
+    self.assertEqual(aggregates(), [
+      ('2023-11', None, None, None),
+      ('2023-12', Decimal('10'), 1, Decimal('10')),
+      ('2024-02', Decimal('20'), 2, Decimal('10')),
+      ('2024-03', Decimal('15'), 1, Decimal('11.667')),
+    ])
+
+    # Показание за пропущенный месяц пересчитывает следующие
+    MeterReading.objects.create(meter=meter, period=date(2024, 1, 1), value=Decimal(125))
+    self.assertEqual(aggregates()[2:], [
+      ('2024-01', Decimal('15'), 1, Decimal('12.5')),
+      ('2024-02', Decimal('5'), 1, Decimal('10')),
+      ('2024-03', Decimal('15'), 1, Decimal('11.667')),
+    ])
+
+    MeterReading.objects.get(meter=meter, period=date(2023, 11, 1)).delete()
+    self.assertEqual(aggregates()[0], ('2023-12', None, None, None))
+
+    # Апрель без показаний: оценка по среднему расходу из показания за март
+    result = calculate_utility_bills_for_house(house.id, 2024, 4)
+    charge = next(row for row in result if row['apartment_id'] == apartment.id)['calc_rent']
+    self.assertEqual(next(line for line in charge if line['name'] == water.name)['consumption'], 11.67)
+
+  def test_consumption_rollups(self):
+    house, apartment, meter, water, _ = self.create_dataset(10)
+    refresh_consumption([(meter_id, date(2024, 6, 1)) for meter_id in Meter.objects.values_list('id', flat=True)])
+    # Август по показаниям, сентябрь без показаний — по среднему расходу
+    run_house_calculation(house.id, 2024, 8)
+    run_house_calculation(house.id, 2024, 9)
+
+    response = self.client.get(f'/api/analytics/consumption/?house_id={house.id}&month_from=2024-08')
+    august, september = response.json()['months']
+    self.assertEqual((august['month'], august['cost'], august['estimated']), ('2024-08', 15425.0, 0))
+    self.assertEqual((september['cost'], september['cost_change_percent'], september['estimated']), (15425.0, 0.0, 10))
+
+    water_line = next(line for line in september['charges'] if line['meter_type_id'] == water.id)
+    self.assertEqual(
+      (water_line['apartments'], water_line['consumption'], water_line['cost'], water_line['estimated'],
+       water_line['consumption_change_percent']),
+      (10, 100.0, 4050.0, 10, 0.0)
+    )
+
+    self.assertEqual(self.client.get('/api/analytics/consumption/?month_from=2024-13').status_code, 400)
+
+    # Пометка начисления по среднему — отдельное поле квитанции, строки начислений прежнего вида
+    water_tariff_id = Tariff.objects.get(meter_type=water).id
+    bill = UtilityBill.objects.get(apartment=apartment, month=date(2024, 9, 1))
+    self.assertEqual(bill.estimated_tariffs, [water_tariff_id])
+    self.assertEqual({key for line in bill.charge for key in line}, {'id', 'name', 'consumption', 'unit', 'cost'})
+    self.assertEqual(UtilityBill.objects.get(apartment=apartment, month=date(2024, 8, 1)).estimated_tariffs, [])
+    response = self.client.get(f'/api/bills/?house_id={house.id}&month_from=2024-09')
+    self.assertEqual({tuple(bill['estimated_tariffs']) for bill in response.json()['results']}, {(water_tariff_id,)})
+
+  async def test_async_endpoints(self):
+    """
+    Асинхронные эндпоинты отвечают так же, как синхронные, и выполняют не больше запросов
+    """
+    await sync_to_async(self.create_dataset)(10)
+    for sync_url, async_url in [
+      ('/api/houses/', '/api/async/houses/'),
+      ('/api/meters/?readings_last=2', '/api/async/meters/?readings_last=2'),
+      ('/api/tasks/unknown-task/result/', '/api/async/tasks/unknown-task/result/'),
+      ('/api/tasks/task-10/result/', '/api/async/tasks/task-10/result/'),
+    ]:
+      with self.subTest(url=async_url):
+        expected = await sync_to_async(self.client.get)(sync_url)
+        response = await self.async_client.get(async_url)
+        self.assertEqual(response.status_code, expected.status_code)
+        self.assertEqual(response.json(), expected.json())
+        self.assertLessEqual(int(response['X-DB-Query-Count']), int(expected['X-DB-Query-Count']))
+
+    response = await self.async_client.get('/api/async/meters/?readings_last=0')
+    self.assertEqual(response.status_code, 400)
+
+  def test_calculation_coalescing(self):
+    """
+    Повторный запуск расчета дома за месяц возвращает id уже запущенной задачи; force запускает новую
+    """
+    started = []
+    start = partial(start_house_calculation, 1, 2024, 8, started.append)
+
+    task_id, coalesced = start()
+    self.assertEqual((started, coalesced), ([task_id], False))
+    self.assertEqual(start(), (task_id, True))
+    self.assertEqual(len(started), 1)
+
+    forced_task_id, coalesced = start(force=True)
+    self.assertEqual((started, coalesced), ([task_id, forced_task_id], False))
+    # Завершение прежней задачи не снимает ключ новой
+    release_house_calculation(1, 2024, 8, task_id)
+    self.assertEqual(start(), (forced_task_id, True))
+
+    # Ключ задачи, уже завершенной по данным бэкенда результатов, устарел
+    TaskResult.objects.create(task_id=forced_task_id, status='SUCCESS')
+    task_id, coalesced = start()
+    self.assertEqual((started[-1], coalesced), (task_id, False))
+
+    release_house_calculation(1, 2024, 8, task_id)
+    self.assertEqual(start()[1], False)
+    self.assertEqual(len(started), 4)
+
+  def test_calculation_routing(self):
+    house, *_ = self.create_dataset(10)
+    # 10 квартир и 10 счётчиков
+    with self.assertNumQueries(1):
+      self.assertEqual(estimate_house_cost(house.id), 20)
+    self.assertIsNone(estimate_house_cost(0))
+
+    with override_settings(CALC_LARGE_HOUSE_COST=19):
+      self.assertEqual(get_calculation_queue(19), QUEUE_INTERACTIVE)
+      self.assertEqual(get_calculation_queue(20), QUEUE_LARGE)
+      self.assertEqual(get_calculation_queue(1, ORIGIN_BATCH), QUEUE_BATCH)
+
+    router = current_app.amqp.router
+    self.assertEqual(router.route({}, calculate_houses_chunk_task.name)['queue'].name, QUEUE_BATCH)
+    self.assertEqual(router.route({}, calculate_utility_bills_for_house_task.name)['queue'].name, QUEUE_INTERACTIVE)
+    self.assertEqual(
+      router.route({'queue': QUEUE_LARGE}, calculate_utility_bills_for_house_task.name)['queue'].name, QUEUE_LARGE
+    )
+
+  def test_compact_task_result(self):
+    """
+    Результат задачи расчета — итоги и ссылка на квитанции; сжатый результат читается, как и прежний несжатый
+    """
+    house, *_ = self.create_dataset(10)
+    result = calculate_utility_bills_for_house_task.apply(args=(house.id, 2024, 8)).get()
+    self.assertEqual((result['bills'], result['cost'], result['processed_apartments']), (10, 15425.0, 10))
+    self.assertEqual(len(self.client.get(result['bills_url']).json()['results']), 10)
+
+    accept = ['application/json', 'application/x-json-zlib']
+    for serializer in ('json', 'json-zlib'):
+      with self.subTest(serializer=serializer):
+        _, _, payload = dumps(result, serializer=serializer)
+        self.assertEqual(loads(payload, 'application/x-json-zlib', 'binary', accept=accept), result)
+
+  @override_settings(CALC_CHUNK_APARTMENTS=4)
+  def test_resumed_task_result(self):
+    """
+    Итоги задачи, продолженной с контрольной точки, — по всем квитанциям дома, а не по пачкам последней попытки
+    """
+    house, *_ = self.create_dataset(10)
+    UtilityBill.objects.filter(apartment__house=house).delete()
+    chunks = []
+
+    def fail_on_second_chunk(apartments, *args):
+      chunks.append(len(apartments))
+      if len(chunks) == 2:
+        raise ValueError('Ошибка расчета')
+      return calculate_charges_decimal(apartments, *args)
+
+    with patch('home.services.calc_tarif.calculate_charges_decimal', side_effect=fail_on_second_chunk):
+      failed = calculate_utility_bills_for_house_task.apply(args=(house.id, 2024, 8), task_id='resumed-task')
+      self.assertEqual(failed.state, 'FAILURE')
+      result = calculate_utility_bills_for_house_task.apply(args=(house.id, 2024, 8), task_id='resumed-task').get()
+
+    self.assertEqual(chunks, [4, 4, 4, 2])
+    self.assertEqual((result['bills'], result['cost'], result['processed_apartments']), (10, 15425.0, 10))
+
+  @override_settings(MONTH_CLOSE_APARTMENTS_PER_SECOND=1000, MONTH_CLOSE_MAX_ATTEMPTS=2)
+  def test_month_close(self):
+    house, *_ = self.create_dataset(10)
+    eager = current_app.conf.task_always_eager
+    current_app.conf.task_always_eager = True
+    try:
+      result = close_month_task.apply(kwargs={'year': 2024, 'month': 8}).get()
+      # Повторный запуск расписания за тот же месяц не создает второй расчет
+      self.assertEqual(close_month_task.apply(kwargs={'year': 2024, 'month': 8}).get()['run_id'], result['run_id'])
+
+      run = CalculationRun.objects.get(id=result['run_id'])
+      self.assertEqual((run.trigger, run.status, run.houses_total, run.houses_done, run.houses_failed),
+                       ('schedule', 'готово', 10, 10, 0))
+      self.assertEqual((run.summary['attempts'], run.summary['apartments_per_second_limit']), (1, 1000))
+
+      # Дом с ошибкой рассчитывается повторно и пропадает из ошибок расчета
+      CalculationProgress.objects.filter(run=run, house_id=house.id).update(status='ошибка', error_message='Ошибка')
+      CalculationRun.objects.filter(id=run.id).update(status='в работе', houses_done=9, houses_failed=1)
+      finish_city_calculation_task([], run.id, run.summary['chunks'])
+    finally:
+      current_app.conf.task_always_eager = eager
+
+    response = self.client.get(f'/api/calculations/{run.id}/')
+    self.assertEqual(
+      [response.json()[field] for field in ('status', 'attempts', 'houses_done', 'houses_failed', 'failures')],
+      ['готово', 2, 10, 0, []]
+    )
+    # В сводке пачки всех проходов: первого и повторного
+    self.assertEqual(response.json()['summary']['chunks'], run.summary['chunks'] + 1)
+
+  @override_settings(CITY_CHUNK_APARTMENTS=10, CITY_MAX_COUNTDOWN=1800)
+  def test_city_calculation_budget(self):
+    """
+    Ограничение скорости расчета по городу соблюдается при запуске пачек (задержки по бюджету квартир),
+    пачка дальше предельной задержки откладывается повторно, ошибка пачки помечает расчет ошибкой
+    """
+    house, *_ = self.create_dataset(10)
+    Apartment.objects.bulk_create([
+      Apartment(house=other, number=1, area=Decimal('30')) for other in House.objects.exclude(id=house.id)[:5]
+    ])
+    run = CalculationRun.objects.create(year=2024, month=8, apartments_per_second_limit=0.001)
+
+    with patch('home.celery_tasks.chord') as chord_mock:
+      calculate_city_bills_task.apply(args=(run.id,))
+    header = list(chord_mock.call_args.args[0])
+    # Дом из 10 квартир отдельной пачкой, 5 домов по квартире и 4 пустых дома — следующей
+    self.assertEqual([len(signature.args[1]) for signature in header], [1, 9])
+    self.assertEqual([signature.options.get('countdown') for signature in header], [None, 1800])
+    self.assertIsNone(header[0].kwargs['not_before'])
+    self.assertAlmostEqual(header[1].kwargs['not_before'], time.time() + 10 / 0.001, delta=5)
+
+    callback = chord_mock.return_value.call_args.args[0]
+    self.assertEqual(callback.args, (run.id, 2))
+
+    # Пачка, запланированная позже предельной задержки, не занимает воркер ожиданием
+    with patch.object(calculate_houses_chunk_task, 'retry', side_effect=Retry()) as retry:
+      calculate_houses_chunk_task.apply(args=(run.id, header[1].args[1]), kwargs=header[1].kwargs)
+    self.assertAlmostEqual(retry.call_args.kwargs['countdown'], 1800, delta=5)
+    self.assertFalse(CalculationProgress.objects.filter(run=run).exists())
+
+    # Ошибка пачки: завершающий шаг не выполняется, расчет помечается ошибкой обработчиком link_error
+    callback.freeze()
+    try:
+      raise ChordError('Пачка завершилась ошибкой')
+    except ChordError as exc:
+      # Так бэкенд результатов вызывает обработчики при ошибке пачки
+      current_app.backend.chord_error_from_stack(callback, exc)
+    run.refresh_from_db()
+    self.assertEqual((run.status, run.summary['error']), ('ошибка', 'Пачка завершилась ошибкой'))
+    self.assertIsNotNone(run.finished_at)
+
+  @override_settings(TASK_EVENTS_BUS='local')
+  async def test_task_events(self):
+    """
+    Ход расчета приходит событиями: новые — по подписке, после завершения — сохраненным событием без запросов к БД
+    """
+    house, *_ = await sync_to_async(self.create_dataset)(10)
+    url = '/api/async/tasks/events-task/events/'
+
+    # Событий еще нет: текущее состояние из бэкенда результатов
+    response = await self.async_client.get(url)
+    self.assertEqual((response.json()['seq'], response.json()['event']), (0, 'status'))
+
+    def save_progress():
+      with self.captureOnCommitCallbacks(execute=True):
+        CalculationProgress.objects.create(house_id=house.id, year=2024, month=8, status='в работе',
+                                           task_id='events-task', total_apartments=10, processed_apartments=5)
+
+    waiting = asyncio.ensure_future(self.async_client.get(f'{url}?after=0&timeout=5'))
+    await asyncio.sleep(0.1)
+    await sync_to_async(save_progress)()
+    event = (await waiting).json()
+    self.assertEqual((event['seq'], event['event']), (1, 'progress'))
+    self.assertEqual(event['data']['progress']['processed_apartments'], 5)
+
+    response = await self.async_client.get(url, headers={'Accept': 'text/event-stream', 'Last-Event-ID': '1'})
+    await sync_to_async(calculate_utility_bills_for_house_task.apply)(args=(house.id, 2024, 8), task_id='events-task')
+    stream = b''.join([chunk async for chunk in response.streaming_content]).decode()
+    self.assertTrue(stream.startswith('id: 2\nevent: done\n'), stream)
+    self.assertIn('"bills": 10, "cost": 15425.0', stream)
+
+    # Клиент, пришедший после завершения, получает итог без запросов к БД
+    response = await self.async_client.get(f'{url}?after=2')
+    self.assertEqual((response.json()['event'], response['X-DB-Query-Count']), ('done', '0'))
+
+    await sync_to_async(calculate_utility_bills_for_house_task.apply)(args=(0, 2024, 8), task_id='failed-task')
+    response = await self.async_client.get('/api/async/tasks/failed-task/events/?after=0')
+    self.assertEqual(response.json()['event'], 'error')
+
+    response = await self.async_client.get(f'{url}?after=-1')
+    self.assertEqual(response.status_code, 400)
+
+  def test_admin_changelist_query_budget(self):
+    User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+    self.client.login(username='admin', password='admin')
+    for size in SIZES:
+      with self.subTest(size=size):
+        self.create_dataset(size)
+        for url, budget in ADMIN_BUDGETS.items():
+          with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+          self.assertEqual(response.status_code, 200)
+          self.assertLessEqual(len(queries), budget, f'{url}: {len(queries)} SQL-запросов вместо {budget}')
+
+
+class ReadingsConcurrencyTestCase(TransactionTestCase):
+  """
+  Одновременные передачи показаний по одному счётчику из разных соединений.
+  Нужна БД с блокировкой строк (PostgreSQL); на SQLite тест пропускается.
+  """
+  threads = 8
+
+  @skipUnlessDBFeature('has_select_for_update')
+  def test_concurrent_append(self):
+    water = MeterType.objects.create(name='ХВС', unit='м3')
+    house = House.objects.create(address='Ленина, 3')
+    apartment = Apartment.objects.create(house=house, number=1, area=Decimal('45.50'))
+    meter = Meter.objects.create(apartment=apartment, meter_number='ХВС-1', meter_type=water)
+    month = get_allowed_months()[0]
+    barrier = threading.Barrier(self.threads)
+    outcomes = []
+
+    def append(value):
+      try:
+        barrier.wait()
+        append_reading(meter.id, month, Decimal(value))
+        outcomes.append('created')
+      except ReadingError as e:
+        outcomes.append(str(e))
+      finally:
+        connections.close_all()
+
+    threads = [threading.Thread(target=append, args=(value,)) for value in range(self.threads)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(sorted(outcomes), ['created'] + [f'Показания за {month} уже существуют.'] * (self.threads - 1))
+    self.assertEqual(meter.meter_readings.count(), 1)
@@ -1,16 +1,49 @@
+import json
+from contextlib import aclosing
+from functools import partial
 from rest_framework import viewsets, generics, status, mixins
 from rest_framework.views import APIView
+from rest_framework.parsers import MultiPartParser
 from rest_framework.response import Response
-from .models import House, Apartment, Meter, MeterType
+from rest_framework.utils.encoders import JSONEncoder
+from asgiref.sync import sync_to_async
+from django.db.models import Count, Prefetch
+from django.conf import settings
+from django.http import StreamingHttpResponse, HttpResponse, HttpResponseForbidden, JsonResponse
+from django.views import View
+from prometheus_client import CONTENT_TYPE_LATEST
+from .models import House, Apartment, Meter, MeterType, CalculationRun, CalculationProgress, StaleBill
 from .serializers import (HouseSerializer,
                           ApartmentSerializer,
                           ApartmentWithHouseSerializer,
                           MeterByHouseSerializer,
                           MeterSerializer,
                           MeterTypeSerializer,
-                          HouseListSerializer)
-from celery.result import AsyncResult
-from .celery_tasks import calculate_utility_bills_for_house_task
+                          HouseListSerializer,
+                          CalculationRunSerializer,
+                          CalculationProfileSerializer,
+                          UtilityBillSerializer)
+from .pagination import BillCursorPagination
+from .metrics import render_metrics
+from .mixins import VersionedCacheMixin, ReadingsWindowMixin, READINGS_WINDOW_PARAMETERS
+from .services.response_cache import get_apartment_house_id
+from .celery_tasks import (calculate_utility_bills_for_house_task,
+                           calculate_city_bills_task,
+                           recalculate_stale_bills_task)
+from .services.calc_tarif import ENGINES, ENGINE_DECIMAL
+from .services.profiling import PROFILE_TOOLS
+from .services.bills import filter_bills, BillFilterError
+from .services.analytics import get_consumption_analytics
+from .services.task_results import (get_task_state, aget_task_state, get_task_progress, aget_task_progress,
+                                    UNFINISHED_STATES)
+from .services.calculation_lock import start_house_calculation
+from .services.task_routing import estimate_house_cost, get_calculation_queue, ORIGINS, ORIGIN_INTERACTIVE
+from .services.task_events import (iter_task_events, make_event, dump_event, EVENT_STATUS, EVENT_DONE,
+                                   EVENT_ERROR)
+from .services.bills_export import export_bills, CONTENT_TYPES
+from .services.readings import get_readings_window, ReadingError
+from .services.readings_import import (import_readings, iter_text_lines, detect_format, FORMATS, FORMAT_NDJSON,
+                                      IMPORT_MAX_ERRORS)
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
 
@@ -46,26 +79,37 @@ class HouseListViewSet(mixins.ListModelMixin,
     """
     return super().create(request, *args, **kwargs)
 
-class HouseDetailView(generics.RetrieveUpdateAPIView):
-  queryset = House.objects.prefetch_related(
-        'apartments__meters',
-        'apartments__meters__meter_type'
-  )
+class HouseDetailView(VersionedCacheMixin, ReadingsWindowMixin, generics.RetrieveUpdateAPIView):
   serializer_class = HouseSerializer
   lookup_field = 'id'
   http_method_names = ['get', 'put']
 
+  def get_queryset(self):
+    return House.objects.prefetch_related(
+      'apartments__meters',
+      self.get_readings_prefetch('apartments__meters__meter_readings')
+    )
+
+  def get_cache_house_id(self):
+    return self.kwargs['id']
+
+  def perform_update(self, serializer):
+    super().perform_update(serializer)
+    # UpdateModelMixin сбрасывает prefetch объекта: перечитываем его одним набором запросов
+    serializer.instance = self.get_queryset().get(pk=serializer.instance.pk)
+
   @swagger_auto_schema(
     operation_description='Получить детали дома с его квартирами и счётчиками',
     operation_summary='Данные по дому (квартиры, счетчики)',
     tags=['Управление домом'],
+    manual_parameters=READINGS_WINDOW_PARAMETERS,
     responses={200: HouseSerializer}
   )
   def get(self, request, *args, **kwargs):
     """
     Возвращает детали дома, включая связанные квартиры и счётчики.
     """
-    return super().get(request, *args, **kwargs)
+    return self.versioned_get(request, partial(super().get, request, *args, **kwargs))
 
   @swagger_auto_schema(
     operation_description='Обновить детали дома',
@@ -97,23 +141,34 @@ class ApartmentCreateView(generics.CreateAPIView):
     """
     return super().post(request, *args, **kwargs)
 
-class ApartmentDetailView(generics.RetrieveUpdateAPIView):
-  queryset = Apartment.objects.all()
+class ApartmentDetailView(VersionedCacheMixin, ReadingsWindowMixin, generics.RetrieveUpdateAPIView):
   serializer_class = ApartmentWithHouseSerializer
   lookup_field = 'id'
   http_method_names = ['get', 'put']
 
+  def get_queryset(self):
+    return Apartment.objects.prefetch_related(self.get_readings_prefetch('meters__meter_readings'))
+
+  def get_cache_house_id(self):
+    return get_apartment_house_id(self.kwargs['id'])
+
+  def perform_update(self, serializer):
+    super().perform_update(serializer)
+    # UpdateModelMixin сбрасывает prefetch объекта: перечитываем его одним набором запросов
+    serializer.instance = self.get_queryset().get(pk=serializer.instance.pk)
+
   @swagger_auto_schema(
     operation_description='Получить информацию о квартире с деталями счётчиков и ID дома',
     operation_summary='Данные по квартире (счетчики, дом)',
     tags=['Управление квартирой'],
+    manual_parameters=READINGS_WINDOW_PARAMETERS,
     responses={200: ApartmentWithHouseSerializer}
   )
   def get(self, request, *args, **kwargs):
     """
     Возвращает детали квартиры, включая ID дома и список счётчиков.
     """
-    return super().get(request, *args, **kwargs)
+    return self.versioned_get(request, partial(super().get, request, *args, **kwargs))
 
   @swagger_auto_schema(
     operation_description='Обновить данные о квартире',
@@ -156,14 +211,19 @@ class MeterTypeViewSet(viewsets.ReadOnlyModelViewSet):
     """
     return super().retrieve(request, *args, **kwargs)
 
-class MetersByHouseView(generics.ListAPIView):
+class MetersByHouseView(VersionedCacheMixin, ReadingsWindowMixin, generics.ListAPIView):
   serializer_class = MeterByHouseSerializer
 
+  def get_cache_house_id(self):
+    return self.kwargs['house_id']
+
   def get_queryset(self):
     house_id = self.kwargs['house_id']
     apartment_id = self.request.query_params.get('apartment_id', None)
 
-    queryset = Meter.objects.filter(apartment__house_id=house_id)
+    queryset = (Meter.objects
+                .filter(apartment__house_id=house_id)
+                .prefetch_related(self.get_readings_prefetch('meter_readings')))
 
     if apartment_id is not None:
       queryset = queryset.filter(apartment_id=apartment_id)
@@ -180,7 +240,8 @@ class MetersByHouseView(generics.ListAPIView):
         openapi.IN_QUERY,
         description='ID квартиры для фильтрации',
         type=openapi.TYPE_INTEGER
-      )
+      ),
+      *READINGS_WINDOW_PARAMETERS
     ],
     responses={200: MeterByHouseSerializer(many=True)}
   )
@@ -189,11 +250,11 @@ class MetersByHouseView(generics.ListAPIView):
     Возвращает список всех счётчиков, связанных с домом по `house_id`.
     Дополнительно можно фильтровать по `apartment_id`.
     """
-    return super().get(request, *args, **kwargs)
+    return self.versioned_get(request, partial(super().get, request, *args, **kwargs))
 
 
 class MeterDetailView(generics.RetrieveUpdateAPIView):
-    queryset = Meter.objects.all()
+    queryset = Meter.objects.prefetch_related('meter_readings')
     serializer_class = MeterByHouseSerializer
     lookup_field = 'id'
     http_method_names = ['get', 'put']
@@ -280,17 +341,22 @@ class MeterDetailView(generics.RetrieveUpdateAPIView):
       """
       return super().put(request, *args, **kwargs)
 
-class MeterViewSet(mixins.ListModelMixin,
+class MeterViewSet(ReadingsWindowMixin,
+                   mixins.ListModelMixin,
                    mixins.CreateModelMixin,
                    viewsets.GenericViewSet):
   queryset = Meter.objects.all()
   serializer_class = MeterSerializer
   http_method_names = ['get', 'post']
 
+  def get_queryset(self):
+    return Meter.objects.prefetch_related(self.get_readings_prefetch('meter_readings'))
+
   @swagger_auto_schema(
     operation_description='Получить список всех счётчиков',
     operation_summary='Список счётчиков',
     tags=['Управление счётчиками'],
+    manual_parameters=READINGS_WINDOW_PARAMETERS,
     responses={200: MeterSerializer(many=True)}
   )
   def list(self, request, *args, **kwargs):
@@ -312,6 +378,58 @@ class MeterViewSet(mixins.ListModelMixin,
     """
     return super().create(request, *args, **kwargs)
 
+class MeterReadingsImportView(APIView):
+  parser_classes = [MultiPartParser]
+
+  @swagger_auto_schema(
+    operation_description='Массовая загрузка показаний счётчиков из CSV (колонки meter_id, period, value) '
+                          'или NDJSON (объекты {"meter_id": 1, "period": "2024-06", "value": 150}). '
+                          'Файл обрабатывается потоково, пачками; каждая строка проверяется по тем же правилам, '
+                          f'что и при редактировании счётчика. В errors — первые {IMPORT_MAX_ERRORS} ошибок, '
+                          'failed — кол-во всех строк с ошибками.',
+    operation_summary='Загрузка показаний счётчиков файлом',
+    tags=['Управление счётчиками'],
+    manual_parameters=[
+      openapi.Parameter('file', openapi.IN_FORM, type=openapi.TYPE_FILE, required=True,
+                        description='Файл с показаниями'),
+      openapi.Parameter('file_format', openapi.IN_FORM, type=openapi.TYPE_STRING, enum=list(FORMATS),
+                        description='Формат файла (по умолчанию по расширению, иначе csv)')
+    ],
+    responses={
+      200: openapi.Response(description='Отчет о загрузке', examples={
+        'application/json': {
+          'total': 3,
+          'created': 2,
+          'failed': 1,
+          'errors': [
+            {'row': 3, 'error': 'Показания за 2024-06 уже существуют.'}
+          ]
+        }
+      }),
+      400: openapi.Response(description='Неправильный запрос', examples={
+        'application/json': {
+          'error': 'Необходимо передать файл с показаниями.'
+        }
+      })
+    }
+  )
+  def post(self, request):
+    upload = request.FILES.get('file')
+    if upload is None:
+      return Response({'error': 'Необходимо передать файл с показаниями.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    file_format = request.data.get('file_format') or detect_format(upload.name)
+    if file_format not in FORMATS:
+      return Response({'error': f'Формат файла должен быть одним из: {", ".join(FORMATS)}.'},
+                      status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+      report = import_readings(iter_text_lines(upload), file_format)
+    except UnicodeDecodeError:
+      return Response({'error': 'Файл должен быть в кодировке UTF-8.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response(report, status=status.HTTP_200_OK)
+
 class UtilityBillCalculationView(APIView):
   @swagger_auto_schema(
     operation_description='Запуск задачи расчета квитанций за коммунальные услуги для указанного дома',
@@ -324,14 +442,31 @@ class UtilityBillCalculationView(APIView):
         'year': openapi.Schema(type=openapi.TYPE_INTEGER, description='Год расчета'),
         'month': openapi.Schema(type=openapi.TYPE_INTEGER, description='Месяц расчета'),
         'delay': openapi.Schema(type=openapi.TYPE_INTEGER, description='Задержка в секундах перед началом расчета',
-                                default=0)
+                                default=0),
+        'engine': openapi.Schema(type=openapi.TYPE_STRING, enum=list(ENGINES), default=ENGINE_DECIMAL,
+                                 description='Движок расчета: построчный Decimal или векторизованный NumPy'),
+        'profile': openapi.Schema(type=openapi.TYPE_BOOLEAN, default=False,
+                                  description='Профилирование расчета: время по этапам, результат по '
+                                              'api/tasks/task_id/profile/'),
+        'profile_tools': openapi.Schema(type=openapi.TYPE_ARRAY,
+                                        items=openapi.Schema(type=openapi.TYPE_STRING, enum=list(PROFILE_TOOLS)),
+                                        description='Дополнительно к времени по этапам: профиль cProfile '
+                                                    'и/или снимок памяти tracemalloc (только вместе с profile)'),
+        'force': openapi.Schema(type=openapi.TYPE_BOOLEAN, default=False,
+                                description='Запустить новый расчет, даже если расчет дома за этот месяц '
+                                            'уже в очереди или выполняется'),
+        'origin': openapi.Schema(type=openapi.TYPE_STRING, enum=list(ORIGINS), default=ORIGIN_INTERACTIVE,
+                                 description='Происхождение запуска: interactive — очередь по размеру дома, '
+                                             'batch — очередь пакетных расчетов')
       }
     ),
     responses={
-      202: openapi.Response(description='Задача по расчету квитанций запущена', examples={
+      202: openapi.Response(description='Задача по расчету квитанций запущена или уже выполняется '
+                                        '(coalesced: true — возвращен id уже запущенной задачи)', examples={
         'application/json': {
           'task_id': '1234567890',
-          'status': 'Расчет квартплаты выполняется'
+          'status': 'Расчет квартплаты выполняется',
+          'coalesced': False
         }
       }),
       400: openapi.Response(description='Неправильный запрос', examples={
@@ -351,22 +486,49 @@ class UtilityBillCalculationView(APIView):
     year = request.data.get('year')
     month = request.data.get('month')
     delay = request.data.get('delay', 0)
+    engine = request.data.get('engine', ENGINE_DECIMAL)
+    profile_tools = request.data.get('profile_tools') or []
 
     if not all([year, month]):
       return Response({'error': 'Необходимо указать год и месяц для расчета.'}, status=status.HTTP_400_BAD_REQUEST)
 
+    if engine not in ENGINES:
+      return Response({'error': f'Движок расчета должен быть одним из: {", ".join(ENGINES)}.'},
+                      status=status.HTTP_400_BAD_REQUEST)
+
+    if not isinstance(profile_tools, list) or not set(profile_tools) <= set(PROFILE_TOOLS):
+      return Response({'error': f'Инструменты профилирования должны быть списком из: {", ".join(PROFILE_TOOLS)}.'},
+                      status=status.HTTP_400_BAD_REQUEST)
+
+    profile = profile_tools if request.data.get('profile') in (True, 'true', '1', 1) else None
+    force = request.data.get('force') in (True, 'true', '1', 1)
+    origin = request.data.get('origin', ORIGIN_INTERACTIVE)
+
+    if origin not in ORIGINS:
+      return Response({'error': f'Происхождение запуска должно быть одним из: {", ".join(ORIGINS)}.'},
+                      status=status.HTTP_400_BAD_REQUEST)
+
     try:
       year = int(year)
       month = int(month)
       delay = int(delay)
 
-      house = House.objects.get(id=house_id)
-      if not house:
-        return Response({'error': 'Указанного дома не существует'}, status=status.HTTP_400_BAD_REQUEST)
+      cost = estimate_house_cost(house_id)
+      if cost is None:
+        raise House.DoesNotExist
+      queue = get_calculation_queue(cost, origin)
 
-      task = calculate_utility_bills_for_house_task.delay(house_id, year, month, delay)
+      # Повторный запрос (двойной клик, повтор клиента) присоединяется к уже запущенному расчету дома за месяц
+      task_id, coalesced = start_house_calculation(
+        house_id, year, month,
+        lambda task_id: calculate_utility_bills_for_house_task.apply_async(
+          (house_id, year, month, delay, engine, profile), task_id=task_id, queue=queue
+        ),
+        force=force
+      )
 
-      return Response({'task_id': task.id, 'status': 'Расчет квартплаты выполняется'}, status=status.HTTP_202_ACCEPTED)
+      return Response({'task_id': task_id, 'status': 'Расчет квартплаты выполняется', 'coalesced': coalesced},
+                      status=status.HTTP_202_ACCEPTED)
     except House.DoesNotExist:
       return Response({'error': 'Дом не найден.'}, status=status.HTTP_404_NOT_FOUND)
     except ValueError:
@@ -374,6 +536,222 @@ class UtilityBillCalculationView(APIView):
     except Exception as e:
       return Response({'error': f'Произошла ошибка: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+class CityBillCalculationView(APIView):
+  @swagger_auto_schema(
+    operation_description='Запуск расчета квитанций за месяц для всех домов (или для переданного списка домов). '
+                          'Дома раскладываются по пачкам с учетом кол-ва квартир и считаются параллельно.',
+    operation_summary='Запуск расчета квитанций по городу',
+    tags=['Расчет ком. услуг'],
+    request_body=openapi.Schema(
+      type=openapi.TYPE_OBJECT,
+      required=['year', 'month'],
+      properties={
+        'year': openapi.Schema(type=openapi.TYPE_INTEGER, description='Год расчета'),
+        'month': openapi.Schema(type=openapi.TYPE_INTEGER, description='Месяц расчета'),
+        'house_ids': openapi.Schema(type=openapi.TYPE_ARRAY, items=openapi.Schema(type=openapi.TYPE_INTEGER),
+                                    description='ID домов для расчета (по умолчанию все дома)'),
+        'engine': openapi.Schema(type=openapi.TYPE_STRING, enum=list(ENGINES), default=ENGINE_DECIMAL,
+                                 description='Движок расчета: построчный Decimal или векторизованный NumPy')
+      }
+    ),
+    responses={
+      202: openapi.Response(description='Расчет по городу запущен', examples={
+        'application/json': {
+          'job_id': 1,
+          'status': 'Расчет квартплаты по городу выполняется'
+        }
+      }),
+      400: openapi.Response(description='Неправильный запрос', examples={
+        'application/json': {
+          'error': 'Некорректный формат года или месяца.'
+        }
+      }),
+    }
+  )
+  def post(self, request):
+    year = request.data.get('year')
+    month = request.data.get('month')
+    house_ids = request.data.get('house_ids')
+    engine = request.data.get('engine', ENGINE_DECIMAL)
+
+    if not all([year, month]):
+      return Response({'error': 'Необходимо указать год и месяц для расчета.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    if engine not in ENGINES:
+      return Response({'error': f'Движок расчета должен быть одним из: {", ".join(ENGINES)}.'},
+                      status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+      year = int(year)
+      month = int(month)
+      if house_ids is not None:
+        house_ids = [int(house_id) for house_id in house_ids]
+    except (TypeError, ValueError):
+      return Response({'error': 'Некорректный формат года, месяца или списка домов.'},
+                      status=status.HTTP_400_BAD_REQUEST)
+
+    run = CalculationRun.objects.create(year=year, month=month, house_ids=house_ids, engine=engine)
+    calculate_city_bills_task.delay(run.id)
+
+    return Response({'job_id': run.id, 'status': 'Расчет квартплаты по городу выполняется'},
+                    status=status.HTTP_202_ACCEPTED)
+
+class CalculationRunView(generics.RetrieveAPIView):
+  queryset = CalculationRun.objects.all()
+  serializer_class = CalculationRunSerializer
+  lookup_field = 'id'
+
+  @swagger_auto_schema(
+    operation_description='Получить прогресс расчета по городу: кол-во рассчитанных домов и квартир, ошибки по домам '
+                          'и итоговую сводку после завершения',
+    operation_summary='Прогресс расчета по городу',
+    tags=['Расчет ком. услуг'],
+    responses={200: CalculationRunSerializer}
+  )
+  def get(self, request, *args, **kwargs):
+    """
+    Возвращает сводный прогресс расчета по городу по `job_id`.
+    """
+    return super().get(request, *args, **kwargs)
+
+class UtilityBillListView(generics.ListAPIView):
+  serializer_class = UtilityBillSerializer
+  pagination_class = BillCursorPagination
+
+  def get_queryset(self):
+    params = self.request.query_params
+    return filter_bills(params.get('house_id'), params.get('apartment_id'),
+                        params.get('month_from'), params.get('month_to'))
+
+  @swagger_auto_schema(
+    operation_description='Рассчитанные квитанции с фильтром по дому, квартире и диапазону месяцев. '
+                          'Постраничная выдача по курсору: ссылки next / previous из ответа.',
+    operation_summary='Список квитанций',
+    tags=['Расчет ком. услуг'],
+    manual_parameters=[
+      openapi.Parameter('house_id', openapi.IN_QUERY, type=openapi.TYPE_INTEGER, description='ID дома'),
+      openapi.Parameter('apartment_id', openapi.IN_QUERY, type=openapi.TYPE_INTEGER, description='ID квартиры'),
+      openapi.Parameter('month_from', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                        description='Начальный месяц (YYYY-MM), включительно'),
+      openapi.Parameter('month_to', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                        description='Конечный месяц (YYYY-MM), включительно')
+    ],
+    responses={
+      200: UtilityBillSerializer(many=True),
+      400: openapi.Response(description='Неправильный запрос', examples={
+        'application/json': {
+          'error': 'Параметр month_from должен быть в формате YYYY-MM.'
+        }
+      })
+    }
+  )
+  def get(self, request, *args, **kwargs):
+    try:
+      return self.list(request, *args, **kwargs)
+    except BillFilterError as e:
+      return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+class UtilityBillExportView(APIView):
+  @swagger_auto_schema(
+    operation_description='Потоковая выгрузка квитанций с данными квартиры и дома в NDJSON или CSV. '
+                          'Без фильтров выгружаются квитанции по всему городу; память сервера не зависит '
+                          'от объема выгрузки.',
+    operation_summary='Выгрузка квитанций',
+    tags=['Расчет ком. услуг'],
+    manual_parameters=[
+      openapi.Parameter('export_format', openapi.IN_QUERY, type=openapi.TYPE_STRING, enum=list(FORMATS),
+                        default=FORMAT_NDJSON, description='Формат выгрузки'),
+      openapi.Parameter('house_id', openapi.IN_QUERY, type=openapi.TYPE_INTEGER, description='ID дома'),
+      openapi.Parameter('apartment_id', openapi.IN_QUERY, type=openapi.TYPE_INTEGER, description='ID квартиры'),
+      openapi.Parameter('month_from', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                        description='Начальный месяц (YYYY-MM), включительно'),
+      openapi.Parameter('month_to', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                        description='Конечный месяц (YYYY-MM), включительно')
+    ],
+    responses={
+      200: openapi.Response(description='Файл с квитанциями (по строке на квитанцию)'),
+      400: openapi.Response(description='Неправильный запрос', examples={
+        'application/json': {
+          'error': 'Формат выгрузки должен быть одним из: csv, ndjson.'
+        }
+      })
+    }
+  )
+  def get(self, request):
+    params = request.query_params
+    file_format = params.get('export_format', FORMAT_NDJSON)
+    if file_format not in FORMATS:
+      return Response({'error': f'Формат выгрузки должен быть одним из: {", ".join(FORMATS)}.'},
+                      status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+      bills = filter_bills(params.get('house_id'), params.get('apartment_id'),
+                           params.get('month_from'), params.get('month_to'))
+    except BillFilterError as e:
+      return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    response = StreamingHttpResponse(export_bills(bills, file_format), content_type=CONTENT_TYPES[file_format])
+    response['Content-Disposition'] = f'attachment; filename="bills.{file_format}"'
+    return response
+
+class StaleBillsView(APIView):
+  @swagger_auto_schema(
+    operation_description='Кол-во квитанций, устаревших после исправления показаний, площади квартиры или цены тарифа',
+    operation_summary='Устаревшие квитанции',
+    tags=['Расчет ком. услуг'],
+    responses={200: openapi.Response(description='Кол-во устаревших квитанций', examples={
+      'application/json': {
+        'total': 3,
+        'by_reason': {'reading': 2, 'area': 1}
+      }
+    })}
+  )
+  def get(self, request):
+    by_reason = dict(StaleBill.objects.values_list('reason').annotate(count=Count('id')).values_list('reason', 'count'))
+    return Response({'total': sum(by_reason.values()), 'by_reason': by_reason}, status=status.HTTP_200_OK)
+
+  @swagger_auto_schema(
+    operation_description='Запуск пересчета только устаревших квитанций (пачками), без полного пересчета домов',
+    operation_summary='Пересчет устаревших квитанций',
+    tags=['Расчет ком. услуг'],
+    responses={202: openapi.Response(description='Пересчет устаревших квитанций запущен', examples={
+      'application/json': {
+        'task_id': '1234567890',
+        'status': 'Пересчет устаревших квитанций выполняется'
+      }
+    })}
+  )
+  def post(self, request):
+    task = recalculate_stale_bills_task.delay()
+    return Response({'task_id': task.id, 'status': 'Пересчет устаревших квитанций выполняется'},
+                    status=status.HTTP_202_ACCEPTED)
+
+def get_task_status_data(state, result, progress=None):
+  """
+  Ответ на опрос статуса расчета: (данные, HTTP-статус); общий для синхронного и асинхронного эндпоинтов
+  """
+  if state in UNFINISHED_STATES:
+    if progress is None:
+      return {'status': 'Расчет квартплаты в очереди на выполнение'}, status.HTTP_200_OK
+
+    return {
+      'status': 'Расчет квартплаты выполняется',
+      'progress': {
+        'processed_apartments': progress.processed_apartments,
+        'total_apartments': progress.total_apartments,
+        'last_apartment_id': progress.last_apartment_id
+      }
+    }, status.HTTP_200_OK
+
+  elif state == 'SUCCESS':
+    return {'status': 'Расчет квартплаты выполнен', 'data': result}, status.HTTP_200_OK
+
+  elif state == 'FAILURE':
+    return ({'status': 'Ошибка выполнения расчета квартплаты', 'error': str(result)},
+            status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+  return {'status': 'Неизвестное состояние расчета квартплаты'}, status.HTTP_400_BAD_REQUEST
+
 class TaskResultView(APIView):
   @swagger_auto_schema(
     operation_description='Получить статус выполнения задачи расчета квартплаты',
@@ -389,34 +767,21 @@ class TaskResultView(APIView):
     ],
     responses={
       200: openapi.Response(
-        description='Статус выполнения задачи',
+        description='Статус выполнения задачи; результат расчета — итоги и ссылка на квитанции дома за месяц',
         examples={
           'application/json': {
             'status': 'Расчет квартплаты выполнен',
-            'data': [
-              {
-                'apartment_id': 0,
-                'apartment_number': 0,
-                'house_id': 0,
-                'address': 'string',
-                'date': 'string',
-                'calc_rent': [
-                  {
-                    'id': 0,
-                    'name': 'string',
-                    'consumption': 0,
-                    'unit': 'string',
-                    'cost': 0
-                  }
-                ],
-                'absent_meters': [
-                  {
-                    'id': 0,
-                    'name': 'name'
-                  }
-                ]
-              }
-            ]
+            'data': {
+              'house_id': 1,
+              'processed_apartments': 2000,
+              'total_apartments': 2000,
+              'last_apartment_id': 2000,
+              'year': 2024,
+              'month': 8,
+              'bills': 2000,
+              'cost': 3085000.0,
+              'bills_url': '/api/bills/?house_id=1&month_from=2024-08&month_to=2024-08'
+            }
           }
         }
       ),
@@ -424,8 +789,12 @@ class TaskResultView(APIView):
         description='Задача по расчету квитанций запущена',
         examples={
           'application/json': {
-            'task_id': '1234567890',
-            'status': 'Расчет квартплаты выполняется'
+            'status': 'Расчет квартплаты выполняется',
+            'progress': {
+              'processed_apartments': 500,
+              'total_apartments': 2000,
+              'last_apartment_id': 500
+            }
           }
         },
       ),
@@ -438,20 +807,195 @@ class TaskResultView(APIView):
   )
 
   def get(self, request, task_id):
-    task_result = AsyncResult(task_id)
+    state, result = get_task_state(task_id)
+    progress = get_task_progress(task_id) if state in UNFINISHED_STATES else None
+    data, status_code = get_task_status_data(state, result, progress)
+    return Response(data, status=status_code)
+
+class MetricsView(View):
+  """
+  Метрики Prometheus; доступны только с адресов из METRICS_ALLOWED_IPS
+  """
+  def get(self, request):
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+      return HttpResponseForbidden()
+    return HttpResponse(render_metrics(), content_type=CONTENT_TYPE_LATEST)
+
+class CalculationProfileView(APIView):
+  @swagger_auto_schema(
+    operation_description='Профиль расчета квартплаты, запущенного с profile=true: время по этапам (загрузка '
+                          'дома, квартир, счетчиков, расчет, оценка по среднему, формирование и запись квитанций), '
+                          'при выборе - профиль cProfile и снимок памяти tracemalloc',
+    operation_summary='Профиль расчета квартплаты',
+    tags=['Расчет ком. услуг'],
+    responses={
+      200: CalculationProfileSerializer,
+      404: openapi.Response(description='Профиль не найден', examples={
+        'application/json': {
+          'error': 'Профиль расчета не найден.'
+        }
+      })
+    }
+  )
+  def get(self, request, task_id):
+    progress = (CalculationProgress.objects
+                .filter(task_id=task_id, profile__isnull=False)
+                .order_by('-id')
+                .first())
+    if progress is None:
+      return Response({'error': 'Профиль расчета не найден.'}, status=status.HTTP_404_NOT_FOUND)
 
-    if task_result.state == 'PENDING':
-      return Response({'status': 'Расчет квартплаты в очереди на выполнение'}, status=status.HTTP_200_OK)
+    return Response(CalculationProfileSerializer(progress).data, status=status.HTTP_200_OK)
 
-    elif task_result.state == 'STARTED':
-      return Response({'status': 'Расчет квартплаты выполняется'}, status=status.HTTP_200_OK)
+class ConsumptionAnalyticsView(APIView):
+  @swagger_auto_schema(
+    operation_description='Итоги начислений по месяцам и тарифам (расход, сумма, кол-во начислений по среднему '
+                          'расходу) для дома или по всем домам, с изменением к предыдущему месяцу в процентах. '
+                          'Итоги обновляются после каждого расчета дома.',
+    operation_summary='Аналитика начислений',
+    tags=['Расчет ком. услуг'],
+    manual_parameters=[
+      openapi.Parameter('house_id', openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                        description='ID дома (по умолчанию итоги по всем домам)'),
+      openapi.Parameter('meter_type_id', openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                        description='Только тарифы по указанному типу счётчика'),
+      openapi.Parameter('month_from', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                        description='Начальный месяц (YYYY-MM), включительно'),
+      openapi.Parameter('month_to', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                        description='Конечный месяц (YYYY-MM), включительно')
+    ],
+    responses={
+      200: openapi.Response(description='Итоги по месяцам', examples={
+        'application/json': {
+          'house_id': 1,
+          'months': [
+            {
+              'month': '2024-08',
+              'cost': 15230.5,
+              'cost_change_percent': 3.2,
+              'estimated': 4,
+              'charges': [
+                {
+                  'tariff_id': 2,
+                  'name': 'Water',
+                  'unit': 'm3',
+                  'meter_type_id': 1,
+                  'apartments': 120,
+                  'consumption': 1824.6,
+                  'cost': 7390.2,
+                  'estimated': 4,
+                  'consumption_change_percent': -1.5
+                }
+              ]
+            }
+          ]
+        }
+      }),
+      400: openapi.Response(description='Неправильный запрос', examples={
+        'application/json': {
+          'error': 'Параметр month_from должен быть в формате YYYY-MM.'
+        }
+      })
+    }
+  )
+  def get(self, request):
+    params = request.query_params
+    try:
+      analytics = get_consumption_analytics(params.get('house_id'), params.get('month_from'),
+                                            params.get('month_to'), params.get('meter_type_id'))
+    except BillFilterError as e:
+      return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-    elif task_result.state == 'SUCCESS':
-      result = task_result.result
-      return Response({'status': 'Расчет квартплаты выполнен', 'data': result}, status=status.HTTP_200_OK)
+    return Response(analytics, status=status.HTTP_200_OK)
 
-    elif task_result.state == 'FAILURE':
-      return Response({'status': 'Ошибка выполнения расчета квартплаты', 'error': str(task_result.result)},
-                      status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    return Response({'status': 'Неизвестное состояние расчета квартплаты'}, status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+# Асинхронные эндпоинты чтения (ASGI, uvicorn): запросы к БД через async ORM не блокируют цикл событий,
+# поэтому один процесс обслуживает много одновременных опросов. Ответы совпадают с синхронными эндпоинтами.
+
+class AsyncHouseListView(View):
+  async def get(self, request):
+    houses = [house async for house in House.objects.all()]
+    return JsonResponse(HouseListSerializer(houses, many=True).data, safe=False, encoder=JSONEncoder)
+
+class AsyncMeterListView(View):
+  async def get(self, request):
+    params = request.GET
+    try:
+      readings = get_readings_window(params.get('readings'), params.get('readings_since'), params.get('readings_last'))
+    except ReadingError as e:
+      return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    meters = [meter async for meter in Meter.objects.prefetch_related(Prefetch('meter_readings', queryset=readings))]
+    # Тип счётчика берется из справочного кэша, который при промахе читает БД синхронно
+    data = await sync_to_async(lambda: MeterSerializer(meters, many=True, context={'request': request}).data)()
+    return JsonResponse(data, safe=False, encoder=JSONEncoder)
+
+async def aget_task_status(task_id):
+  """
+  (состояние, данные, HTTP-статус) опроса статуса расчета через async ORM
+  """
+  state, result = await aget_task_state(task_id)
+  progress = await aget_task_progress(task_id) if state in UNFINISHED_STATES else None
+  return (state, *get_task_status_data(state, result, progress))
+
+class AsyncTaskResultView(View):
+  async def get(self, request, task_id):
+    _, data, status_code = await aget_task_status(task_id)
+    return JsonResponse(data, status=status_code, encoder=JSONEncoder)
+
+async def aget_initial_task_event(task_id):
+  """
+  Событие для задачи без сохраненных событий (запущена до включения событий или события истекли):
+  состояние из бэкенда результатов, один раз на подключение
+  """
+  state, data, _ = await aget_task_status(task_id)
+  if state in UNFINISHED_STATES:
+    event = EVENT_STATUS
+  else:
+    event = EVENT_DONE if state == 'SUCCESS' else EVENT_ERROR
+  return json.loads(dump_event(make_event(task_id, 0, event, data)))
+
+async def stream_task_events(events):
+  """
+  События в формате Server-Sent Events; пустой комментарий поддерживает соединение через прокси
+  """
+  async with aclosing(events):
+    async for event in events:
+      if event is None:
+        yield ': keepalive\n\n'
+        continue
+      yield f"id: {event['seq']}\nevent: {event['event']}\ndata: {dump_event(event)}\n\n"
+
+class AsyncTaskEventsView(View):
+  """
+  Ход расчета без опроса БД: события задачи (прогресс по пачкам квартир, итог или ошибка).
+  С заголовком Accept: text/event-stream — поток Server-Sent Events до итогового события;
+  иначе long-poll: первое событие с номером больше after (или текущее состояние без after),
+  204 — за timeout секунд новых событий не было.
+  """
+  async def get(self, request, task_id):
+    try:
+      after = request.GET.get('after', request.headers.get('Last-Event-ID'))
+      after = int(after) if after not in (None, '') else None
+      timeout = float(request.GET.get('timeout', settings.TASK_EVENTS_POLL_TIMEOUT))
+      if (after is not None and after < 0) or timeout <= 0:
+        raise ValueError
+    except ValueError:
+      return JsonResponse({'error': 'after должен быть целым числом не меньше 0, timeout — положительным числом.'},
+                          status=status.HTTP_400_BAD_REQUEST)
+
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+      events = iter_task_events(task_id, after, get_initial=aget_initial_task_event)
+      response = StreamingHttpResponse(stream_task_events(events), content_type='text/event-stream')
+      response['Cache-Control'] = 'no-cache'
+      # Без буферизации ответа в nginx
+      response['X-Accel-Buffering'] = 'no'
+      return response
+
+    events = iter_task_events(task_id, after, timeout=min(timeout, settings.TASK_EVENTS_POLL_TIMEOUT),
+                              get_initial=aget_initial_task_event)
+    async with aclosing(events):
+      async for event in events:
+        if event is not None:
+          return JsonResponse(event)
+    return HttpResponse(status=status.HTTP_204_NO_CONTENT)